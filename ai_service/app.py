@@ -9,12 +9,11 @@ import logging
 print(f"DEBUG PRINT (app.py top): OPENROUTER_API_KEY from .env: {os.getenv('OPENROUTER_API_KEY')}")
 
 from flask import Flask, request, jsonify
-import threading
 import requests # Keep for Response object if needed by Flask
 
 # Importaciones de los nuevos módulos
-import rabbitmq_client
 import openrouter_client
+from comun.metricas import estado_salud, respuesta_metricas, registrar_comprobacion
 
 # Configure logging (can be done after load_dotenv if logging config might come from .env)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -26,15 +25,42 @@ app = Flask(__name__)
 
 # Las configuraciones de API y RabbitMQ se han movido a sus respectivos módulos.
 
+# Sin la clave de OpenRouter el proxy no puede atender ninguna petición
+registrar_comprobacion("openrouter_api_key", lambda: bool(openrouter_client.OPENROUTER_API_KEY))
+
 @app.route('/health')
 def health_check():
-    # Considerar verificar la conectividad con RabbitMQ si es crítico
-    # rabbitmq_status = rabbitmq_client.check_rabbitmq_connection()
-    # if rabbitmq_status:
-    #     return jsonify({"status": "healthy", "rabbitmq_connection": "ok"}), 200
-    # else:
-    #     return jsonify({"status": "unhealthy", "rabbitmq_connection": "failed"}), 503
-    return jsonify({"status": "healthy"}), 200
+    """Disponibilidad real: 503 si falla alguna comprobación (en modo desarrollo, también la del consumidor)."""
+    listo, cuerpo = estado_salud()
+    return jsonify(cuerpo), 200 if listo else 503
+
+@app.route('/metrics')
+def metrics():
+    cuerpo, content_type = respuesta_metricas()
+    return app.response_class(cuerpo, content_type=content_type)
+
+def respuesta_streaming(upstream):
+    """Reenvía los eventos SSE de OpenRouter según llegan, sin acumularlos en memoria.
+
+    iter_content(chunk_size=None) entrega cada trozo tal como lo recibe la conexión. Si el
+    cliente se desconecta, el servidor WSGI cierra la respuesta y call_on_close libera la
+    conexión con OpenRouter.
+    """
+    def generar():
+        for chunk in upstream.iter_content(chunk_size=None):
+            if chunk:
+                yield chunk
+
+    respuesta = app.response_class(
+        generar(),
+        content_type=upstream.headers.get('Content-Type', 'text/event-stream'),
+        status=upstream.status_code
+    )
+    respuesta.headers['Cache-Control'] = 'no-cache'
+    # Evita que un proxy inverso (nginx, traefik) acumule la respuesta antes de enviarla
+    respuesta.headers['X-Accel-Buffering'] = 'no'
+    respuesta.call_on_close(upstream.close)
+    return respuesta
 
 @app.route('/api/v1/chat/completions', methods=['POST'])
 def proxy_openrouter_endpoint():
@@ -48,18 +74,21 @@ def proxy_openrouter_endpoint():
         # Llamada a la función del openrouter_client
         response_data = openrouter_client.proxy_openrouter_request(incoming_data)
 
-        if isinstance(response_data, tuple) and len(response_data) == 2 and isinstance(response_data[0], dict):
-            # Es un error formateado como (dict_error, status_code)
-            return jsonify(response_data[0]), response_data[1]
+        if isinstance(response_data, tuple) and len(response_data) in (2, 3) and isinstance(response_data[0], dict):
+            # Es un error formateado como (dict_error, status_code[, cabeceras]), p. ej. un 429 con Retry-After
+            return (jsonify(response_data[0]), *response_data[1:])
         elif isinstance(response_data, requests.Response):
-            # Es una respuesta de OpenRouter, potencialmente para streaming
-            if 'chunked' in response_data.headers.get('Transfer-Encoding', '').lower():
-                def generate():
-                    for chunk in response_data.iter_content(chunk_size=8192):
-                        yield chunk
-                return app.response_class(generate(), content_type=response_data.headers['Content-Type'], status=response_data.status_code)
-            else:
-                return jsonify(response_data.json()), response_data.status_code
+            # Es una respuesta de OpenRouter: en streaming se reenvía trozo a trozo
+            if openrouter_client.es_peticion_streaming(incoming_data):
+                return respuesta_streaming(response_data)
+            try:
+                return app.response_class(
+                    response_data.content,
+                    content_type=response_data.headers.get('Content-Type', 'application/json'),
+                    status=response_data.status_code
+                )
+            finally:
+                response_data.close()
         else:
             # Caso inesperado
             logging.error(f"Respuesta inesperada del proxy_openrouter_request: {response_data}")
@@ -72,11 +101,14 @@ def proxy_openrouter_endpoint():
 
 
 if __name__ == '__main__':
-    # Iniciar el consumidor de RabbitMQ en un hilo separado
+    # Modo desarrollo: API y consumidor en el mismo proceso. En producción la API se sirve con
+    # gunicorn (gunicorn -c gunicorn.conf.py app:app) y el consumidor corre con worker.py
+    import threading
+    import worker
     thread_consumidor = threading.Thread(
-        target=rabbitmq_client.iniciar_consumidor_ia,
+        target=worker.obtener_consumidor(),
         daemon=True
     )
     thread_consumidor.start()
     
-    app.run(host='0.0.0.0', port=5001, debug=False) # debug=False para producción 
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5001, debug=False) 
\ No newline at end of file
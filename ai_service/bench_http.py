@@ -0,0 +1,115 @@
+"""Benchmark HTTP de las APIs: peticiones por segundo y latencias con N clientes keep-alive.
+
+Uso típico contra el proxy, con un OpenRouter simulado en local (sin los presupuestos del
+planificador, que limitarían el proxy a OPENROUTER_RPM peticiones por minuto):
+    python bench_http.py stub --puerto 9000 --latencia 0.2
+    OPENROUTER_API_URL=http://127.0.0.1:9000/api/v1/chat/completions OPENROUTER_API_KEY=x \\
+        OPENROUTER_RPM=0 OPENROUTER_MAX_EN_VUELO=0 gunicorn -c gunicorn.conf.py app:app
+    python bench_http.py carga http://127.0.0.1:5001/api/v1/chat/completions \\
+        --json '{"model": "m", "messages": [{"role": "user", "content": "hola"}]}'
+
+Y contra la API del backend (servida con python api.py o con gunicorn):
+    python bench_http.py carga http://127.0.0.1:5000/formulary/1 --concurrencia 32
+"""
+import json
+import time
+import argparse
+import threading
+import http.client
+from collections import Counter
+from urllib.parse import urlsplit
+
+from loadtest_consumidor import iniciar_openrouter_simulado
+
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(len(ordenados) * p))]
+
+
+def cliente(url, cuerpo, fin, latencias, estados, lock):
+    """Bucle de un cliente: una conexión keep-alive que repite la petición hasta `fin`."""
+    partes = urlsplit(url)
+    ruta = partes.path + (f"?{partes.query}" if partes.query else "")
+    metodo = "POST" if cuerpo is not None else "GET"
+    cabeceras = {"Content-Type": "application/json"} if cuerpo is not None else {}
+    conexion = http.client.HTTPConnection(partes.hostname, partes.port or 80, timeout=30)
+    propias, estados_propios = [], Counter()
+    while time.monotonic() < fin:
+        inicio = time.perf_counter()
+        try:
+            conexion.request(metodo, ruta, body=cuerpo, headers=cabeceras)
+            respuesta = conexion.getresponse()
+            respuesta.read()
+            estados_propios[respuesta.status] += 1
+        except (OSError, http.client.HTTPException) as e:
+            estados_propios[type(e).__name__] += 1
+            conexion.close()
+            conexion = http.client.HTTPConnection(partes.hostname, partes.port or 80, timeout=30)
+            continue
+        propias.append(time.perf_counter() - inicio)
+    conexion.close()
+    with lock:
+        latencias.extend(propias)
+        estados.update(estados_propios)
+
+
+def carga(args):
+    cuerpo = json.dumps(json.loads(args.json)).encode() if args.json else None
+    latencias, estados, lock = [], Counter(), threading.Lock()
+    inicio = time.monotonic()
+    fin = inicio + args.duracion
+    hilos = [
+        threading.Thread(target=cliente, args=(args.url, cuerpo, fin, latencias, estados, lock))
+        for _ in range(args.concurrencia)
+    ]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    segundos = time.monotonic() - inicio
+
+    print(f"{args.url}  concurrencia={args.concurrencia}  duración={segundos:.1f} s")
+    print(f"  peticiones: {len(latencias)}  ->  {len(latencias) / segundos:.1f} req/s")
+    print(
+        f"  latencia: p50={percentil(latencias, 0.50) * 1000:.1f} ms  "
+        f"p90={percentil(latencias, 0.90) * 1000:.1f} ms  p99={percentil(latencias, 0.99) * 1000:.1f} ms"
+    )
+    print(f"  respuestas: {dict(estados)}")
+
+
+def stub(args):
+    servidor, url = iniciar_openrouter_simulado(args.latencia, puerto=args.puerto, host=args.host)
+    print(f"OpenRouter simulado en {url} (latencia {args.latencia} s). Ctrl+C para terminar.")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        servidor.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark HTTP de las APIs de Smart Search")
+    subparsers = parser.add_subparsers(dest="comando", required=True)
+
+    p_carga = subparsers.add_parser("carga", help="Genera carga contra una URL")
+    p_carga.add_argument("url")
+    p_carga.add_argument("--json", help="Cuerpo JSON; si se indica, la petición es POST")
+    p_carga.add_argument("--concurrencia", type=int, default=16)
+    p_carga.add_argument("--duracion", type=float, default=10)
+    p_carga.set_defaults(funcion=carga)
+
+    p_stub = subparsers.add_parser("stub", help="Levanta un OpenRouter simulado")
+    p_stub.add_argument("--puerto", type=int, default=9000)
+    p_stub.add_argument("--host", default="127.0.0.1")
+    p_stub.add_argument("--latencia", type=float, default=0.2)
+    p_stub.set_defaults(funcion=stub)
+
+    args = parser.parse_args()
+    args.funcion(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+# Configuración de gunicorn para la API del servicio de IA (app:app)
+import os
+import shutil
+import multiprocessing
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:5001")
+# El proxy pasa casi todo el tiempo esperando a OpenRouter: pocos procesos y muchos hilos
+workers = int(os.environ.get("GUNICORN_WORKERS", min(multiprocessing.cpu_count() + 1, 4)))
+threads = int(os.environ.get("GUNICORN_THREADS", 32))
+worker_class = "gthread"
+# Con gthread el timeout vigila el proceso, no cada petición: un streaming largo no lo dispara
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+accesslog = os.environ.get("GUNICORN_ACCESSLOG") or None
+errorlog = "-"
+
+# Cada worker escribe sus métricas en este directorio y /metrics las agrega (ver comun/metricas.py).
+# Se define aquí, antes de que los workers importen prometheus_client
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus_api_ia")
+
+
+def on_starting(server):
+    # Los ficheros de una ejecución anterior sumarían métricas de procesos que ya no existen
+    directorio = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(directorio, ignore_errors=True)
+    os.makedirs(directorio)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,316 @@
+import os
+import re
+import json
+import time
+import asyncio
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from comun.metricas import contar_cache
+
+# Segundos que se reutiliza una respuesta del LLM; 0 desactiva la caché
+LLM_CACHE_TTL = int(os.environ.get("LLM_CACHE_TTL", 7 * 24 * 3600))
+LLM_CACHE_MAX_ENTRADAS = int(os.environ.get("LLM_CACHE_MAX_ENTRADAS", 10000))
+# Fichero SQLite del nivel persistente; vacío para usar solo memoria
+LLM_CACHE_RUTA = os.environ.get("LLM_CACHE_RUTA", "/tmp/llm_cache.sqlite3")
+# Tamaño máximo del nivel persistente y cada cuántos segundos cada proceso lo purga
+LLM_CACHE_PERSISTENTE_MAX_ENTRADAS = int(os.environ.get("LLM_CACHE_PERSISTENTE_MAX_ENTRADAS", 100000))
+LLM_CACHE_PURGA_INTERVALO = float(os.environ.get("LLM_CACHE_PURGA_INTERVALO", 300))
+
+# Respuestas del formulario que forman el perfil; nombre, edad e IDs quedan fuera
+CAMPOS_FORMULARIO = (
+    "motivoCompra",
+    "fuenteInformacion",
+    "temasDeInteres",
+    "comprasNoNecesarias",
+    "importanciaMarca",
+    "probarNuevosProductos",
+    "aspiraciones",
+    "nivelSocial",
+    "tiempoLibre",
+    "identidad",
+    "tendencias",
+)
+
+
+def _normalizar(valor):
+    if valor is None:
+        return ""
+    return re.sub(r"\s+", " ", str(valor)).strip().lower()
+
+
+def perfil_canonico(data_usuario):
+    """Reduce el mensaje de peticiones_ia a lo que determina las búsquedas: respuestas y comentario.
+
+    Dos usuarios con las mismas respuestas (sin distinguir mayúsculas ni espacios) producen el
+    mismo perfil, y por tanto el mismo prompt y la misma clave de caché.
+    """
+    formulario = data_usuario.get("formulario") or {}
+    return {
+        "formulario": {campo: _normalizar(formulario.get(campo)) for campo in CAMPOS_FORMULARIO},
+        "comentarioSolicitud": _normalizar(data_usuario.get("comentarioSolicitud")),
+    }
+
+
+def clave_prompt(prompt, modelo):
+    """Clave de caché de un prompt: cambia si cambia el perfil, la plantilla o el modelo."""
+    return hashlib.sha256(f"{modelo}\x1f{prompt}".encode("utf-8")).hexdigest()
+
+
+def es_lista_busquedas(contenido):
+    """Solo se cachean respuestas que el consumidor aceptaría: un array JSON."""
+    try:
+        return isinstance(json.loads(contenido), list)
+    except (TypeError, ValueError):
+        return False
+
+
+class AlmacenSQLite:
+    """Nivel persistente: sobrevive a reinicios y se puede compartir entre procesos del mismo host.
+
+    Al abrirlo y, después, cada `intervalo_purga` segundos desde la siguiente escritura, borra
+    las respuestas caducadas y, si quedan más de `max_entradas`, las que caducan antes.
+    """
+
+    def __init__(self, ruta, ttl, max_entradas=LLM_CACHE_PERSISTENTE_MAX_ENTRADAS,
+                 intervalo_purga=LLM_CACHE_PURGA_INTERVALO):
+        self.ttl = ttl
+        self.max_entradas = max_entradas
+        self.intervalo_purga = intervalo_purga
+        directorio = os.path.dirname(ruta)
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conexion = sqlite3.connect(ruta, timeout=5, check_same_thread=False)
+        with self._lock, self._conexion:
+            self._conexion.execute("PRAGMA journal_mode=WAL")
+            self._conexion.execute(
+                "CREATE TABLE IF NOT EXISTS respuestas_llm ("
+                "clave TEXT PRIMARY KEY, valor TEXT NOT NULL, expira_en REAL NOT NULL)"
+            )
+            self._conexion.execute(
+                "CREATE INDEX IF NOT EXISTS respuestas_llm_expira_en ON respuestas_llm (expira_en)"
+            )
+        self._proxima_purga = 0.0
+        self._purgar_si_toca()
+
+    def _purgar_si_toca(self):
+        with self._lock:
+            ahora = time.monotonic()
+            if ahora < self._proxima_purga:
+                return
+            self._proxima_purga = ahora + self.intervalo_purga
+        self.purgar()
+
+    def purgar(self):
+        try:
+            with self._lock, self._conexion:
+                caducadas = self._conexion.execute(
+                    "DELETE FROM respuestas_llm WHERE expira_en < ?", (time.time(),)
+                ).rowcount
+                # Todas tienen el mismo TTL: las que caducan antes son las escritas hace más tiempo
+                sobrantes = self._conexion.execute(
+                    "DELETE FROM respuestas_llm WHERE clave IN ("
+                    "SELECT clave FROM respuestas_llm ORDER BY expira_en DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entradas,),
+                ).rowcount
+            if caducadas or sobrantes:
+                logging.info(
+                    f"Purga de la caché persistente del LLM: {caducadas} caducadas y {sobrantes} sobrantes borradas"
+                )
+        except sqlite3.Error as e:
+            logging.warning(f"Error purgando la caché persistente del LLM: {e}")
+
+    def obtener(self, clave):
+        try:
+            with self._lock:
+                fila = self._conexion.execute(
+                    "SELECT valor FROM respuestas_llm WHERE clave = ? AND expira_en > ?",
+                    (clave, time.time()),
+                ).fetchone()
+            return fila[0] if fila else None
+        except sqlite3.Error as e:
+            logging.warning(f"Error leyendo la caché persistente del LLM: {e}")
+            return None
+
+    def guardar(self, clave, valor):
+        try:
+            with self._lock, self._conexion:
+                self._conexion.execute(
+                    "INSERT OR REPLACE INTO respuestas_llm (clave, valor, expira_en) VALUES (?, ?, ?)",
+                    (clave, valor, time.time() + self.ttl),
+                )
+        except sqlite3.Error as e:
+            logging.warning(f"Error escribiendo la caché persistente del LLM: {e}")
+            return
+        self._purgar_si_toca()
+
+
+class _Vuelo:
+    """Llamada al LLM en curso para una clave; los demás hilos con la misma clave la esperan."""
+
+    def __init__(self):
+        self.terminado = threading.Event()
+        self.resultado = None
+        self.error = None
+
+
+class CacheLLM:
+    """Caché de respuestas del LLM: memoria (TTL + LRU), SQLite persistente y coalescencia.
+
+    obtener_o_calcular garantiza que, para una misma clave, solo un hilo (o una corrutina)
+    llama al LLM a la vez; el resto recibe el mismo resultado o la misma excepción.
+    """
+
+    def __init__(self, ttl=LLM_CACHE_TTL, max_entradas=LLM_CACHE_MAX_ENTRADAS, ruta=LLM_CACHE_RUTA):
+        self.habilitada = ttl > 0
+        self.ttl = ttl
+        self.max_entradas = max_entradas
+        self._memoria = OrderedDict()
+        self._lock = threading.Lock()
+        self._vuelos = {}
+        self._vuelos_async = {}
+        self._contadores = {"aciertos_memoria": 0, "aciertos_persistente": 0, "coalescidas": 0, "fallos": 0}
+        self.persistente = None
+        if self.habilitada and ruta:
+            try:
+                self.persistente = AlmacenSQLite(ruta, ttl)
+            except (OSError, sqlite3.Error) as e:
+                logging.warning(f"No se pudo abrir la caché persistente del LLM en {ruta}: {e}. Se usa solo memoria.")
+
+    def _obtener_memoria(self, clave):
+        with self._lock:
+            entrada = self._memoria.get(clave)
+            if entrada is None:
+                return None
+            expira_en, valor = entrada
+            if expira_en < time.monotonic():
+                del self._memoria[clave]
+                return None
+            self._memoria.move_to_end(clave)
+            self._contadores["aciertos_memoria"] += 1
+        contar_cache("llm", "aciertos_memoria")
+        return valor
+
+    def _guardar_memoria(self, clave, valor):
+        with self._lock:
+            self._memoria[clave] = (time.monotonic() + self.ttl, valor)
+            self._memoria.move_to_end(clave)
+            while len(self._memoria) > self.max_entradas:
+                self._memoria.popitem(last=False)
+
+    def _contar(self, contador):
+        with self._lock:
+            self._contadores[contador] += 1
+        contar_cache("llm", contador)
+
+    def _obtener_persistente(self, clave):
+        if self.persistente is None:
+            return None
+        valor = self.persistente.obtener(clave)
+        if valor is not None:
+            self._guardar_memoria(clave, valor)
+            self._contar("aciertos_persistente")
+        return valor
+
+    def _guardar(self, clave, valor, es_valido):
+        if valor and (es_valido is None or es_valido(valor)):
+            self._guardar_memoria(clave, valor)
+            if self.persistente is not None:
+                self.persistente.guardar(clave, valor)
+
+    def obtener_o_calcular(self, clave, calcular, es_valido=None):
+        """Devuelve la respuesta cacheada o la calcula con `calcular()` una sola vez por clave."""
+        if not self.habilitada:
+            return calcular()
+        valor = self._obtener_memoria(clave)
+        if valor is not None:
+            return valor
+
+        with self._lock:
+            vuelo = self._vuelos.get(clave)
+            lider = vuelo is None
+            if lider:
+                vuelo = self._vuelos[clave] = _Vuelo()
+        if not lider:
+            self._contar("coalescidas")
+            vuelo.terminado.wait()
+            if vuelo.error is not None:
+                raise vuelo.error
+            return vuelo.resultado
+
+        try:
+            valor = self._obtener_persistente(clave)
+            if valor is None:
+                self._contar("fallos")
+                valor = calcular()
+                self._guardar(clave, valor, es_valido)
+            vuelo.resultado = valor
+            return valor
+        except Exception as e:
+            vuelo.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._vuelos[clave]
+            vuelo.terminado.set()
+
+    async def obtener_o_calcular_async(self, clave, calcular, es_valido=None):
+        """Versión para el runtime asyncio: `calcular` es una función que devuelve una corrutina."""
+        if not self.habilitada:
+            return await calcular()
+        valor = self._obtener_memoria(clave)
+        if valor is not None:
+            return valor
+
+        futuro = self._vuelos_async.get(clave)
+        if futuro is not None:
+            self._contar("coalescidas")
+            # shield: si se cancela quien espera, la llamada del líder sigue su curso
+            return await asyncio.shield(futuro)
+
+        futuro = asyncio.get_running_loop().create_future()
+        self._vuelos_async[clave] = futuro
+        try:
+            valor = await asyncio.to_thread(self._obtener_persistente, clave)
+            if valor is None:
+                self._contar("fallos")
+                valor = await calcular()
+                await asyncio.to_thread(self._guardar, clave, valor, es_valido)
+            futuro.set_result(valor)
+            return valor
+        except Exception as e:
+            futuro.set_exception(e)
+            # Evita el aviso de excepción no recuperada cuando nadie más esperaba
+            futuro.exception()
+            raise
+        finally:
+            if not futuro.done():
+                futuro.cancel()
+            del self._vuelos_async[clave]
+
+    def estadisticas(self):
+        """Contadores de aciertos, fallos y llamadas ahorradas por coalescencia."""
+        with self._lock:
+            stats = dict(self._contadores)
+            stats["entradas_memoria"] = len(self._memoria)
+        total = stats["aciertos_memoria"] + stats["aciertos_persistente"] + stats["coalescidas"] + stats["fallos"]
+        stats["ratio_aciertos"] = (total - stats["fallos"]) / total if total else 0.0
+        return stats
+
+
+_cache_llm = None
+_cache_llm_lock = threading.Lock()
+
+
+def obtener_cache_llm():
+    """Devuelve la caché del LLM del proceso, creándola la primera vez."""
+    global _cache_llm
+    if _cache_llm is None:
+        with _cache_llm_lock:
+            if _cache_llm is None:
+                _cache_llm = CacheLLM()
+    return _cache_llm
@@ -0,0 +1,255 @@
+"""Planificador de las llamadas a OpenRouter: concurrencia, presupuestos por minuto y Retry-After.
+
+Cada llamada pide un turno al planificador del proceso antes de salir:
+
+- reserva una petición del presupuesto por minuto de peticiones y los tokens estimados del de
+  tokens (cubos que se rellenan de forma continua a lo largo del minuto). Son la parte del
+  proceso de OPENROUTER_RPM y OPENROUTER_TPM, repartidos entre los OPENROUTER_PROCESOS
+  procesos que llaman con la misma clave;
+- espera lo que falte para tener presupuesto, y además la pausa que impuso el último 429/503
+  con su Retry-After;
+- ocupa una de las OPENROUTER_MAX_EN_VUELO plazas de llamadas simultáneas.
+
+Si la espera supera OPENROUTER_ESPERA_MAXIMA no se espera: se lanza LimiteOpenRouter con los
+segundos que faltan, y el consumidor reprograma el mensaje en una cola de reintentos en lugar
+de reencolarlo al instante. Así el proceso se mantiene en el límite del proveedor sin
+bombardearlo con peticiones que va a rechazar.
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+import weakref
+from contextlib import contextmanager, asynccontextmanager, nullcontext
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from comun.limitacion import CODIGOS_LIMITACION, segundos_retry_after
+
+# Llamadas simultáneas a OpenRouter por proceso; 0 sin límite
+OPENROUTER_MAX_EN_VUELO = int(os.getenv("OPENROUTER_MAX_EN_VUELO", 20))
+# Presupuestos por minuto de la clave de OpenRouter; 0 los desactiva. Los modelos :free admiten 20 peticiones/min
+OPENROUTER_RPM = float(os.getenv("OPENROUTER_RPM", 20))
+OPENROUTER_TPM = float(os.getenv("OPENROUTER_TPM", 0))
+# Procesos que llaman con la misma clave (workers de gunicorn de la API más procesos de ai_worker).
+# Cada uno lleva su propio presupuesto con una parte igual de OPENROUTER_RPM y OPENROUTER_TPM
+OPENROUTER_PROCESOS = max(1, int(os.getenv("OPENROUTER_PROCESOS", 1)))
+# Tokens de respuesta que se reservan por llamada cuando el payload no fija max_tokens
+OPENROUTER_TOKENS_RESPUESTA = int(os.getenv("OPENROUTER_TOKENS_RESPUESTA", 1000))
+# Espera máxima por un turno; si hace falta más, la llamada se reprograma en la cola de reintentos
+OPENROUTER_ESPERA_MAXIMA = float(os.getenv("OPENROUTER_ESPERA_MAXIMA", 30))
+# Pausa tras un 429/503 sin Retry-After, y tope del que indique el proveedor
+OPENROUTER_PAUSA_LIMITE = float(os.getenv("OPENROUTER_PAUSA_LIMITE", 10))
+OPENROUTER_RETRY_AFTER_MAX = float(os.getenv("OPENROUTER_RETRY_AFTER_MAX", 600))
+
+LLAMADAS_EN_VUELO = Gauge(
+    "openrouter_llamadas_en_vuelo", "Llamadas a OpenRouter en curso con turno del planificador",
+    multiprocess_mode="livesum"
+)
+ESPERA_TURNO = Histogram(
+    "openrouter_espera_turno_segundos", "Tiempo que una llamada espera presupuesto en el planificador antes de salir",
+    buckets=(0.01, 0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+)
+LIMITACIONES = Counter(
+    "openrouter_limitaciones_total", "Llamadas limitadas: respuestas 429/503 del proveedor o turnos rechazados "
+    "por superar la espera máxima (espera_excedida)",
+    ["motivo"]
+)
+
+
+class LimiteOpenRouter(Exception):
+    """No hay presupuesto para llamar a OpenRouter en un plazo razonable. `espera` son los segundos que faltan."""
+
+    def __init__(self, mensaje, espera):
+        super().__init__(mensaje)
+        self.espera = espera
+
+
+def estimar_tokens(payload):
+    """Tokens que consumirá la llamada: unos 4 caracteres por token del prompt más la respuesta esperada."""
+    prompt = json.dumps(payload.get("messages", []), ensure_ascii=False)
+    return len(prompt) // 4 + int(payload.get("max_tokens") or OPENROUTER_TOKENS_RESPUESTA)
+
+
+class PresupuestoMinuto:
+    """Cubo de tokens con capacidad `por_minuto` que se rellena de forma continua. No es seguro entre hilos."""
+
+    def __init__(self, por_minuto):
+        self.capacidad = por_minuto
+        self.tasa = por_minuto / 60
+        self._disponible = por_minuto
+        self._actualizado = time.monotonic()
+
+    def espera(self, cantidad, ahora):
+        """Segundos hasta que haya `cantidad` disponible (una reserva mayor que la capacidad espera al cubo lleno)."""
+        self._disponible = min(self.capacidad, self._disponible + (ahora - self._actualizado) * self.tasa)
+        self._actualizado = ahora
+        return max(0.0, (min(cantidad, self.capacidad) - self._disponible) / self.tasa)
+
+    def consumir(self, cantidad):
+        # Puede quedar en negativo: quien reserva después espera también lo que se adelantó
+        self._disponible -= cantidad
+
+    def devolver(self, cantidad):
+        self._disponible = min(self.capacidad, self._disponible + cantidad)
+
+
+class TurnoLLM:
+    """Turno concedido a una llamada: recibe su respuesta para ajustar el planificador."""
+
+    def __init__(self, planificador, tokens):
+        self._planificador = planificador
+        self.tokens = tokens
+
+    def registrar_respuesta(self, codigo, cabeceras):
+        """Anota el código de la respuesta. Con 429/503 pausa el planificador y lanza LimiteOpenRouter."""
+        if codigo in CODIGOS_LIMITACION:
+            retry_after = segundos_retry_after(cabeceras.get("Retry-After"), OPENROUTER_RETRY_AFTER_MAX)
+            espera = self._planificador.pausar(codigo, retry_after)
+            raise LimiteOpenRouter(f"OpenRouter respondió {codigo}", espera)
+
+    def registrar_uso(self, response_json):
+        """Corrige el presupuesto de tokens con el uso real que devuelve OpenRouter, si lo incluye."""
+        reales = (response_json.get("usage") or {}).get("total_tokens")
+        if reales:
+            self._planificador.ajustar_tokens(self.tokens, reales)
+
+
+class PlanificadorLLM:
+    """Reparte los turnos de llamada a OpenRouter de un proceso. Seguro entre hilos.
+
+    turno() es para el consumidor bloqueante y turno_async() para el de asyncio; ambos
+    comparten los presupuestos y la pausa, así que pueden convivir en el mismo proceso.
+    `rpm` y `tpm` son los presupuestos de este proceso, no los de la clave.
+    """
+
+    def __init__(self, max_en_vuelo=OPENROUTER_MAX_EN_VUELO, rpm=OPENROUTER_RPM / OPENROUTER_PROCESOS,
+                 tpm=OPENROUTER_TPM / OPENROUTER_PROCESOS, espera_maxima=OPENROUTER_ESPERA_MAXIMA):
+        self.max_en_vuelo = max_en_vuelo
+        self.espera_maxima = espera_maxima
+        self._peticiones = PresupuestoMinuto(rpm) if rpm > 0 else None
+        self._tokens = PresupuestoMinuto(tpm) if tpm > 0 else None
+        self._pausado_hasta = 0.0
+        self._lock = threading.Lock()
+        self._en_vuelo = threading.BoundedSemaphore(max_en_vuelo) if max_en_vuelo > 0 else None
+        # Un asyncio.Semaphore pertenece a su event loop: uno por loop que pida turnos
+        self._en_vuelo_async = weakref.WeakKeyDictionary()
+
+    def _reservar(self, tokens):
+        """Reserva una petición y `tokens` de los presupuestos. Devuelve los segundos que hay que esperar."""
+        with self._lock:
+            ahora = time.monotonic()
+            espera = max(0.0, self._pausado_hasta - ahora)
+            if self._peticiones is not None:
+                espera = max(espera, self._peticiones.espera(1, ahora))
+            if self._tokens is not None:
+                espera = max(espera, self._tokens.espera(tokens, ahora))
+            if espera > self.espera_maxima:
+                LIMITACIONES.labels("espera_excedida").inc()
+                raise LimiteOpenRouter(f"Sin presupuesto de OpenRouter durante {espera:.1f} s", espera)
+            if self._peticiones is not None:
+                self._peticiones.consumir(1)
+            if self._tokens is not None:
+                self._tokens.consumir(tokens)
+        return espera
+
+    def _devolver(self, tokens):
+        """Devuelve a los presupuestos la reserva de una llamada que al final no sale."""
+        with self._lock:
+            if self._peticiones is not None:
+                self._peticiones.devolver(1)
+            if self._tokens is not None:
+                self._tokens.devolver(tokens)
+
+    def _pausa_pendiente(self):
+        """Segundos de pausa que quedan (un 429 pudo llegar mientras se esperaba). Lanza LimiteOpenRouter si es demasiada."""
+        with self._lock:
+            espera = max(0.0, self._pausado_hasta - time.monotonic())
+        if espera > self.espera_maxima:
+            LIMITACIONES.labels("espera_excedida").inc()
+            raise LimiteOpenRouter(f"OpenRouter en pausa durante {espera:.1f} s", espera)
+        return espera
+
+    def pausar(self, codigo, retry_after=None):
+        """Detiene las llamadas tras un 429/503 durante `retry_after` (o OPENROUTER_PAUSA_LIMITE). Devuelve la pausa."""
+        espera = OPENROUTER_PAUSA_LIMITE if retry_after is None else retry_after
+        with self._lock:
+            self._pausado_hasta = max(self._pausado_hasta, time.monotonic() + espera)
+        LIMITACIONES.labels(str(codigo)).inc()
+        logging.warning(f"OpenRouter respondió {codigo}; llamadas en pausa durante {espera:.1f} s")
+        return espera
+
+    def ajustar_tokens(self, estimados, reales):
+        if self._tokens is not None:
+            with self._lock:
+                self._tokens.devolver(estimados - reales)
+
+    @contextmanager
+    def turno(self, tokens):
+        inicio = time.perf_counter()
+        espera = self._reservar(tokens)
+        try:
+            while espera > 0:
+                time.sleep(espera)
+                espera = self._pausa_pendiente()
+        except BaseException:
+            # Pausa demasiado larga (LimiteOpenRouter) o espera interrumpida: la reserva no se usa
+            self._devolver(tokens)
+            raise
+        with self._en_vuelo or nullcontext():
+            ESPERA_TURNO.observe(time.perf_counter() - inicio)
+            LLAMADAS_EN_VUELO.inc()
+            try:
+                yield TurnoLLM(self, tokens)
+            finally:
+                LLAMADAS_EN_VUELO.dec()
+
+    @asynccontextmanager
+    async def turno_async(self, tokens):
+        inicio = time.perf_counter()
+        espera = self._reservar(tokens)
+        try:
+            while espera > 0:
+                await asyncio.sleep(espera)
+                espera = self._pausa_pendiente()
+        except BaseException:
+            # Pausa demasiado larga (LimiteOpenRouter) o tarea cancelada: la reserva no se usa
+            self._devolver(tokens)
+            raise
+        async with self._semaforo_async():
+            ESPERA_TURNO.observe(time.perf_counter() - inicio)
+            LLAMADAS_EN_VUELO.inc()
+            try:
+                yield TurnoLLM(self, tokens)
+            finally:
+                LLAMADAS_EN_VUELO.dec()
+
+    def _semaforo_async(self):
+        if self.max_en_vuelo <= 0:
+            return nullcontext()
+        loop = asyncio.get_running_loop()
+        semaforo = self._en_vuelo_async.get(loop)
+        if semaforo is None:
+            semaforo = self._en_vuelo_async[loop] = asyncio.Semaphore(self.max_en_vuelo)
+        return semaforo
+
+
+_planificador = None
+_planificador_lock = threading.Lock()
+
+
+def obtener_planificador_llm():
+    """Devuelve el planificador de llamadas a OpenRouter del proceso, creándolo la primera vez."""
+    global _planificador
+    if _planificador is None:
+        with _planificador_lock:
+            if _planificador is None:
+                _planificador = PlanificadorLLM()
+                logging.info(
+                    f"Planificador de OpenRouter inicializado (máx. en vuelo: {OPENROUTER_MAX_EN_VUELO}, "
+                    f"RPM: {OPENROUTER_RPM / OPENROUTER_PROCESOS:g}, TPM: {OPENROUTER_TPM / OPENROUTER_PROCESOS:g} "
+                    f"de este proceso, 1/{OPENROUTER_PROCESOS} de los de la clave; 0 = sin límite)"
+                )
+    return _planificador
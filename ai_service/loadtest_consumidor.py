@@ -0,0 +1,197 @@
+"""Prueba de carga del consumidor de IA: runtime bloqueante (pika) frente a asyncio (aio-pika).
+
+Levanta un OpenRouter simulado en local con una latencia fija, publica N peticiones en
+una cola de pruebas y mide cuántos mensajes por segundo llegan a la cola del scraper con
+cada runtime. Necesita un RabbitMQ accesible (RABBITMQ_HOST, etc.); las colas de
+producción no se tocan.
+
+Uso:
+    python loadtest_consumidor.py --mensajes 500 --latencia 2.0 --workers 8
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+COLA_ENTRADA = "loadtest_peticiones_ia"
+COLA_SALIDA = "loadtest_scrapper_peticiones"
+
+RESPUESTA_SIMULADA = json.dumps(
+    {"choices": [{"message": {"content": '["cámara nikon", "sony alpha 7"]'}}]}
+).encode()
+
+
+def iniciar_openrouter_simulado(latencia, puerto=0, host="127.0.0.1"):
+    """Servidor HTTP que responde como OpenRouter tras `latencia` segundos. Devuelve (servidor, url).
+
+    Con `"stream": true` en el cuerpo responde con eventos SSE en chunked, como OpenRouter.
+    """
+
+    class Manejador(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Sin Nagle: los trozos SSE pequeños no esperan al ACK retardado del cliente
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            cuerpo = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                streaming = json.loads(cuerpo or b"{}").get("stream") is True
+            except ValueError:
+                streaming = False
+            time.sleep(latencia)
+            if streaming:
+                self._responder_sse()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(RESPUESTA_SIMULADA)))
+            self.end_headers()
+            self.wfile.write(RESPUESTA_SIMULADA)
+
+        def _responder_sse(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            eventos = [
+                json.dumps({"choices": [{"delta": {"content": parte}}]})
+                for parte in ('["cámara nikon", ', '"sony alpha 7"]')
+            ]
+            for evento in eventos + ["[DONE]"]:
+                datos = f"data: {evento}\n\n".encode()
+                self.wfile.write(f"{len(datos):X}\r\n".encode() + datos + b"\r\n")
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+
+        def log_message(self, *args):
+            pass
+
+    servidor = ThreadingHTTPServer((host, puerto), Manejador)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor, f"http://{host}:{servidor.server_port}/api/v1/chat/completions"
+
+
+def preparar_colas(consumidor, mensajes):
+    """Vacía las colas de prueba y publica `mensajes` peticiones de IA."""
+    conexion = consumidor.conectar_a_rabbitmq()
+    if not conexion:
+        sys.exit("No se pudo conectar a RabbitMQ")
+    canal = conexion.channel()
+    for cola in (COLA_ENTRADA, COLA_SALIDA):
+        canal.queue_declare(queue=cola, durable=True)
+        canal.queue_purge(queue=cola)
+    for i in range(mensajes):
+        cuerpo = {"usuario": {"id": i + 1}, "formulario": {"intereses": "fotografía"}}
+        canal.basic_publish(exchange="", routing_key=COLA_ENTRADA, body=json.dumps(cuerpo))
+    conexion.close()
+
+
+def esperar_salida(consumidor, mensajes, timeout):
+    """Espera a que la cola de salida tenga `mensajes` mensajes. Devuelve los que llegaron."""
+    conexion = consumidor.conectar_a_rabbitmq()
+    canal = conexion.channel()
+    limite = time.monotonic() + timeout
+    recibidos = 0
+    while time.monotonic() < limite:
+        recibidos = canal.queue_declare(queue=COLA_SALIDA, durable=True, passive=True).method.message_count
+        if recibidos >= mensajes:
+            break
+        time.sleep(0.1)
+    conexion.close()
+    return recibidos
+
+
+def ejecutar_bloqueante(rabbitmq_client, workers):
+    """Arranca el consumidor de pika en un hilo. Devuelve la función que lo detiene."""
+    consumidor = rabbitmq_client.ConsumidorConcurrente(
+        COLA_ENTRADA,
+        rabbitmq_client.procesar_peticion_ia_callback,
+        workers=workers,
+        colas_adicionales=rabbitmq_client.colas_reintento(),
+    )
+    hilo = threading.Thread(target=consumidor.ejecutar, daemon=True)
+    hilo.start()
+
+    def detener():
+        consumidor.detener()
+        hilo.join()
+
+    return detener
+
+
+def ejecutar_asyncio(rabbitmq_client_async):
+    """Arranca el consumidor aio-pika en su propio event loop. Devuelve la función que lo detiene."""
+    loop = asyncio.new_event_loop()
+    detener_evento = asyncio.Event()
+    hilo = threading.Thread(
+        target=loop.run_until_complete,
+        args=(rabbitmq_client_async.consumir_peticiones_ia(detener_evento),),
+        daemon=True,
+    )
+    hilo.start()
+
+    def detener():
+        loop.call_soon_threadsafe(detener_evento.set)
+        hilo.join()
+        loop.close()
+
+    return detener
+
+
+def medir(nombre, arrancar, consumidor, mensajes, timeout):
+    preparar_colas(consumidor, mensajes)
+    inicio = time.perf_counter()
+    detener = arrancar()
+    recibidos = esperar_salida(consumidor, mensajes, timeout)
+    segundos = time.perf_counter() - inicio
+    detener()
+    print(
+        f"{nombre:<10} {recibidos}/{mensajes} mensajes en {segundos:7.2f} s  ->  {recibidos / segundos:8.1f} msg/s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compara el throughput de los runtimes del consumidor de IA")
+    parser.add_argument("--mensajes", type=int, default=200)
+    parser.add_argument("--latencia", type=float, default=1.0, help="Segundos que tarda el OpenRouter simulado")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("CONSUMIDOR_WORKERS", 4)),
+                        help="Hilos del consumidor bloqueante")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--runtime", choices=("ambos", "blocking", "asyncio"), default="ambos")
+    args = parser.parse_args()
+
+    servidor, url = iniciar_openrouter_simulado(args.latencia)
+    # La configuración se lee al importar los módulos: fijarla antes
+    os.environ["OPENROUTER_API_URL"] = url
+    os.environ.setdefault("OPENROUTER_API_KEY", "loadtest")
+    os.environ["QUEUE_PETICIONES_IA"] = COLA_ENTRADA
+    os.environ["SCRAPPER_PETICIONES_QUEUE"] = COLA_SALIDA
+    # Todos los mensajes tienen el mismo perfil: sin desactivar la caché se mediría la caché
+    os.environ["LLM_CACHE_TTL"] = "0"
+    # Se mide el consumidor, no el planificador: sin presupuestos por minuto ni límite de llamadas
+    os.environ.setdefault("OPENROUTER_RPM", "0")
+    os.environ.setdefault("OPENROUTER_TPM", "0")
+    os.environ.setdefault("OPENROUTER_MAX_EN_VUELO", "0")
+
+    import rabbitmq_client
+    from comun import consumidor
+
+    print(f"OpenRouter simulado en {url} (latencia {args.latencia} s)")
+    if args.runtime in ("ambos", "blocking"):
+        medir(f"blocking/{args.workers}", lambda: ejecutar_bloqueante(rabbitmq_client, args.workers),
+              consumidor, args.mensajes, args.timeout)
+    if args.runtime in ("ambos", "asyncio"):
+        import rabbitmq_client_async
+
+        medir("asyncio", lambda: ejecutar_asyncio(rabbitmq_client_async),
+              consumidor, args.mensajes, args.timeout)
+    servidor.shutdown()
+
+
+if __name__ == "__main__":
+    main()
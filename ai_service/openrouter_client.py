@@ -3,17 +3,64 @@ import requests
 import json
 import logging
 import re  # Importamos re para usar expresiones regulares
+import math
+import time
+import threading
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+
+from comun.metricas import observar_http
+from llm_planificador import LimiteOpenRouter, estimar_tokens, obtener_planificador_llm
 
 # Configuración de logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
-OPENROUTER_API_URL = "https://openrouter.ai/api/v1/chat/completions"
+OPENROUTER_API_URL = os.getenv("OPENROUTER_API_URL", "https://openrouter.ai/api/v1/chat/completions")
+OPENROUTER_HOST = urlsplit(OPENROUTER_API_URL).netloc
 YOUR_SITE_URL = os.getenv("YOUR_SITE_URL", "http://localhost:5173")
 YOUR_SITE_NAME = os.getenv("YOUR_SITE_NAME", "Smart Search")
 
 DEFAULT_MODEL = "deepseek/deepseek-r1-zero:free"
 
+# Cliente compartido hacia OpenRouter: conexiones keep-alive reutilizadas entre peticiones
+OPENROUTER_POOL = int(os.getenv("OPENROUTER_POOL", 20))
+OPENROUTER_TIMEOUT_CONEXION = float(os.getenv("OPENROUTER_TIMEOUT_CONEXION", 5))
+# En streaming es el tiempo máximo entre dos trozos, no la duración total de la respuesta
+OPENROUTER_TIMEOUT_LECTURA = float(os.getenv("OPENROUTER_TIMEOUT_LECTURA", 60))
+OPENROUTER_TIMEOUT = (OPENROUTER_TIMEOUT_CONEXION, OPENROUTER_TIMEOUT_LECTURA)
+
+_sesion = None
+_sesion_lock = threading.Lock()
+
+def obtener_sesion():
+    """Devuelve la sesión HTTP compartida del proceso, con un pool de conexiones hacia OpenRouter."""
+    global _sesion
+    if _sesion is None:
+        with _sesion_lock:
+            if _sesion is None:
+                sesion = requests.Session()
+                # pool_block: con el pool lleno se espera a una conexión libre en vez de abrir otra sin keep-alive
+                adaptador = HTTPAdapter(pool_connections=1, pool_maxsize=OPENROUTER_POOL, pool_block=True)
+                sesion.mount("https://", adaptador)
+                sesion.mount("http://", adaptador)
+                _sesion = sesion
+    return _sesion
+
+def publicar_en_openrouter(**kwargs):
+    """POST a OpenRouter con la sesión compartida, registrando latencia y código de respuesta.
+
+    En streaming la latencia registrada es la de la cabecera de la respuesta, no la del cuerpo.
+    """
+    inicio = time.perf_counter()
+    try:
+        response = obtener_sesion().post(OPENROUTER_API_URL, **kwargs)
+    except requests.exceptions.RequestException:
+        observar_http(OPENROUTER_HOST, "error", time.perf_counter() - inicio)
+        raise
+    observar_http(OPENROUTER_HOST, response.status_code, time.perf_counter() - inicio)
+    return response
+
 def get_openrouter_headers():
     if not OPENROUTER_API_KEY:
         logging.error("OPENROUTER_API_KEY no está configurada.")
@@ -25,73 +72,91 @@ def get_openrouter_headers():
         "X-Title": YOUR_SITE_NAME,
     }
 
+def construir_payload_prompt(prompt: str):
+    """Construye el cuerpo de la petición a OpenRouter para un prompt de generación de búsquedas."""
+    return {
+        "model": DEFAULT_MODEL,
+        "messages": [
+            {"role": "user", "content": prompt}
+        ],
+        # "temperature": 0.7, # Opcional
+        # "max_tokens": 150,  # Opcional
+    }
+
+def extraer_contenido_busquedas(response_json: dict):
+    """Extrae de la respuesta de OpenRouter el array JSON de búsquedas (como texto)."""
+    ia_message_content_str = response_json.get('choices', [{}])[0].get('message', {}).get('content')
+    if not ia_message_content_str:
+        logging.warning("No se encontró contenido en la respuesta de la IA o formato inesperado.")
+        return None
+        
+    # Limpiar la respuesta para extraer solo el contenido JSON
+    logging.info(f"Contenido original recibido de IA: {ia_message_content_str}")
+    
+    # Buscar patrones de array JSON dentro de posibles formatos como \boxed{[...]} o ```json[...]```
+    json_array_pattern = r'\[(.*?)\]'
+    boxed_pattern = r'\\boxed\{(.*?)\}'
+    code_block_pattern = r'```(?:json)?\s*(\[.*?\])\s*```'
+    
+    # Intentar primero con \boxed{...}
+    boxed_match = re.search(boxed_pattern, ia_message_content_str, re.DOTALL)
+    if boxed_match:
+        json_content = boxed_match.group(1)
+        logging.info(f"Contenido extraído del patrón boxed: {json_content}")
+        # Verificar si lo que hay dentro es un array JSON
+        if json_content.strip().startswith('[') and json_content.strip().endswith(']'):
+            return json_content
+    
+    # Intentar con bloques de código
+    code_match = re.search(code_block_pattern, ia_message_content_str, re.DOTALL)
+    if code_match:
+        json_content = code_match.group(1)
+        logging.info(f"Contenido extraído del bloque de código: {json_content}")
+        return json_content
+    
+    # Si no se encontró en patrones específicos, buscar cualquier array JSON en el texto
+    json_match = re.search(json_array_pattern, ia_message_content_str, re.DOTALL)
+    if json_match:
+        json_array_text = f"[{json_match.group(1)}]"
+        logging.info(f"Contenido extraído como array JSON: {json_array_text}")
+        
+        # Verificar que sea un JSON válido intentando parsearlo
+        try:
+            json.loads(json_array_text)
+            return json_array_text
+        except json.JSONDecodeError as e:
+            logging.warning(f"El contenido extraído no es un JSON válido: {json_array_text}. Error: {e}")
+    
+    # Si no encontramos un patrón reconocible o JSON válido, devolver el contenido original
+    logging.warning("No se pudo extraer un array JSON válido, devolviendo contenido original")
+    return ia_message_content_str
+
 def call_openrouter_api_for_prompt(prompt: str):
-    """Llama a la API de OpenRouter con un prompt específico para la generación de búsquedas."""
+    """Llama a la API de OpenRouter con un prompt específico para la generación de búsquedas.
+
+    La llamada espera su turno en el planificador (concurrencia, peticiones y tokens por minuto);
+    lanza LimiteOpenRouter si no hay presupuesto pronto o si OpenRouter responde 429/503.
+    """
     try:
         headers = get_openrouter_headers()
-        payload = {
-            "model": DEFAULT_MODEL,
-            "messages": [
-                {"role": "user", "content": prompt}
-            ],
-            # "temperature": 0.7, # Opcional
-            # "max_tokens": 150,  # Opcional
-        }
+        payload = construir_payload_prompt(prompt)
         
         logging.debug(f"Enviando petición a OpenRouter (prompt): {json.dumps(payload)}")
-        response = requests.post(OPENROUTER_API_URL, headers=headers, data=json.dumps(payload), timeout=60)
-        response.raise_for_status()
-        response_json = response.json()
+        with obtener_planificador_llm().turno(estimar_tokens(payload)) as turno:
+            with publicar_en_openrouter(headers=headers, data=json.dumps(payload), timeout=OPENROUTER_TIMEOUT) as response:
+                turno.registrar_respuesta(response.status_code, response.headers)
+                response.raise_for_status()
+                response_json = response.json()
+            turno.registrar_uso(response_json)
         logging.debug(f"Respuesta recibida de OpenRouter (prompt): {response_json}")
         
-        ia_message_content_str = response_json.get('choices', [{}])[0].get('message', {}).get('content')
-        if not ia_message_content_str:
-            logging.warning("No se encontró contenido en la respuesta de la IA o formato inesperado.")
-            return None
-            
-        # Limpiar la respuesta para extraer solo el contenido JSON
-        logging.info(f"Contenido original recibido de IA: {ia_message_content_str}")
-        
-        # Buscar patrones de array JSON dentro de posibles formatos como \boxed{[...]} o ```json[...]```
-        json_array_pattern = r'\[(.*?)\]'
-        boxed_pattern = r'\\boxed\{(.*?)\}'
-        code_block_pattern = r'```(?:json)?\s*(\[.*?\])\s*```'
-        
-        # Intentar primero con \boxed{...}
-        boxed_match = re.search(boxed_pattern, ia_message_content_str, re.DOTALL)
-        if boxed_match:
-            json_content = boxed_match.group(1)
-            logging.info(f"Contenido extraído del patrón boxed: {json_content}")
-            # Verificar si lo que hay dentro es un array JSON
-            if json_content.strip().startswith('[') and json_content.strip().endswith(']'):
-                return json_content
-        
-        # Intentar con bloques de código
-        code_match = re.search(code_block_pattern, ia_message_content_str, re.DOTALL)
-        if code_match:
-            json_content = code_match.group(1)
-            logging.info(f"Contenido extraído del bloque de código: {json_content}")
-            return json_content
-        
-        # Si no se encontró en patrones específicos, buscar cualquier array JSON en el texto
-        json_match = re.search(json_array_pattern, ia_message_content_str, re.DOTALL)
-        if json_match:
-            json_array_text = f"[{json_match.group(1)}]"
-            logging.info(f"Contenido extraído como array JSON: {json_array_text}")
-            
-            # Verificar que sea un JSON válido intentando parsearlo
-            try:
-                json.loads(json_array_text)
-                return json_array_text
-            except json.JSONDecodeError as e:
-                logging.warning(f"El contenido extraído no es un JSON válido: {json_array_text}. Error: {e}")
-        
-        # Si no encontramos un patrón reconocible o JSON válido, devolver el contenido original
-        logging.warning("No se pudo extraer un array JSON válido, devolviendo contenido original")
-        return ia_message_content_str
+        return extraer_contenido_busquedas(response_json)
 
+    except LimiteOpenRouter as limite:
+        logging.warning(f"Llamada a OpenRouter aplazada: {limite}. Reintentar en {limite.espera:.1f} s")
+        raise # El consumidor la reprograma en la cola de reintentos
     except requests.exceptions.HTTPError as http_err:
-        logging.error(f"Error HTTP al contactar OpenRouter: {http_err} - {http_err.response.text if http_err.response else 'No response text'}")
+        logging.error(f"Error HTTP al contactar OpenRouter: {http_err} - {http_err.response.text if http_err.response is not None else 'No response text'}")
         # Reintentar es manejado por RabbitMQ, aquí solo retornamos None o levantamos la excepción
         raise # Re-levantar para que el consumidor de RabbitMQ pueda decidir si reencolar
     except requests.exceptions.RequestException as req_err:
@@ -104,8 +169,17 @@ def call_openrouter_api_for_prompt(prompt: str):
         logging.error(f"Error inesperado al llamar a OpenRouter API: {e}", exc_info=True)
         raise # Re-levantar para manejo genérico
 
+def es_peticion_streaming(incoming_data: dict):
+    """Indica si el cliente pidió la respuesta en streaming (SSE) con `stream: true`."""
+    return incoming_data.get("stream") is True
+
 def proxy_openrouter_request(incoming_data: dict):
-    """Actúa como proxy para la API de OpenRouter, reenviando la solicitud y respuesta."""
+    """Actúa como proxy para la API de OpenRouter, reenviando la solicitud y respuesta.
+
+    Comparte clave y cuota con el consumidor, así que también pide turno al planificador: lo
+    ocupa hasta recibir las cabeceras (el cuerpo lo reenvía después el llamador) y un 429/503
+    pausa todas las llamadas del proceso. Sin presupuesto devuelve un 429 con Retry-After.
+    """
     try:
         headers = get_openrouter_headers()
         model = incoming_data.get("model")
@@ -126,14 +200,31 @@ def proxy_openrouter_request(incoming_data: dict):
 
         logging.debug(f"Enviando a OpenRouter (proxy): {json.dumps(data_to_send)}")
         
-        response = requests.post(OPENROUTER_API_URL, headers=headers, data=json.dumps(data_to_send), stream=True)
-        response.raise_for_status()
-        return response # Se devuelve el objeto response para streaming si es necesario
+        with obtener_planificador_llm().turno(estimar_tokens(data_to_send)) as turno:
+            response = publicar_en_openrouter(
+                headers=headers, data=json.dumps(data_to_send), stream=True, timeout=OPENROUTER_TIMEOUT
+            )
+            try:
+                turno.registrar_respuesta(response.status_code, response.headers)
+                response.raise_for_status()
+            except (LimiteOpenRouter, requests.exceptions.HTTPError):
+                # Leer el cuerpo del error (para los detalles) y devolver la conexión al pool
+                response.content
+                response.close()
+                raise
+        return response # El llamador lee el cuerpo (o lo reenvía en streaming) y debe cerrar la respuesta
 
+    except LimiteOpenRouter as limite:
+        logging.warning(f"Proxy a OpenRouter limitado: {limite}. Reintentar en {limite.espera:.1f} s")
+        return (
+            {"error": "Límite de peticiones a la API de IA alcanzado", "details": str(limite)},
+            429,
+            {"Retry-After": str(math.ceil(limite.espera))},
+        )
     except requests.exceptions.HTTPError as http_err:
-        logging.error(f"HTTP error en proxy: {http_err} - {http_err.response.text if http_err.response else 'No response text'}")
+        logging.error(f"HTTP error en proxy: {http_err} - {http_err.response.text if http_err.response is not None else 'No response text'}")
         # Devolver el error original de OpenRouter si es posible
-        error_details = http_err.response.text if http_err.response else "Error en la comunicación con la API de IA"
+        error_details = http_err.response.text if http_err.response is not None else "Error en la comunicación con la API de IA"
         status_code = http_err.response.status_code if http_err.response is not None else 500
         return {"error": "Error en la comunicación con la API de IA", "details": error_details}, status_code
     except requests.exceptions.RequestException as req_err:
@@ -1,12 +1,25 @@
 import os
 import pika
 import logging
-import time
 import json
+import threading
+import random
 import requests
 
 # Import openrouter_client correctly
 import openrouter_client
+from llm_cache import (
+    perfil_canonico,
+    clave_prompt,
+    es_lista_busquedas,
+    obtener_cache_llm,
+)
+from comun.trazas import tramo, cabeceras_traza, id_correlacion_actual
+from comun.metricas import contar_reintento
+# El consumidor concurrente y el publicador son comunes con el backend (comun/)
+from comun.consumidor import ConsumidorConcurrente, instalar_manejador_senales
+from comun.publicador import obtener_publicador, esperar_confirmaciones
+from llm_planificador import LimiteOpenRouter
 
 # Configuración de logging
 logging.basicConfig(
@@ -14,49 +27,135 @@ logging.basicConfig(
 )
 
 # Configuración RabbitMQ
-RABBITMQ_HOST = os.environ.get("RABBITMQ_HOST", "rabbitmq")
-RABBITMQ_PORT = int(os.environ.get("RABBITMQ_PORT", 5672))
-RABBITMQ_USER = os.environ.get("RABBITMQ_USER", "guest")
-RABBITMQ_PASS = os.environ.get("RABBITMQ_PASS", "guest")
-QUEUE_PETICIONES_IA = "peticiones_ia"
+QUEUE_PETICIONES_IA = os.environ.get("QUEUE_PETICIONES_IA", "peticiones_ia")
 SCRAPPER_PETICIONES_QUEUE = os.environ.get(
     "SCRAPPER_PETICIONES_QUEUE", "scrapper_peticiones_queue"
 )  # Nueva cola
+# Prioridades en la cola del scraper (x-max-priority); 0 las desactiva. Debe coincidir con
+# SCRAPER_PRIORIDAD_MAXIMA del scraper: una cola ya declarada sin ella hay que borrarla antes
+SCRAPER_PRIORIDAD_MAXIMA = int(os.environ.get("SCRAPER_PRIORIDAD_MAXIMA", 0))
+# Reintentos diferidos de peticiones_ia: cada espera (en segundos) es una cola con ese TTL cuyos
+# mensajes caducados vuelven a peticiones_ia por dead-letter. Agotados los reintentos se descartan
+AI_REINTENTOS_MAX = int(os.environ.get("AI_REINTENTOS_MAX", 5))
+AI_REINTENTO_BASE = float(os.environ.get("AI_REINTENTO_BASE", 5))
+AI_REINTENTO_ESPERAS = sorted(
+    int(segundos) for segundos in os.environ.get("AI_REINTENTO_ESPERAS", "5,15,30,60,120,300").split(",")
+)
+CABECERA_REINTENTOS = "x-reintentos"
 
 
-def get_connection_params():
-    """Obtiene los parámetros de conexión a RabbitMQ"""
-    return pika.ConnectionParameters(
-        host=RABBITMQ_HOST,
-        port=RABBITMQ_PORT,
-        credentials=pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS),
-        heartbeat=600,
-        blocked_connection_timeout=300,
-    )
+def argumentos_cola_scraper():
+    """Argumentos con los que se declara la cola del scraper (None sin prioridades)."""
+    if SCRAPER_PRIORIDAD_MAXIMA > 0:
+        return {"x-max-priority": SCRAPER_PRIORIDAD_MAXIMA}
+    return None
 
 
-def conectar_a_rabbitmq(max_intentos=5, tiempo_espera=5):
-    intentos = 0
-    while intentos < max_intentos:
-        try:
-            conexion = pika.BlockingConnection(get_connection_params())
-            logging.info("Conexión establecida con RabbitMQ")
-            return conexion
-        except Exception as e:
-            intentos += 1
-            logging.error(
-                f"Intento {intentos}/{max_intentos} fallido al conectar con RabbitMQ: {e}"
-            )
-            if intentos < max_intentos:
-                logging.info(f"Reintentando en {tiempo_espera} segundos...")
-                time.sleep(tiempo_espera)
-    logging.error(
-        "No se pudo establecer conexión con RabbitMQ después de varios intentos"
+def prioridad_scraper(busquedas):
+    """Prioridad del mensaje para el scraper: más alta cuantas menos búsquedas tiene (None sin prioridades)."""
+    if SCRAPER_PRIORIDAD_MAXIMA <= 0:
+        return None
+    return max(0, SCRAPER_PRIORIDAD_MAXIMA - len(busquedas) + 1)
+
+
+def cola_reintento(segundos):
+    return f"{QUEUE_PETICIONES_IA}_reintento_{segundos}s"
+
+
+def colas_reintento():
+    """Colas de reintentos con sus argumentos: {nombre: arguments de queue_declare}."""
+    return {
+        cola_reintento(segundos): {
+            "x-message-ttl": segundos * 1000,
+            "x-dead-letter-exchange": "",
+            "x-dead-letter-routing-key": QUEUE_PETICIONES_IA,
+        }
+        for segundos in AI_REINTENTO_ESPERAS
+    }
+
+
+def preparar_reintento(headers, minimo=0):
+    """Devuelve (cabeceras, cola, segundos) del siguiente reintento, o None si ya se agotaron.
+
+    La espera es un backoff exponencial desde AI_REINTENTO_BASE con jitter, nunca menor que
+    `minimo` (el Retry-After o lo que falta para tener presupuesto), redondeada a la primera
+    cola de AI_REINTENTO_ESPERAS que la cubra. Un TTL fijo por cola evita que un mensaje con
+    una espera larga retenga a los de espera corta que tiene detrás.
+    """
+    headers = headers or {}
+    intento = int(headers.get(CABECERA_REINTENTOS, 0))
+    if intento >= AI_REINTENTOS_MAX:
+        return None
+    espera = max(minimo, AI_REINTENTO_BASE * 2**intento * random.uniform(0.5, 1))
+    segundos = next((s for s in AI_REINTENTO_ESPERAS if s >= espera), AI_REINTENTO_ESPERAS[-1])
+    # x-death y similares los añade el broker en cada dead-letter: no se republican
+    cabeceras = {
+        clave: valor
+        for clave, valor in headers.items()
+        if not clave.startswith(("x-death", "x-first-death", "x-last-death"))
+    }
+    cabeceras[CABECERA_REINTENTOS] = intento + 1
+    return cabeceras, cola_reintento(segundos), segundos
+
+
+def reintentar_mas_tarde(ch, method, properties, body, user_id, motivo, minimo=0):
+    """Reprograma la petición en una cola de reintentos en vez de reencolarla al instante.
+
+    Publica una copia con el contador de reintentos y confirma el original; si la publicación
+    falla, el original se reencola como antes.
+    """
+    reintento = preparar_reintento(properties.headers, minimo)
+    if reintento is None:
+        logging.error(
+            f"Petición de IA para {user_id} descartada tras {AI_REINTENTOS_MAX} reintentos: {motivo}"
+        )
+        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+        return
+    cabeceras, cola, segundos = reintento
+    fallos = esperar_confirmaciones([
+        obtener_publicador().publicar(
+            body,
+            cola,
+            propiedades=pika.BasicProperties(delivery_mode=2, headers=cabeceras),
+            cola=cola,
+            argumentos=colas_reintento()[cola],
+        )
+    ])
+    if fallos:
+        pub_err = fallos[0][1]
+        logging.error(
+            f"Error al publicar el reintento de {user_id} en {cola}: {pub_err}. Mensaje será reencolado."
+        )
+        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+        return
+    contar_reintento(QUEUE_PETICIONES_IA, segundos)
+    logging.warning(
+        f"Petición de IA para {user_id} reprogramada en {segundos} s "
+        f"(reintento {cabeceras[CABECERA_REINTENTOS]}/{AI_REINTENTOS_MAX}): {motivo}"
     )
-    return None
+    ch.basic_ack(delivery_tag=method.delivery_tag)
+
+
+def construir_prompt(data_usuario):
+    """Construye el prompt de generación de términos de búsqueda para un perfil de usuario.
+
+    Solo se envía el perfil canónico (respuestas y comentario): el nombre y los IDs no
+    influyen en las búsquedas y harían distinto el prompt de perfiles idénticos.
+    """
+    return f"""Analiza el siguiente perfil de usuario y genera entre 10 y 12 términos de búsqueda altamente relevantes y específicos para una tienda online. Enfócate especialmente en palabras clave concretas relacionadas con marcas, productos o intereses explícitos del usuario. Utiliza el lenguaje exacto que un usuario escribiría en un buscador, priorizando términos cortos y accionables como 'cámara nikon', 'sony alpha', 'cámara para paisajes', etc.
+
+Perfil del usuario: data{json.dumps(perfil_canonico(data_usuario))}.
+
+Responde únicamente con un array JSON de strings. Ejemplo de formato exacto de respuesta: ["cámara nikon", "sony alpha 7", "ofertas cámaras canon"]. No incluyas ningún texto adicional, explicaciones ni markdown, solo el array JSON."""
+
+
+def llamar_openrouter_medido(prompt):
+    with tramo("openrouter"):
+        return openrouter_client.call_openrouter_api_for_prompt(prompt)
 
 
 def procesar_peticion_ia_callback(ch, method, properties, body):
+    user_id = None
     try:
         data_usuario = json.loads(body.decode())
         # Extraer el ID de usuario del mensaje
@@ -69,21 +168,22 @@ def procesar_peticion_ia_callback(ch, method, properties, body):
             
         logging.info(f"Recibida petición de IA para usuario: {user_id}")
 
-        prompt = f"""Analiza el siguiente perfil de usuario y genera entre 10 y 12 términos de búsqueda altamente relevantes y específicos para una tienda online. Enfócate especialmente en palabras clave concretas relacionadas con marcas, productos o intereses explícitos del usuario. Utiliza el lenguaje exacto que un usuario escribiría en un buscador, priorizando términos cortos y accionables como 'cámara nikon', 'sony alpha', 'cámara para paisajes', etc.
-
-Perfil del usuario: data{json.dumps(data_usuario)}.
-
-Responde únicamente con un array JSON de strings. Ejemplo de formato exacto de respuesta: ["cámara nikon", "sony alpha 7", "ofertas cámaras canon"]. No incluyas ningún texto adicional, explicaciones ni markdown, solo el array JSON."""
+        prompt = construir_prompt(data_usuario)
 
-        ia_message_content_str = openrouter_client.call_openrouter_api_for_prompt(
-            prompt
-        )
+        # Perfiles idénticos comparten respuesta y, si coinciden en el tiempo, una sola llamada.
+        # 'llm' incluye los aciertos de caché; 'openrouter' solo las llamadas reales
+        with tramo("llm"):
+            ia_message_content_str = obtener_cache_llm().obtener_o_calcular(
+                clave_prompt(prompt, openrouter_client.DEFAULT_MODEL),
+                lambda: llamar_openrouter_medido(prompt),
+                es_valido=es_lista_busquedas,
+            )
 
         if not ia_message_content_str:
             logging.warning(
                 f"No se recibió contenido de la IA para usuario: {user_id}. Reintentando mensaje."
             )
-            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+            reintentar_mas_tarde(ch, method, properties, body, user_id, "respuesta de la IA vacía")
             return
 
         try:
@@ -110,41 +210,54 @@ Responde únicamente con un array JSON de strings. Ejemplo de formato exacto de
 
         # Preparar mensaje para el scraper
         mensaje_para_scraper = {
+            'id_correlacion': data_usuario.get('id_correlacion') or id_correlacion_actual(),
             'user_id': user_id,  # Usar el ID extraído
+            'reply_to': data_usuario.get('reply_to'),  # Sesión del frontend que recibe las URLs
             'busquedas': lista_busquedas
         }
 
-        try:
-            # Publicar en la cola del scraper
-            # Asegurarse de que la cola existe (declararla aquí también es una buena práctica, aunque el consumidor también lo hará)
-            ch.queue_declare(queue=SCRAPPER_PETICIONES_QUEUE, durable=True)
-            ch.basic_publish(
-                exchange="",
-                routing_key=SCRAPPER_PETICIONES_QUEUE,
-                body=json.dumps(mensaje_para_scraper),
-                properties=pika.BasicProperties(
+        # Publicar en la cola del scraper (el publicador la declara la primera vez) y esperar solo
+        # la confirmación de este mensaje: los demás workers siguen publicando mientras tanto
+        fallos = esperar_confirmaciones([
+            obtener_publicador().publicar(
+                json.dumps(mensaje_para_scraper),
+                SCRAPPER_PETICIONES_QUEUE,
+                propiedades=pika.BasicProperties(
                     delivery_mode=2,  # Hacer el mensaje persistente
+                    headers=cabeceras_traza(mensaje_para_scraper),
+                    priority=prioridad_scraper(lista_busquedas),
                 ),
+                cola=SCRAPPER_PETICIONES_QUEUE,
+                argumentos=argumentos_cola_scraper(),
             )
-            logging.info(
-                f"Mensaje con búsquedas para usuario {user_id} enviado a {SCRAPPER_PETICIONES_QUEUE}: {mensaje_para_scraper}"
-            )
-        except Exception as pub_err:
+        ])
+        if fallos:
+            pub_err = fallos[0][1]
             logging.error(
                 f"Error al publicar mensaje en {SCRAPPER_PETICIONES_QUEUE} para {user_id}: {pub_err}. El mensaje original de IA será reencolado para no perder la petición."
             )
             # Reencolar el mensaje original de IA si falla la publicación al scraper
             ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
             return
+        logging.info(
+            f"Mensaje con búsquedas para usuario {user_id} enviado a {SCRAPPER_PETICIONES_QUEUE}: {mensaje_para_scraper}"
+        )
 
         ch.basic_ack(delivery_tag=method.delivery_tag)
         logging.info(
             f"Petición de IA procesada y ack enviada para usuario: {user_id}"
         )
 
+    except (
+        json.JSONDecodeError
+    ) as e:  # Antes que ValueError, del que es subclase: el body del mensaje de RabbitMQ no es JSON
+        logging.error(
+            f"Error al decodificar JSON de RabbitMQ: {body.decode()}. Error: {e}. Mensaje no será reencolado."
+        )
+        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
     except (
         ValueError
-    ) as val_err:  # Captura el ValueError de openrouter_client (ej. API Key) o json.loads
+    ) as val_err:  # Captura el ValueError de openrouter_client (ej. API Key)
         # Distinguir si el error es por API key o por otra cosa podría ser útil aquí
         if "OPENROUTER_API_KEY" in str(val_err):
             logging.critical(
@@ -155,22 +268,22 @@ Responde únicamente con un array JSON de strings. Ejemplo de formato exacto de
                 f"ValueError durante el procesamiento para {user_id}: {val_err}. Mensaje no será reencolado."
             )
         ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+    except LimiteOpenRouter as limite:
+        # Sin presupuesto o limitados por OpenRouter: reencolar al instante solo gastaría cuota
+        reintentar_mas_tarde(
+            ch, method, properties, body, user_id, str(limite), minimo=limite.espera
+        )
     except (
         requests.exceptions.HTTPError,
         requests.exceptions.RequestException,
     ) as req_err:
         # Errores de comunicación con OpenRouter (ya logueados en openrouter_client)
         logging.warning(
-            f"Error de comunicación con OpenRouter (procesando usuario {user_id}): {req_err}. Mensaje será reencolado."
+            f"Error de comunicación con OpenRouter (procesando usuario {user_id}): {req_err}. Mensaje será reintentado."
         )
-        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
-    except (
-        json.JSONDecodeError
-    ) as e:  # Error al decodificar el body del mensaje de RabbitMQ
-        logging.error(
-            f"Error al decodificar JSON de RabbitMQ: {body.decode()}. Error: {e}. Mensaje no será reencolado."
+        reintentar_mas_tarde(
+            ch, method, properties, body, user_id, f"error de comunicación con OpenRouter: {req_err}"
         )
-        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
     except Exception as e:
         logging.error(
             f"Error inesperado al procesar petición de IA para {user_id}: {e}",
@@ -184,52 +297,19 @@ Responde únicamente con un array JSON de strings. Ejemplo de formato exacto de
 def iniciar_consumidor_ia():
     """Inicia el consumidor de RabbitMQ para la cola de peticiones_ia."""
     logging.info(f"Preparando para iniciar consumidor de {QUEUE_PETICIONES_IA}...")
-    # La función call_openrouter_api_for_prompt ya no se pasa como argumento directamente aquí,
-    # ya que procesar_peticion_ia_callback la importa y usa directamente.
-    while True:
-        conexion = conectar_a_rabbitmq()
-        if conexion:
-            try:
-                canal = conexion.channel()
-                canal.queue_declare(queue=QUEUE_PETICIONES_IA, durable=True)
-                canal.basic_qos(prefetch_count=1)
-
-                # El callback ahora usa directamente openrouter_client.call_openrouter_api_for_prompt
-                canal.basic_consume(
-                    queue=QUEUE_PETICIONES_IA,
-                    on_message_callback=procesar_peticion_ia_callback,
-                )
-
-                logging.info(
-                    f"Consumidor de {QUEUE_PETICIONES_IA} iniciado. Esperando mensajes..."
-                )
-                canal.start_consuming()
-            except pika.exceptions.StreamLostError as e:
-                logging.warning(
-                    f"Se perdió la conexión con RabbitMQ (StreamLostError): {e}. Reintentando..."
-                )
-            except pika.exceptions.AMQPConnectionError as e:
-                logging.warning(f"Error de conexión AMQP: {e}. Reintentando...")
-            except Exception as e:
-                logging.error(
-                    f"Error inesperado en el consumidor de IA: {e}. Reintentando...",
-                    exc_info=True,
-                )
-            finally:
-                if conexion and not conexion.is_closed:
-                    try:
-                        conexion.close()
-                        logging.info("Conexión RabbitMQ cerrada limpiamente.")
-                    except Exception as close_err:
-                        logging.error(
-                            f"Error al cerrar la conexión RabbitMQ: {close_err}"
-                        )
-                logging.info(
-                    "Intentando reconectar consumidor RabbitMQ en 10 segundos."
-                )
-                time.sleep(10)
-        else:
-            logging.warning(
-                "No se pudo conectar a RabbitMQ para iniciar consumidor IA. Reintentando en 10 segundos."
-            )
-            time.sleep(10)
+    # Con RABBITMQ_CONFIRMACIONES, la petición de IA solo se confirma (ack) cuando el broker
+    # ha aceptado el mensaje publicado para el scraper (ver comun/publicador.py)
+    consumidor = ConsumidorConcurrente(
+        QUEUE_PETICIONES_IA,
+        procesar_peticion_ia_callback,
+        nombre="Consumidor IA",
+        colas_adicionales=colas_reintento(),
+    )
+    # Las señales solo se pueden registrar desde el hilo principal; en app.py el
+    # consumidor corre en un hilo daemon y termina con el proceso
+    if threading.current_thread() is threading.main_thread():
+        instalar_manejador_senales(consumidor)
+    try:
+        consumidor.ejecutar()
+    finally:
+        obtener_publicador().cerrar()
@@ -0,0 +1,292 @@
+"""Runtime asyncio opcional del consumidor de IA (aio-pika + httpx).
+
+Mantiene los mismos nombres de cola, formato de mensajes y semántica de ack/nack que
+rabbitmq_client.procesar_peticion_ia_callback, pero cada petición a OpenRouter es una
+corrutina: un solo proceso puede tener cientos de llamadas en vuelo sin bloquear los
+heartbeats de la conexión.
+"""
+import os
+import json
+import time
+import signal
+import asyncio
+import logging
+import threading
+
+import aio_pika
+import httpx
+
+import openrouter_client
+from llm_cache import clave_prompt, es_lista_busquedas, obtener_cache_llm
+from comun.trazas import traza_mensaje, tramo, medir_etapa, cabeceras_traza, id_correlacion_actual
+from llm_planificador import LimiteOpenRouter, estimar_tokens, obtener_planificador_llm
+from comun.metricas import EntregaContada, contar_reintento, observar_http, registrar_comprobacion
+from comun.consumidor import (
+    RABBITMQ_HOST,
+    RABBITMQ_PORT,
+    RABBITMQ_USER,
+    RABBITMQ_PASS,
+)
+from comun.publicador import RABBITMQ_CONFIRMACIONES
+from rabbitmq_client import (
+    QUEUE_PETICIONES_IA,
+    SCRAPPER_PETICIONES_QUEUE,
+    AI_REINTENTOS_MAX,
+    CABECERA_REINTENTOS,
+    argumentos_cola_scraper,
+    colas_reintento,
+    construir_prompt,
+    preparar_reintento,
+    prioridad_scraper,
+)
+
+# Peticiones de IA procesándose a la vez; también es la ventana de prefetch
+AI_ASYNC_MAX_EN_VUELO = int(os.environ.get("AI_ASYNC_MAX_EN_VUELO", 200))
+AI_ASYNC_TIMEOUT = float(os.environ.get("AI_ASYNC_TIMEOUT", 60))
+
+
+@medir_etapa("openrouter")
+async def llamar_openrouter(cliente, prompt):
+    """Versión asíncrona de openrouter_client.call_openrouter_api_for_prompt, con el mismo planificador."""
+    payload = openrouter_client.construir_payload_prompt(prompt)
+    headers = openrouter_client.get_openrouter_headers()
+    async with obtener_planificador_llm().turno_async(estimar_tokens(payload)) as turno:
+        inicio = time.perf_counter()
+        try:
+            response = await cliente.post(
+                openrouter_client.OPENROUTER_API_URL,
+                headers=headers,
+                content=json.dumps(payload),
+            )
+        except httpx.HTTPError:
+            observar_http(
+                openrouter_client.OPENROUTER_HOST, "error", time.perf_counter() - inicio
+            )
+            raise
+        observar_http(
+            openrouter_client.OPENROUTER_HOST, response.status_code, time.perf_counter() - inicio
+        )
+        turno.registrar_respuesta(response.status_code, response.headers)
+        response.raise_for_status()
+        response_json = response.json()
+        turno.registrar_uso(response_json)
+    return openrouter_client.extraer_contenido_busquedas(response_json)
+
+
+async def reintentar_mas_tarde(message, exchange, user_id, motivo, minimo=0):
+    """Versión asíncrona de rabbitmq_client.reintentar_mas_tarde."""
+    reintento = preparar_reintento(message.headers, minimo)
+    if reintento is None:
+        logging.error(
+            f"Petición de IA para {user_id} descartada tras {AI_REINTENTOS_MAX} reintentos: {motivo}"
+        )
+        await message.nack(requeue=False)
+        return
+    cabeceras, cola, segundos = reintento
+    try:
+        await exchange.publish(
+            aio_pika.Message(
+                body=message.body,
+                delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                headers=cabeceras,
+            ),
+            routing_key=cola,
+            mandatory=RABBITMQ_CONFIRMACIONES,
+        )
+    except Exception as pub_err:
+        logging.error(
+            f"Error al publicar el reintento de {user_id} en {cola}: {pub_err}. Mensaje será reencolado."
+        )
+        await message.nack(requeue=True)
+        return
+    contar_reintento(QUEUE_PETICIONES_IA, segundos)
+    logging.warning(
+        f"Petición de IA para {user_id} reprogramada en {segundos} s "
+        f"(reintento {cabeceras[CABECERA_REINTENTOS]}/{AI_REINTENTOS_MAX}): {motivo}"
+    )
+    await message.ack()
+
+
+async def procesar_peticion_ia(message, cliente, exchange):
+    """Procesa una entrega de peticiones_ia con las mismas reglas de ack/nack que el consumidor bloqueante."""
+    with traza_mensaje(QUEUE_PETICIONES_IA, message), tramo(f"consumir:{QUEUE_PETICIONES_IA}"):
+        await _procesar_peticion_ia(message, cliente, exchange)
+
+
+async def _procesar_peticion_ia(message, cliente, exchange):
+    user_id = None
+    try:
+        data_usuario = json.loads(message.body.decode())
+        user_id = data_usuario.get("id_usuario") or data_usuario.get("usuario", {}).get("id")
+        if not user_id:
+            logging.error("No se encontró ID de usuario en el mensaje")
+            await message.nack(requeue=False)
+            return
+
+        logging.info(f"Recibida petición de IA (asyncio) para usuario: {user_id}")
+        prompt = construir_prompt(data_usuario)
+        with tramo("llm"):
+            ia_message_content_str = await obtener_cache_llm().obtener_o_calcular_async(
+                clave_prompt(prompt, openrouter_client.DEFAULT_MODEL),
+                lambda: llamar_openrouter(cliente, prompt),
+                es_valido=es_lista_busquedas,
+            )
+        if not ia_message_content_str:
+            logging.warning(
+                f"No se recibió contenido de la IA para usuario: {user_id}. Reintentando mensaje."
+            )
+            await reintentar_mas_tarde(message, exchange, user_id, "respuesta de la IA vacía")
+            return
+
+        try:
+            lista_busquedas = json.loads(ia_message_content_str)
+            if not isinstance(lista_busquedas, list):
+                raise ValueError("El contenido de la IA no es una lista JSON.")
+        except (json.JSONDecodeError, ValueError) as e:
+            logging.error(
+                f"Error en formato de contenido de IA para {user_id}: {ia_message_content_str}. Error: {e}. Mensaje no será reencolado."
+            )
+            await message.nack(requeue=False)
+            return
+
+        mensaje_para_scraper = {
+            "id_correlacion": data_usuario.get("id_correlacion") or id_correlacion_actual(),
+            "user_id": user_id,
+            "reply_to": data_usuario.get("reply_to"),
+            "busquedas": lista_busquedas,
+        }
+        try:
+            await exchange.publish(
+                aio_pika.Message(
+                    body=json.dumps(mensaje_para_scraper).encode(),
+                    delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                    headers=cabeceras_traza(mensaje_para_scraper),
+                    priority=prioridad_scraper(lista_busquedas),
+                ),
+                routing_key=SCRAPPER_PETICIONES_QUEUE,
+                mandatory=RABBITMQ_CONFIRMACIONES,
+            )
+        except Exception as pub_err:
+            logging.error(
+                f"Error al publicar mensaje en {SCRAPPER_PETICIONES_QUEUE} para {user_id}: {pub_err}. El mensaje original de IA será reencolado."
+            )
+            await message.nack(requeue=True)
+            return
+
+        await message.ack()
+        logging.info(f"Petición de IA procesada y ack enviada para usuario: {user_id}")
+
+    except ValueError as val_err:
+        # Configuración (API key) o cuerpo del mensaje inválido: no tiene sentido reintentar
+        logging.error(
+            f"ValueError durante el procesamiento para {user_id}: {val_err}. Mensaje no será reencolado."
+        )
+        await message.nack(requeue=False)
+    except LimiteOpenRouter as limite:
+        # Sin presupuesto o limitados por OpenRouter: reencolar al instante solo gastaría cuota
+        await reintentar_mas_tarde(
+            message, exchange, user_id, str(limite), minimo=limite.espera
+        )
+    except httpx.HTTPError as req_err:
+        logging.warning(
+            f"Error de comunicación con OpenRouter (procesando usuario {user_id}): {req_err}. Mensaje será reintentado."
+        )
+        await reintentar_mas_tarde(
+            message, exchange, user_id, f"error de comunicación con OpenRouter: {req_err!r}"
+        )
+    except Exception as e:
+        logging.error(
+            f"Error inesperado al procesar petición de IA para {user_id}: {e}",
+            exc_info=True,
+        )
+        await message.nack(requeue=True)
+
+
+async def consumir_peticiones_ia(detener=None):
+    """Consume peticiones_ia hasta que se active el evento `detener` (o indefinidamente)."""
+    detener = detener or asyncio.Event()
+    conexion = await aio_pika.connect_robust(
+        host=RABBITMQ_HOST,
+        port=RABBITMQ_PORT,
+        login=RABBITMQ_USER,
+        password=RABBITMQ_PASS,
+        heartbeat=600,
+    )
+    limites = httpx.Limits(
+        max_connections=AI_ASYNC_MAX_EN_VUELO,
+        max_keepalive_connections=AI_ASYNC_MAX_EN_VUELO,
+    )
+    async with conexion, httpx.AsyncClient(
+        limits=limites, timeout=AI_ASYNC_TIMEOUT
+    ) as cliente:
+        # Con confirmaciones, aio-pika sigue los delivery tags del canal: cada tarea espera solo el
+        # ack de su mensaje y las demás siguen publicando (como mucho AI_ASYNC_MAX_EN_VUELO a la vez)
+        canal = await conexion.channel(publisher_confirms=RABBITMQ_CONFIRMACIONES)
+        await canal.set_qos(prefetch_count=AI_ASYNC_MAX_EN_VUELO)
+        cola = await canal.declare_queue(QUEUE_PETICIONES_IA, durable=True)
+        for nombre, argumentos in colas_reintento().items():
+            await canal.declare_queue(nombre, durable=True, arguments=argumentos)
+        await canal.declare_queue(
+            SCRAPPER_PETICIONES_QUEUE, durable=True, arguments=argumentos_cola_scraper()
+        )
+        registrar_comprobacion(f"rabbitmq:{QUEUE_PETICIONES_IA}", lambda: not canal.is_closed)
+
+        tareas = set()
+
+        async def al_recibir(message):
+            # No esperar aquí: cada petición avanza en su propia tarea
+            message = EntregaContada(message, QUEUE_PETICIONES_IA)
+            _lanzar(tareas, procesar_peticion_ia(message, cliente, canal.default_exchange))
+
+        consumer_tag = await cola.consume(al_recibir)
+        logging.info(
+            f"Consumidor asyncio de {QUEUE_PETICIONES_IA} iniciado (máx. en vuelo: {AI_ASYNC_MAX_EN_VUELO})"
+        )
+        try:
+            await detener.wait()
+            # Cierre ordenado: dejar de recibir...
+            await cola.cancel(consumer_tag)
+        finally:
+            # ...y, también si el consumidor falla, esperar a las peticiones en curso antes de cerrar la conexión
+            if tareas:
+                logging.info(f"Esperando {len(tareas)} peticiones de IA en curso...")
+                await asyncio.gather(*tareas, return_exceptions=True)
+    logging.info(f"Consumidor asyncio de {QUEUE_PETICIONES_IA} detenido")
+
+
+def _lanzar(tareas, corrutina):
+    """Crea la tarea y la registra para poder esperarla en el cierre."""
+    tarea = asyncio.ensure_future(corrutina)
+    tareas.add(tarea)
+    tarea.add_done_callback(tareas.discard)
+    return tarea
+
+
+def iniciar_consumidor_ia_async():
+    """Punto de entrada bloqueante del runtime asyncio, equivalente a iniciar_consumidor_ia.
+
+    Termina de forma ordenada con SIGTERM/SIGINT: deja de consumir y espera a las peticiones
+    en curso. Si el consumidor falla, se reintenta a los 10 segundos salvo que ya se pidiera el cierre.
+    """
+    asyncio.run(_consumir_hasta_senal())
+
+
+async def _consumir_hasta_senal():
+    detener = asyncio.Event()
+    # Las señales solo se pueden registrar desde el hilo principal, como en iniciar_consumidor_ia
+    if threading.current_thread() is threading.main_thread():
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, detener.set)
+    while not detener.is_set():
+        try:
+            await consumir_peticiones_ia(detener)
+        except Exception as e:
+            logging.error(
+                f"Error en el consumidor asyncio de IA: {e}. Reintentando en 10 segundos.",
+                exc_info=True,
+            )
+            try:
+                await asyncio.wait_for(detener.wait(), 10)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,36 @@
+"""Punto de entrada del consumidor de peticiones_ia como proceso independiente de la API.
+
+Con la API servida por gunicorn (app:app), el consumidor se ejecuta aparte con
+`python worker.py`, de modo que ambos escalan por separado y no compiten por el GIL.
+"""
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import os
+import logging
+
+import rabbitmq_client
+from comun.trazas import iniciar_exportadores
+
+# AI_RUNTIME=asyncio usa el consumidor aio-pika/httpx en lugar del bloqueante de pika
+AI_RUNTIME = os.getenv("AI_RUNTIME", "blocking").lower()
+
+
+def obtener_consumidor():
+    """Devuelve la función bloqueante que ejecuta el consumidor del runtime configurado."""
+    if AI_RUNTIME == "asyncio":
+        import rabbitmq_client_async
+
+        return rabbitmq_client_async.iniciar_consumidor_ia_async
+    return rabbitmq_client.iniciar_consumidor_ia
+
+
+def main():
+    logging.info(f"Iniciando worker de IA (runtime: {AI_RUNTIME})")
+    iniciar_exportadores("ai_service")
+    obtener_consumidor()()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,105 +1,233 @@
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request
 from flask_cors import CORS
+import os
+import time
+import hashlib
 import logging
-from database_utils import get_db_connection
+import threading
+from collections import deque
+from database_utils import (
+    conexion_db, ConexionNoDisponible, estadisticas_pool, EscuchaNotificaciones, CANAL_CAMBIOS_FORMULARIO,
+    ejecutar_preparada, comprobar_db
+)
+from cache_utils import CacheTTL
+from comun.metricas import contar_cache, estado_salud, respuesta_metricas, registrar_comprobacion
+
+# Caché de respuestas de /formulary/<id>; se invalida con NOTIFY y el TTL solo acota lo que se escape
+FORMULARIO_CACHE_TTL = int(os.environ.get('FORMULARIO_CACHE_TTL', 300))
+FORMULARIO_CACHE_MAX_ENTRADAS = int(os.environ.get('FORMULARIO_CACHE_MAX_ENTRADAS', 10000))
 
 app = Flask(__name__)
 CORS(app)
 
+
+class CacheFormularios:
+    """Caché de respuestas serializadas por user_id, invalidada por los avisos de PostgreSQL.
+
+    Solo se usa mientras la escucha de NOTIFY está activa. Una carga que se cruza con una
+    invalidación del mismo usuario no se guarda, para no cachear datos ya obsoletos.
+    """
+
+    def __init__(self, max_entradas, ttl):
+        self.cache = CacheTTL(max_entradas, ttl)
+        self.habilitada = ttl > 0
+        self.escucha = None
+        self._cargas = {}
+        self._lock = threading.Lock()
+        self._contadores = {'aciertos': 0, 'fallos': 0, 'no_modificado': 0, 'invalidaciones': 0}
+
+    def _activa(self):
+        if not self.habilitada:
+            return False
+        if self.escucha is None:
+            with self._lock:
+                if self.escucha is None:
+                    self.escucha = EscuchaNotificaciones(
+                        CANAL_CAMBIOS_FORMULARIO, self._al_notificar, al_reconectar=self.limpiar
+                    ).iniciar()
+        return self.escucha.conectado
+
+    def contar(self, contador):
+        with self._lock:
+            self._contadores[contador] += 1
+        contar_cache('formularios', contador)
+
+    def obtener(self, user_id):
+        """Devuelve (cuerpo, etag) cacheado o None, junto con la marca para guardar la carga."""
+        if not self._activa():
+            return None, None
+        entrada = self.cache.obtener(user_id)
+        marca = None
+        with self._lock:
+            if entrada is not None:
+                self._contadores['aciertos'] += 1
+            else:
+                self._contadores['fallos'] += 1
+                marca = self._cargas[user_id] = object()
+        contar_cache('formularios', 'aciertos' if entrada is not None else 'fallos')
+        return entrada, marca
+
+    def guardar(self, user_id, entrada, marca):
+        with self._lock:
+            if marca is None or self._cargas.get(user_id) is not marca:
+                return
+            del self._cargas[user_id]
+        self.cache.guardar(user_id, entrada)
+
+    def _al_notificar(self, payload):
+        try:
+            user_id = int(payload)
+        except ValueError:
+            logging.warning(f"Aviso de cambio de formulario con payload inválido: {payload!r}")
+            return
+        with self._lock:
+            self._cargas.pop(user_id, None)
+            self._contadores['invalidaciones'] += 1
+        self.cache.invalidar(user_id)
+
+    def limpiar(self):
+        with self._lock:
+            self._cargas.clear()
+        self.cache.limpiar()
+
+    def estadisticas(self):
+        with self._lock:
+            stats = dict(self._contadores)
+        consultas = stats['aciertos'] + stats['fallos']
+        stats['ratio_aciertos'] = stats['aciertos'] / consultas if consultas else 0.0
+        stats['entradas'] = len(self.cache)
+        stats['escucha_activa'] = bool(self.escucha and self.escucha.conectado)
+        return stats
+
+
+class MedidorLatencias:
+    """Guarda las últimas N duraciones para calcular percentiles sin dependencias externas."""
+
+    def __init__(self, max_muestras=2048):
+        self._muestras = deque(maxlen=max_muestras)
+        self._lock = threading.Lock()
+
+    def registrar(self, segundos):
+        with self._lock:
+            self._muestras.append(segundos)
+
+    def percentiles(self, *ps):
+        with self._lock:
+            muestras = sorted(self._muestras)
+        if not muestras:
+            return {f"p{int(p * 100)}_ms": None for p in ps}
+        return {f"p{int(p * 100)}_ms": round(muestras[min(len(muestras) - 1, int(len(muestras) * p))] * 1000, 2) for p in ps}
+
+
+cache_formularios = CacheFormularios(FORMULARIO_CACHE_MAX_ENTRADAS, FORMULARIO_CACHE_TTL)
+latencias_formulario = MedidorLatencias()
+registrar_comprobacion('postgres', comprobar_db)
+
+@app.route('/health', methods=['GET'])
+def health_check():
+    """Disponibilidad: 503 si el pool no entrega una conexión que responda, para dejar de recibir tráfico."""
+    listo, cuerpo = estado_salud()
+    return jsonify(cuerpo), 200 if listo else 503
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    cuerpo, content_type = respuesta_metricas()
+    return app.response_class(cuerpo, content_type=content_type)
+
 @app.route('/formulary/<int:user_id>', methods=['GET'])
 def get_user_form_data(user_id):
+    inicio = time.perf_counter()
     try:
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({'error': 'Error de conexión a la base de datos'}), 500
-
-        cursor = conn.cursor()
-
-        # Consulta para obtener la información del usuario y su formulario
-        query = """
-            SELECT 
-                u.id as usuario_id,
-                u.nombreUsuario,
-                u.edad,
-                t.motivoCompra,
-                t.fuenteInformacion,
-                t.temasDeInteres,
-                t.comprasNoNecesarias,
-                t.importanciaMarca,
-                t.probarNuevosProductos,
-                t.aspiraciones,
-                t.nivelSocial,
-                t.tiempoLibre,
-                t.identidad,
-                t.tendencias,
-                s.id as solicitud_id,
-                s.comentarioSolicitud
-            FROM usuarios u
-            LEFT JOIN solicitudes s ON u.id = s.userId
-            LEFT JOIN tests t ON s.testsId = t.id
-            WHERE u.id = %s
-            ORDER BY s.id DESC
-            LIMIT 1
-        """
-        
-        cursor.execute(query, (user_id,))
-        result = cursor.fetchone()
-
-        if not result:
+        return _responder_formulario(user_id)
+    finally:
+        latencias_formulario.registrar(time.perf_counter() - inicio)
+
+def _responder_formulario(user_id):
+    entrada, marca = cache_formularios.obtener(user_id)
+    if entrada is None:
+        try:
+            with conexion_db() as conn, conn.cursor() as cursor:
+                datos = _consultar_formulario(cursor, user_id)
+        except ConexionNoDisponible as e:
+            logging.error(f"Sin conexión a la base de datos para el usuario {user_id}: {e}")
+            return jsonify({'error': 'Error de conexión a la base de datos'}), 503
+        except Exception as e:
+            logging.error(f"Error al obtener datos del usuario: {e}")
+            return jsonify({'error': f'Error del servidor: {str(e)}'}), 500
+        if datos is None:
             return jsonify({'error': 'Usuario no encontrado'}), 404
+        cuerpo = datos.encode('utf-8')
+        entrada = (cuerpo, hashlib.sha1(cuerpo).hexdigest())
+        cache_formularios.guardar(user_id, entrada, marca)
 
-        # Modificamos la consulta de URLs para usar el ID de solicitud específico
-        urls_query = """
-            SELECT ue.url, ue.fecha_creacion
-            FROM urls_encontradas ue
-            WHERE ue.solicitud_id = %s
-            ORDER BY ue.fecha_creacion DESC
-        """
-        
-        # Usamos el ID de solicitud específico
-        cursor.execute(urls_query, (result[14],))  # result[14] es solicitud_id
-        urls = [{"url": row[0], "fecha": row[1].isoformat()} for row in cursor.fetchall()]
-
-        # Para debugging
-        logging.info(f"URLs encontradas para solicitud {result[14]}: {urls}")
-
-        response = {
-            'usuario': {
-                'id': result[0],
-                'nombre': result[1],
-                'edad': result[2]
-            },
-            'formulario': {
-                'motivoCompra': result[3],
-                'fuenteInformacion': result[4],
-                'temasDeInteres': result[5],
-                'comprasNoNecesarias': result[6],
-                'importanciaMarca': result[7],
-                'probarNuevosProductos': result[8],
-                'aspiraciones': result[9],
-                'nivelSocial': result[10],
-                'tiempoLibre': result[11],
-                'identidad': result[12],
-                'tendencias': result[13]
-            },
-            'solicitud': {
-                'id': result[14],
-                'comentario': result[15],
-                'urls': urls
-            }
-        }
-
-        # Para debugging
-        logging.info(f"Respuesta completa: {response}")
-
-        return jsonify(response)
-
-    except Exception as e:
-        logging.error(f"Error al obtener datos del usuario: {e}")
-        return jsonify({'error': f'Error del servidor: {str(e)}'}), 500
-    finally:
-        if conn:
-            conn.close()
+    cuerpo, etag = entrada
+    respuesta = app.response_class(cuerpo, mimetype='application/json')
+    respuesta.set_etag(etag)
+    # no-cache: el cliente puede guardar la respuesta pero debe revalidarla (If-None-Match -> 304)
+    respuesta.headers['Cache-Control'] = 'no-cache'
+    respuesta.make_conditional(request)
+    if respuesta.status_code == 304:
+        cache_formularios.contar('no_modificado')
+    return respuesta
+
+@app.route('/formulary/estadisticas', methods=['GET'])
+def get_estadisticas():
+    """Indicadores del proceso: caché y latencias de /formulary/<id> y estado del pool de conexiones."""
+    return jsonify({
+        'cache_formularios': cache_formularios.estadisticas(),
+        'latencia_formulario': latencias_formulario.percentiles(0.5, 0.9, 0.99),
+        'pool_db': estadisticas_pool()
+    })
+
+# Usuario, formulario, última solicitud y sus URLs en una sola ida y vuelta. PostgreSQL construye
+# el JSON de la respuesta, que se envía tal cual sin decodificarlo ni volver a serializarlo
+SQL_FORMULARIO_USUARIO = """
+    SELECT json_build_object(
+        'usuario', json_build_object('id', u.id, 'nombre', u.nombreUsuario, 'edad', u.edad),
+        'formulario', json_build_object(
+            'motivoCompra', t.motivoCompra,
+            'fuenteInformacion', t.fuenteInformacion,
+            'temasDeInteres', t.temasDeInteres,
+            'comprasNoNecesarias', t.comprasNoNecesarias,
+            'importanciaMarca', t.importanciaMarca,
+            'probarNuevosProductos', t.probarNuevosProductos,
+            'aspiraciones', t.aspiraciones,
+            'nivelSocial', t.nivelSocial,
+            'tiempoLibre', t.tiempoLibre,
+            'identidad', t.identidad,
+            'tendencias', t.tendencias
+        ),
+        'solicitud', json_build_object(
+            'id', s.id,
+            'comentario', s.comentarioSolicitud,
+            'urls', COALESCE((
+                SELECT json_agg(json_build_object('url', ue.url, 'fecha', ue.fecha_creacion)
+                                ORDER BY ue.fecha_creacion DESC)
+                FROM urls_encontradas ue
+                WHERE ue.solicitud_id = s.id
+            ), '[]'::json)
+        )
+    )::text
+    FROM usuarios u
+    LEFT JOIN LATERAL (
+        SELECT id, testsId, comentarioSolicitud
+        FROM solicitudes
+        WHERE userId = u.id
+        ORDER BY id DESC
+        LIMIT 1
+    ) s ON true
+    LEFT JOIN tests t ON t.id = s.testsId
+    WHERE u.id = $1
+"""
+
+def _consultar_formulario(cursor, user_id):
+    """Devuelve el JSON de la respuesta de /formulary/<id> como texto, o None si el usuario no existe."""
+    ejecutar_preparada(cursor, 'formulario_usuario', SQL_FORMULARIO_USUARIO, (user_id,))
+    fila = cursor.fetchone()
+    if fila is None:
+        return None
+    logging.debug(f"Respuesta completa para el usuario {user_id}: {fila[0]}")
+    return fila[0]
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
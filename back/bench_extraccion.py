@@ -0,0 +1,54 @@
+"""Micro-benchmark de los backends de extracción HTML del scraper.
+
+Uso:
+    python bench_extraccion.py pagina1.html [pagina2.html ...] [--repeticiones 20] [--limite 3]
+
+Sirven los listados recortados de tests/fixtures/ o páginas reales guardadas con, por ejemplo:
+    curl -s https://listado.mercadolibre.com.co/camara-nikon -o camara-nikon.html
+
+Para cada backend disponible muestra el tiempo medio por página y si su resultado
+coincide con el de 'bs4', que reproduce el comportamiento original del scraper.
+"""
+import argparse
+import time
+
+from extraction_utils import BACKENDS, backend_disponible
+
+
+def medir(extractor, html, repeticiones, limite):
+    inicio = time.perf_counter()
+    for _ in range(repeticiones):
+        resultado = extractor(html, limite)
+    return (time.perf_counter() - inicio) / repeticiones, resultado
+
+
+def coincide(resultado, referencia):
+    """Compara con la referencia; un resultado incompleto solo debe ser un prefijo de sus enlaces."""
+    if not resultado["completo"]:
+        return resultado["links"] == referencia["links"][:len(resultado["links"])]
+    return resultado["links"] == referencia["links"] and resultado["siguiente"] == referencia["siguiente"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compara los backends de extracción HTML")
+    parser.add_argument("paginas", nargs="+", help="Ficheros HTML de listados guardados")
+    parser.add_argument("--repeticiones", type=int, default=20)
+    parser.add_argument("--limite", type=int, default=None, help="Enlaces tras los que el extractor puede parar")
+    args = parser.parse_args()
+
+    backends = [nombre for nombre in BACKENDS if backend_disponible(nombre)]
+    print(f"Backends disponibles: {', '.join(backends)}")
+
+    for ruta in args.paginas:
+        with open(ruta, encoding="utf-8", errors="replace") as f:
+            html = f.read()
+        referencia = BACKENDS["bs4"](html) if "bs4" in backends else None
+        print(f"\n{ruta} ({len(html) / 1024:.0f} KB)")
+        for nombre in backends:
+            segundos, resultado = medir(BACKENDS[nombre], html, args.repeticiones, args.limite)
+            paridad = "-" if referencia is None else ("ok" if coincide(resultado, referencia) else "DIFIERE")
+            print(f"  {nombre:<11} {segundos * 1000:8.2f} ms/página  enlaces={len(resultado['links']):<3} paridad={paridad}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""Benchmark de las consultas más frecuentes antes y después de las migraciones de índices.
+
+Crea el esquema `bench_consultas` con copias vacías de las tablas, lo siembra con datos
+sintéticos, mide cada consulta (plan con EXPLAIN ANALYZE y latencias p50/p99), aplica las
+migraciones de migrations/ sobre ese esquema y vuelve a medir. Las tablas reales no se tocan.
+
+Uso:
+    python bench_queries.py --usuarios 100000 --solicitudes 1000000 --urls-por-solicitud 5
+"""
+import re
+import time
+import random
+import argparse
+
+import psycopg2
+
+from database_utils import DB_CONFIG
+from migrate import leer_migraciones, ejecutar_migracion
+from api import SQL_FORMULARIO_USUARIO
+
+ESQUEMA = 'bench_consultas'
+
+CONSULTAS = {
+    'ultima_solicitud': (
+        "SELECT id FROM solicitudes WHERE userId = %s ORDER BY id DESC LIMIT 1", 'usuario'
+    ),
+    'urls_por_solicitud': (
+        "SELECT url, fecha_creacion FROM urls_encontradas WHERE solicitud_id = %s ORDER BY fecha_creacion DESC",
+        'solicitud'
+    ),
+    # Se ejecuta dentro de una transacción que se deshace: los datos no cambian entre rondas
+    'borrar_urls_solicitud': ("DELETE FROM urls_encontradas WHERE solicitud_id = %s", 'solicitud'),
+    'formulario_usuario': (re.sub(r'\$\d+', '%s', SQL_FORMULARIO_USUARIO), 'usuario'),
+}
+
+
+def crear_esquema(cursor, usuarios, solicitudes, urls_por_solicitud):
+    cursor.execute(f"DROP SCHEMA IF EXISTS {ESQUEMA} CASCADE")
+    cursor.execute(f"CREATE SCHEMA {ESQUEMA}")
+    cursor.execute(f"SET search_path TO {ESQUEMA}, public")
+    for tabla in ('usuarios', 'tests', 'solicitudes', 'urls_encontradas'):
+        cursor.execute(f"CREATE TABLE {ESQUEMA}.{tabla} (LIKE public.{tabla} INCLUDING DEFAULTS, PRIMARY KEY (id))")
+    # Las tablas parten del esquema de init.sql: fuera las columnas que añaden las migraciones
+    cursor.execute(f"ALTER TABLE {ESQUEMA}.tests DROP COLUMN IF EXISTS huella")
+
+    inicio = time.perf_counter()
+    cursor.execute(
+        "INSERT INTO usuarios (id, nombreUsuario, edad) "
+        "SELECT i, 'usuario ' || i, 18 + i %% 60 FROM generate_series(1, %s) i",
+        (usuarios,)
+    )
+    cursor.execute(
+        "INSERT INTO tests (id, motivoCompra, fuenteInformacion, temasDeInteres, comprasNoNecesarias, "
+        "importanciaMarca, probarNuevosProductos, aspiraciones, nivelSocial, tiempoLibre, identidad, tendencias) "
+        "SELECT i, 'Precio', 'Redes sociales', 'Tecnología', 'A veces', 'Muy importante', 'Le gusta', "
+        "'Crecimiento personal', 'Algo social', 'Tiempo libre moderado', 'A veces', 'Siempre' "
+        "FROM generate_series(1, %s) i",
+        (solicitudes,)
+    )
+    # Las solicitudes de un mismo usuario quedan repartidas por toda la tabla, como en producción
+    cursor.execute(
+        "INSERT INTO solicitudes (id, userId, testsId, comentarioSolicitud) "
+        "SELECT i, 1 + (i - 1) %% %s, i, 'comentario ' || i FROM generate_series(1, %s) i",
+        (usuarios, solicitudes)
+    )
+    cursor.execute(
+        "INSERT INTO urls_encontradas (id, solicitud_id, url, fecha_creacion) "
+        "SELECT (s - 1) * %(n)s + u, s, 'https://articulo.example.com/MCO-' || s || '-' || u, "
+        "       now() - (random() * interval '30 days') "
+        "FROM generate_series(1, %(solicitudes)s) s, generate_series(1, %(n)s) u",
+        {'n': urls_por_solicitud, 'solicitudes': solicitudes}
+    )
+    cursor.execute("ANALYZE usuarios, tests, solicitudes, urls_encontradas")
+    print(f"Datos sembrados en {time.perf_counter() - inicio:.1f} s: {usuarios} usuarios, "
+          f"{solicitudes} solicitudes, {solicitudes * urls_por_solicitud} URLs")
+
+
+def parametro(tipo, usuarios, solicitudes):
+    return random.randint(1, usuarios if tipo == 'usuario' else solicitudes)
+
+
+def ejecutar(cursor, nombre, sql, valor):
+    if nombre == 'borrar_urls_solicitud':
+        cursor.execute("BEGIN")
+        cursor.execute(sql, (valor,))
+        cursor.execute("ROLLBACK")
+    else:
+        cursor.execute(sql, (valor,))
+        cursor.fetchall()
+
+
+def mostrar_plan(cursor, nombre, sql, valor):
+    if nombre == 'borrar_urls_solicitud':
+        cursor.execute("BEGIN")
+    cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS) {sql}", (valor,))
+    plan = [fila[0] for fila in cursor.fetchall()]
+    if nombre == 'borrar_urls_solicitud':
+        cursor.execute("ROLLBACK")
+    for linea in plan:
+        print(f"      {linea}")
+
+
+def medir(cursor, ejecuciones, usuarios, solicitudes, planes):
+    for nombre, (sql, tipo) in CONSULTAS.items():
+        valor = parametro(tipo, usuarios, solicitudes)
+        ejecutar(cursor, nombre, sql, valor)  # calentamiento
+        duraciones = []
+        for _ in range(ejecuciones):
+            valor = parametro(tipo, usuarios, solicitudes)
+            inicio = time.perf_counter()
+            ejecutar(cursor, nombre, sql, valor)
+            duraciones.append(time.perf_counter() - inicio)
+        duraciones.sort()
+        p50 = duraciones[len(duraciones) // 2] * 1000
+        p99 = duraciones[min(len(duraciones) - 1, int(len(duraciones) * 0.99))] * 1000
+        print(f"  {nombre:<22} p50 {p50:9.3f} ms   p99 {p99:9.3f} ms")
+        if planes:
+            mostrar_plan(cursor, nombre, sql, parametro(tipo, usuarios, solicitudes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mide las consultas frecuentes antes y después de las migraciones")
+    parser.add_argument('--usuarios', type=int, default=100000)
+    parser.add_argument('--solicitudes', type=int, default=1000000)
+    parser.add_argument('--urls-por-solicitud', type=int, default=5)
+    parser.add_argument('--ejecuciones', type=int, default=200, help="Ejecuciones por consulta y fase")
+    parser.add_argument('--sin-planes', action='store_true', help="No muestra los planes de EXPLAIN ANALYZE")
+    parser.add_argument('--conservar', action='store_true', help="No borra el esquema de pruebas al terminar")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**DB_CONFIG)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            crear_esquema(cursor, args.usuarios, args.solicitudes, args.urls_por_solicitud)
+
+            print("\nAntes de las migraciones:")
+            medir(cursor, args.ejecuciones, args.usuarios, args.solicitudes, not args.sin_planes)
+
+        for migracion in leer_migraciones():
+            inicio = time.perf_counter()
+            ejecutar_migracion(conn, migracion)
+            print(f"\nMigración {migracion.version} aplicada en {time.perf_counter() - inicio:.1f} s")
+
+        with conn.cursor() as cursor:
+            cursor.execute("ANALYZE urls_encontradas, solicitudes, tests")
+            print("\nDespués de las migraciones:")
+            medir(cursor, args.ejecuciones, args.usuarios, args.solicitudes, not args.sin_planes)
+
+            if not args.conservar:
+                cursor.execute(f"DROP SCHEMA {ESQUEMA} CASCADE")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,328 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from database_utils import get_db_connection, release_db_connection
+from comun.metricas import contar_cache
+
+SCRAPER_CACHE_TTL = int(os.environ.get('SCRAPER_CACHE_TTL', 3600))
+SCRAPER_CACHE_MAX_ENTRADAS = int(os.environ.get('SCRAPER_CACHE_MAX_ENTRADAS', 5000))
+# Segundos que una entrada caducada se conserva para servirla si MercadoLibre no responde
+SCRAPER_CACHE_GRACIA = int(os.environ.get('SCRAPER_CACHE_GRACIA', 86400))
+# Nivel compartido entre réplicas: '' (desactivado), 'postgres' o 'archivo'
+SCRAPER_CACHE_COMPARTIDO = os.environ.get('SCRAPER_CACHE_COMPARTIDO', '').lower()
+SCRAPER_CACHE_DIR = os.environ.get('SCRAPER_CACHE_DIR', '/tmp/scraper_cache')
+# Tamaño máximo del nivel compartido y cada cuántos segundos cada réplica lo purga
+SCRAPER_CACHE_COMPARTIDO_MAX_ENTRADAS = int(os.environ.get('SCRAPER_CACHE_COMPARTIDO_MAX_ENTRADAS', 100000))
+SCRAPER_CACHE_PURGA_INTERVALO = float(os.environ.get('SCRAPER_CACHE_PURGA_INTERVALO', 300))
+# Un temporal más antiguo que esto es de un proceso que murió a mitad de escritura
+TEMPORAL_HUERFANO_SEGUNDOS = 3600
+
+logger = logging.getLogger(__name__)
+
+
+class CacheTTL:
+    """Caché en memoria con expiración por TTL y desalojo LRU. Segura entre hilos.
+
+    Con `gracia`, una entrada caducada se conserva ese tiempo más y obtener(clave, permitir_expirado=True)
+    todavía la devuelve.
+    """
+
+    def __init__(self, max_entradas, ttl, gracia=0):
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self.gracia = gracia
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obtener(self, clave, permitir_expirado=False):
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is None:
+                return None
+            expira_en, valor = entrada
+            ahora = time.monotonic()
+            if expira_en < ahora:
+                if expira_en + self.gracia < ahora:
+                    del self._datos[clave]
+                    return None
+                if not permitir_expirado:
+                    return None
+            self._datos.move_to_end(clave)
+            return valor
+
+    def guardar(self, clave, valor, ttl=None):
+        expira_en = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._datos[clave] = (expira_en, valor)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_entradas:
+                self._datos.popitem(last=False)
+
+    def invalidar(self, clave):
+        with self._lock:
+            self._datos.pop(clave, None)
+
+    def limpiar(self):
+        with self._lock:
+            self._datos.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._datos)
+
+
+class _AlmacenCompartido:
+    """Base de los niveles compartidos: TTL, gracia y purga periódica desde las escrituras.
+
+    Cada `intervalo_purga` segundos, la siguiente escritura del proceso llama a purgar(), que
+    borra las entradas caducadas hace más de `gracia` y, si quedan más de `max_entradas`, las
+    escritas hace más tiempo.
+    """
+
+    def __init__(self, ttl, gracia=0, max_entradas=SCRAPER_CACHE_COMPARTIDO_MAX_ENTRADAS,
+                 intervalo_purga=SCRAPER_CACHE_PURGA_INTERVALO):
+        self.ttl = ttl
+        self.gracia = gracia
+        self.max_entradas = max_entradas
+        self.intervalo_purga = intervalo_purga
+        self._proxima_purga = time.monotonic() + intervalo_purga
+        self._purga_lock = threading.Lock()
+
+    def _purgar_si_toca(self):
+        with self._purga_lock:
+            ahora = time.monotonic()
+            if ahora < self._proxima_purga:
+                return
+            self._proxima_purga = ahora + self.intervalo_purga
+        self.purgar()
+
+    def purgar(self):
+        raise NotImplementedError
+
+
+class AlmacenArchivos(_AlmacenCompartido):
+    """Nivel compartido en disco: un fichero JSON por clave, útil con un volumen común entre réplicas.
+
+    La purga usa la fecha de modificación de cada fichero como fecha de escritura.
+    """
+
+    def __init__(self, directorio, ttl, gracia=0, **kwargs):
+        super().__init__(ttl, gracia, **kwargs)
+        self.directorio = directorio
+        os.makedirs(directorio, exist_ok=True)
+
+    def _ruta(self, clave):
+        return os.path.join(self.directorio, hashlib.sha1(clave.encode('utf-8')).hexdigest() + '.json')
+
+    def obtener(self, clave, permitir_expirado=False):
+        try:
+            with open(self._ruta(clave), encoding='utf-8') as f:
+                entrada = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entrada.get('expira_en', 0) < time.time() - (self.gracia if permitir_expirado else 0):
+            return None
+        return entrada.get('valor')
+
+    def guardar(self, clave, valor):
+        ruta = self._ruta(clave)
+        temporal = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temporal, 'w', encoding='utf-8') as f:
+                json.dump({'expira_en': time.time() + self.ttl, 'valor': valor}, f)
+            # os.replace es atómico: otra réplica nunca lee un fichero a medio escribir
+            os.replace(temporal, ruta)
+        except OSError as e:
+            logger.warning(f"No se pudo escribir la entrada de caché {clave} en disco: {e}")
+        self._purgar_si_toca()
+
+    def purgar(self):
+        ahora = time.time()
+        limite = ahora - self.ttl - self.gracia
+        vigentes = []
+        borrados = 0
+        try:
+            entradas = list(os.scandir(self.directorio))
+        except OSError as e:
+            logger.warning(f"No se pudo recorrer la caché en disco {self.directorio}: {e}")
+            return
+        for entrada in entradas:
+            try:
+                escrito = entrada.stat().st_mtime
+            except OSError:
+                continue  # otra réplica lo borró mientras tanto
+            if entrada.name.endswith('.tmp'):
+                if escrito < ahora - TEMPORAL_HUERFANO_SEGUNDOS:
+                    borrados += _borrar_archivo(entrada.path)
+            elif entrada.name.endswith('.json'):
+                if escrito < limite:
+                    borrados += _borrar_archivo(entrada.path)
+                else:
+                    vigentes.append((escrito, entrada.path))
+        sobrantes = len(vigentes) - self.max_entradas
+        if sobrantes > 0:
+            vigentes.sort()
+            for _, ruta in vigentes[:sobrantes]:
+                borrados += _borrar_archivo(ruta)
+        if borrados:
+            logger.info(f"Purga de la caché en disco: {borrados} ficheros borrados, {min(len(vigentes), self.max_entradas)} vigentes")
+
+
+def _borrar_archivo(ruta):
+    """Borra un fichero de la caché en disco. Devuelve 1 si lo borró y 0 si ya no existía o falló."""
+    try:
+        os.remove(ruta)
+        return 1
+    except FileNotFoundError:
+        return 0
+    except OSError as e:
+        logger.warning(f"No se pudo borrar {ruta} de la caché en disco: {e}")
+        return 0
+
+
+# Purga del nivel en PostgreSQL: caducadas tras la gracia y, por encima del máximo, las más antiguas
+# (todas las entradas tienen el mismo TTL, así que expira_en ordena por fecha de escritura)
+SQL_PURGAR_CACHE_CADUCADA = "DELETE FROM cache_busquedas WHERE expira_en < NOW() - make_interval(secs => %s)"
+SQL_PURGAR_CACHE_SOBRANTE = """
+    DELETE FROM cache_busquedas
+    WHERE clave IN (SELECT clave FROM cache_busquedas ORDER BY expira_en DESC OFFSET %s)
+"""
+
+
+class AlmacenPostgres(_AlmacenCompartido):
+    """Nivel compartido en la tabla cache_busquedas de PostgreSQL (migrations/0005_cache_busquedas.sql)."""
+
+    def obtener(self, clave, permitir_expirado=False):
+        conn = get_db_connection()
+        if not conn:
+            return None
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT valor FROM cache_busquedas WHERE clave = %s AND expira_en > NOW() - make_interval(secs => %s)",
+                    (clave, self.gracia if permitir_expirado else 0)
+                )
+                fila = cursor.fetchone()
+            conn.commit()
+            return fila[0] if fila else None
+        except Exception as e:
+            logger.warning(f"Error leyendo la caché compartida para {clave}: {e}")
+            conn.rollback()
+            return None
+        finally:
+            release_db_connection(conn)
+
+    def guardar(self, clave, valor):
+        conn = get_db_connection()
+        if not conn:
+            return
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO cache_busquedas (clave, valor, expira_en)
+                    VALUES (%s, %s, NOW() + make_interval(secs => %s))
+                    ON CONFLICT (clave) DO UPDATE
+                    SET valor = EXCLUDED.valor, expira_en = EXCLUDED.expira_en
+                """, (clave, json.dumps(valor), self.ttl))
+            conn.commit()
+        except Exception as e:
+            logger.warning(f"Error escribiendo la caché compartida para {clave}: {e}")
+            conn.rollback()
+        finally:
+            release_db_connection(conn)
+        self._purgar_si_toca()
+
+    def purgar(self):
+        conn = get_db_connection()
+        if not conn:
+            return
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(SQL_PURGAR_CACHE_CADUCADA, (self.gracia,))
+                caducadas = cursor.rowcount
+                cursor.execute(SQL_PURGAR_CACHE_SOBRANTE, (self.max_entradas,))
+                sobrantes = cursor.rowcount
+            conn.commit()
+            if caducadas or sobrantes:
+                logger.info(f"Purga de la caché compartida: {caducadas} caducadas y {sobrantes} sobrantes borradas")
+        except Exception as e:
+            logger.warning(f"Error purgando la caché compartida: {e}")
+            conn.rollback()
+        finally:
+            release_db_connection(conn)
+
+
+class CacheBusquedas:
+    """Caché de páginas de resultados en dos niveles: memoria del proceso y, opcionalmente, compartido."""
+
+    def __init__(self, ttl=SCRAPER_CACHE_TTL, max_entradas=SCRAPER_CACHE_MAX_ENTRADAS, compartido=SCRAPER_CACHE_COMPARTIDO,
+                 gracia=SCRAPER_CACHE_GRACIA):
+        self.habilitada = ttl > 0
+        self.memoria = CacheTTL(max_entradas, ttl, gracia)
+        self.compartido = None
+        if self.habilitada and compartido == 'postgres':
+            self.compartido = AlmacenPostgres(ttl, gracia)
+        elif self.habilitada and compartido == 'archivo':
+            self.compartido = AlmacenArchivos(SCRAPER_CACHE_DIR, ttl, gracia)
+        elif compartido:
+            logger.warning(f"Nivel de caché compartido desconocido: {compartido}")
+        self._contadores = {'aciertos_memoria': 0, 'aciertos_compartido': 0, 'fallos': 0, 'aciertos_expirado': 0}
+        self._lock = threading.Lock()
+
+    def _contar(self, contador):
+        with self._lock:
+            self._contadores[contador] += 1
+        contar_cache('busquedas', contador)
+
+    def obtener(self, clave):
+        if not self.habilitada:
+            return None
+        valor = self.memoria.obtener(clave)
+        if valor is not None:
+            self._contar('aciertos_memoria')
+            return valor
+        if self.compartido is not None:
+            valor = self.compartido.obtener(clave)
+            if valor is not None:
+                # Promocionar al nivel en memoria para las siguientes lecturas
+                self.memoria.guardar(clave, valor)
+                self._contar('aciertos_compartido')
+                return valor
+        self._contar('fallos')
+        return None
+
+    def obtener_expirado(self, clave):
+        """Busca la entrada aunque haya caducado (dentro del periodo de gracia).
+
+        Es el último recurso cuando no se puede descargar la página: el valor no se promociona
+        a memoria, así no pasa por fresco en las siguientes lecturas.
+        """
+        if not self.habilitada:
+            return None
+        valor = self.memoria.obtener(clave, permitir_expirado=True)
+        if valor is None and self.compartido is not None:
+            valor = self.compartido.obtener(clave, permitir_expirado=True)
+        if valor is not None:
+            self._contar('aciertos_expirado')
+        return valor
+
+    def guardar(self, clave, valor):
+        if not self.habilitada:
+            return
+        self.memoria.guardar(clave, valor)
+        if self.compartido is not None:
+            self.compartido.guardar(clave, valor)
+
+    def estadisticas(self):
+        """Devuelve los contadores de aciertos/fallos y la ocupación del nivel en memoria."""
+        with self._lock:
+            stats = dict(self._contadores)
+        total = stats['aciertos_memoria'] + stats['aciertos_compartido'] + stats['fallos']
+        stats['entradas_memoria'] = len(self.memoria)
+        stats['ratio_aciertos'] = (total - stats['fallos']) / total if total else 0.0
+        return stats
@@ -1,47 +1,316 @@
 import psycopg2
-from psycopg2 import pool
+from psycopg2 import extensions, errors
+import os
+import re
 import time
 import logging
+import threading
+import select
+from collections import deque
+from contextlib import contextmanager
 
-# Crear un pool de conexiones para PostgreSQL
+from prometheus_client import Counter, Gauge, Histogram
+
+# Parámetros de conexión a PostgreSQL
+DB_CONFIG = {
+    'host': os.environ.get('POSTGRES_HOST', 'postgres'),  # nombre del servicio en docker-compose
+    'port': int(os.environ.get('POSTGRES_PORT', 5432)),
+    'database': os.environ.get('POSTGRES_DB', 'postgres'),
+    'user': os.environ.get('POSTGRES_USER', 'postgres'),
+    'password': os.environ.get('POSTGRES_PASSWORD', 'postgres'),
+}
+
+# Tamaño del pool: debe cubrir al menos los workers del consumidor para que cada uno tenga su conexión
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', max(10, int(os.environ.get('CONSUMIDOR_WORKERS', 1)) * 2)))
+# Segundos que se espera por una conexión libre antes de fallar
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 5))
+# Reciclado: vida máxima de una conexión y tiempo máximo sin usarse
+DB_POOL_MAX_VIDA = float(os.environ.get('DB_POOL_MAX_VIDA', 1800))
+DB_POOL_MAX_INACTIVIDAD = float(os.environ.get('DB_POOL_MAX_INACTIVIDAD', 300))
+# Una conexión que lleva más de estos segundos sin usarse se verifica con SELECT 1 al entregarla
+DB_POOL_VERIFICAR_TRAS = float(os.environ.get('DB_POOL_VERIFICAR_TRAS', 5))
+
+# Canal de LISTEN/NOTIFY por el que se avisa de cambios en el formulario de un usuario (payload: user_id)
+CANAL_CAMBIOS_FORMULARIO = 'formulario_cambios'
+
+# Métricas del pool; en las APIs con gunicorn los gauges suman los pools de todos los workers
+POOL_CONEXIONES = Gauge(
+    'db_pool_conexiones', 'Conexiones del pool por estado', ['estado'], multiprocess_mode='livesum'
+)
+POOL_ESPERANDO = Gauge(
+    'db_pool_hilos_esperando', 'Hilos esperando una conexión libre', multiprocess_mode='livesum'
+)
+POOL_EVENTOS = Counter(
+    'db_pool_eventos_total', 'Conexiones creadas y descartadas y esperas agotadas (timeout) del pool', ['evento']
+)
+POOL_ESPERA = Histogram(
+    'db_pool_espera_segundos', 'Tiempo hasta obtener una conexión del pool',
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+
+
+class ConexionNoDisponible(Exception):
+    """No se pudo obtener una conexión del pool dentro del tiempo de espera."""
+
+
+class ConexionConSentencias(extensions.connection):
+    """Conexión que recuerda qué sentencias tiene preparadas en el servidor (PREPARE)."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.preparadas = set()
+
+
+def ejecutar_preparada(cursor, nombre, sql, parametros):
+    """Ejecuta `sql` (con parámetros $1, $2...) como sentencia preparada en la conexión del cursor.
+
+    La sentencia se prepara la primera vez que se usa en cada conexión; en las siguientes
+    solo viaja EXECUTE, sin volver a analizar ni planificar la consulta.
+    """
+    conn = cursor.connection
+    preparadas = getattr(conn, 'preparadas', None)
+    marcadores = ', '.join(['%s'] * len(parametros))
+    if preparadas is None:
+        # Conexión creada fuera del pool: ejecutar sin preparar ($n -> %s, en orden)
+        cursor.execute(re.sub(r'\$\d+', '%s', sql), parametros)
+        return
+    if nombre not in preparadas:
+        cursor.execute(f"PREPARE {nombre} AS {sql}")
+        preparadas.add(nombre)
+    try:
+        cursor.execute(f"EXECUTE {nombre} ({marcadores})", parametros)
+    except errors.InvalidSqlStatementName:
+        # La sesión perdió la sentencia (p. ej. DISCARD ALL en un pooler): prepararla de nuevo
+        conn.rollback()
+        cursor.execute(f"PREPARE {nombre} AS {sql}")
+        cursor.execute(f"EXECUTE {nombre} ({marcadores})", parametros)
+
+
+class _Entrada:
+    __slots__ = ('conn', 'creada_en', 'usada_en')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.creada_en = self.usada_en = time.monotonic()
+
+
+class PoolConexiones:
+    """Pool de conexiones seguro entre hilos con verificación al entregar y reciclado.
+
+    - obtener() espera como mucho `timeout` segundos a que haya una conexión libre.
+    - Las conexiones que superan su vida máxima o su inactividad máxima se cierran y se reponen.
+    - Las que llevan un rato sin usarse se verifican con SELECT 1 antes de entregarlas.
+    - devolver() deshace cualquier transacción abierta y descarta las conexiones rotas.
+    """
+
+    def __init__(self, minimo, maximo, timeout=DB_POOL_TIMEOUT, max_vida=DB_POOL_MAX_VIDA,
+                 max_inactividad=DB_POOL_MAX_INACTIVIDAD, verificar_tras=DB_POOL_VERIFICAR_TRAS, **parametros):
+        self.minimo = minimo
+        self.maximo = maximo
+        self.timeout = timeout
+        self.max_vida = max_vida
+        self.max_inactividad = max_inactividad
+        self.verificar_tras = verificar_tras
+        self.parametros = parametros
+        self._libres = deque()
+        self._en_uso = {}
+        self._total = 0
+        self._esperando = 0
+        self._cerrado = False
+        self._condicion = threading.Condition()
+        self._contadores = {'creadas': 0, 'descartadas': 0, 'timeouts': 0}
+        for _ in range(minimo):
+            self._libres.append(self._crear())
+            self._total += 1
+        with self._condicion:
+            self._actualizar_metricas()
+
+    def _crear(self):
+        conn = psycopg2.connect(connection_factory=ConexionConSentencias, **self.parametros)
+        with self._condicion:
+            self._contadores['creadas'] += 1
+        POOL_EVENTOS.labels('creada').inc()
+        return _Entrada(conn)
+
+    def _descartar(self, entrada):
+        with self._condicion:
+            self._contadores['descartadas'] += 1
+        POOL_EVENTOS.labels('descartada').inc()
+        try:
+            entrada.conn.close()
+        except Exception:
+            pass
+
+    def _caducada(self, entrada, ahora):
+        return ahora - entrada.creada_en > self.max_vida or ahora - entrada.usada_en > self.max_inactividad
+
+    def _actualizar_metricas(self):
+        # Se llama con self._condicion adquirida
+        POOL_CONEXIONES.labels('en_uso').set(len(self._en_uso))
+        POOL_CONEXIONES.labels('libres').set(len(self._libres))
+        POOL_ESPERANDO.set(self._esperando)
+
+    def _sana(self, entrada, ahora):
+        if entrada.conn.closed:
+            return False
+        if ahora - entrada.usada_en < self.verificar_tras:
+            return True
+        try:
+            with entrada.conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            entrada.conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def obtener(self, timeout=None):
+        """Entrega una conexión sana o lanza ConexionNoDisponible si no hay ninguna a tiempo."""
+        timeout = self.timeout if timeout is None else timeout
+        inicio = time.monotonic()
+        limite = inicio + timeout
+        while True:
+            entrada = None
+            crear = False
+            with self._condicion:
+                while not self._libres and self._total >= self.maximo and not self._cerrado:
+                    restante = limite - time.monotonic()
+                    if restante <= 0:
+                        self._contadores['timeouts'] += 1
+                        POOL_EVENTOS.labels('timeout').inc()
+                        raise ConexionNoDisponible(
+                            f"Sin conexiones libres tras {timeout:.1f} s ({self._total} en uso)"
+                        )
+                    self._esperando += 1
+                    POOL_ESPERANDO.set(self._esperando)
+                    try:
+                        self._condicion.wait(restante)
+                    finally:
+                        self._esperando -= 1
+                        POOL_ESPERANDO.set(self._esperando)
+                if self._cerrado:
+                    raise ConexionNoDisponible("El pool de conexiones está cerrado")
+                if self._libres:
+                    # LIFO: se reutilizan las conexiones calientes y las demás caducan por inactividad
+                    entrada = self._libres.pop()
+                else:
+                    self._total += 1
+                    crear = True
+
+            if crear:
+                try:
+                    entrada = self._crear()
+                except Exception:
+                    self._liberar_hueco()
+                    raise
+            else:
+                ahora = time.monotonic()
+                if self._caducada(entrada, ahora) or not self._sana(entrada, ahora):
+                    # Fuera del lock: cerrar o verificar puede tardar
+                    self._descartar(entrada)
+                    self._liberar_hueco()
+                    continue
+
+            with self._condicion:
+                self._en_uso[id(entrada.conn)] = entrada
+                self._actualizar_metricas()
+            POOL_ESPERA.observe(time.monotonic() - inicio)
+            return entrada.conn
+
+    def _liberar_hueco(self):
+        with self._condicion:
+            self._total -= 1
+            self._condicion.notify()
+
+    def devolver(self, conn):
+        with self._condicion:
+            entrada = self._en_uso.pop(id(conn), None)
+            self._actualizar_metricas()
+        if entrada is None:
+            logging.warning("Se devolvió al pool una conexión que no le pertenece; se cierra")
+            conn.close()
+            return
+
+        descartar = conn.closed or self._cerrado
+        if not descartar and conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                descartar = True
+        entrada.usada_en = ahora = time.monotonic()
+        if descartar or self._caducada(entrada, ahora):
+            self._descartar(entrada)
+            self._liberar_hueco()
+            return
+        with self._condicion:
+            self._libres.append(entrada)
+            self._actualizar_metricas()
+            self._condicion.notify()
+
+    def cerrar(self):
+        with self._condicion:
+            self._cerrado = True
+            libres, self._libres = list(self._libres), deque()
+            self._total -= len(libres)
+            self._actualizar_metricas()
+            self._condicion.notify_all()
+        for entrada in libres:
+            self._descartar(entrada)
+
+    def estadisticas(self):
+        """Indicadores del pool: conexiones en uso, libres, hilos esperando y contadores acumulados."""
+        with self._condicion:
+            stats = dict(self._contadores)
+            stats.update(
+                en_uso=len(self._en_uso),
+                libres=len(self._libres),
+                total=self._total,
+                esperando=self._esperando,
+                maximo=self.maximo,
+            )
+        return stats
+
+
+# Pool de conexiones del proceso
 connection_pool = None
+_pool_lock = threading.Lock()
 
 def init_db_connection_pool(max_attempts=5):
     global connection_pool
     attempt = 0
     while attempt < max_attempts:
-        try:
-            logging.info(f"Intento {attempt + 1} de conectar a la base de datos...")
-            connection_pool = psycopg2.pool.SimpleConnectionPool(
-                1,  # min_connections
-                10,  # max_connections
-                host="postgres",  # nombre del servicio en docker-compose
-                database="postgres",
-                user="postgres",
-                password="postgres",
-                connect_timeout=10
-            )
-            logging.info("Conexión exitosa a la base de datos")
-            return True
-        except Exception as e:
-            logging.error(f"Intento {attempt + 1} fallido: {e}")
-            attempt += 1
-            if attempt < max_attempts:
-                logging.info(f"Intentando de nuevo en 5 segundos...")
-                time.sleep(5)
-    
+        with _pool_lock:
+            if connection_pool is not None:
+                return True
+            try:
+                logging.info(f"Intento {attempt + 1} de conectar a la base de datos...")
+                connection_pool = PoolConexiones(
+                    DB_POOL_MIN,
+                    DB_POOL_MAX,
+                    connect_timeout=10,
+                    **DB_CONFIG
+                )
+                logging.info("Conexión exitosa a la base de datos")
+                return True
+            except Exception as e:
+                logging.error(f"Intento {attempt + 1} fallido: {e}")
+        attempt += 1
+        if attempt < max_attempts:
+            logging.info(f"Intentando de nuevo en 5 segundos...")
+            time.sleep(5)
+
     logging.error("No se pudo establecer conexión a la base de datos después de varios intentos")
     return False
 
 def get_db_connection():
-    global connection_pool
+    """Obtiene una conexión del pool o None. Siempre hay que devolverla con release_db_connection."""
     if connection_pool is None:
         # Intentar inicializar nuevamente el pool si no existe
         init_db_connection_pool()
-    
+
     if connection_pool:
         try:
-            return connection_pool.getconn()
+            return connection_pool.obtener()
         except Exception as e:
             logging.error(f"Error al obtener conexión del pool: {e}")
     return None
@@ -49,6 +318,99 @@ def get_db_connection():
 def release_db_connection(conn):
     if connection_pool and conn:
         try:
-            connection_pool.putconn(conn)
+            connection_pool.devolver(conn)
         except Exception as e:
-            logging.error(f"Error al devolver conexión al pool: {e}") 
\ No newline at end of file
+            logging.error(f"Error al devolver conexión al pool: {e}")
+
+@contextmanager
+def conexion_db():
+    """Presta una conexión del pool durante el bloque `with`.
+
+    Hace commit si el bloque termina bien y rollback si lanza una excepción; la conexión
+    vuelve siempre al pool. Lanza ConexionNoDisponible si no se puede obtener ninguna.
+    """
+    conn = get_db_connection()
+    if conn is None:
+        raise ConexionNoDisponible("No se pudo obtener una conexión a la base de datos")
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        release_db_connection(conn)
+
+def comprobar_db(timeout=1):
+    """Comprobación de /health: el pool entrega una conexión que responde a SELECT 1 en `timeout` segundos."""
+    if connection_pool is None and not init_db_connection_pool(max_attempts=1):
+        return False
+    conn = connection_pool.obtener(timeout=timeout)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        return True
+    finally:
+        release_db_connection(conn)
+
+def estadisticas_pool():
+    """Indicadores del pool del proceso, o None si todavía no existe."""
+    return connection_pool.estadisticas() if connection_pool else None
+
+def notificar_cambio_formulario(cursor, user_id):
+    """Avisa a las APIs de que los datos del usuario cambiaron. Se entrega al hacer commit."""
+    cursor.execute("SELECT pg_notify(%s, %s)", (CANAL_CAMBIOS_FORMULARIO, str(user_id)))
+
+class EscuchaNotificaciones:
+    """Hilo con una conexión dedicada (fuera del pool) que hace LISTEN en un canal.
+
+    Llama a `al_notificar(payload)` por cada NOTIFY. Si la conexión se pierde llama a
+    `al_reconectar()` antes de volver a escuchar, porque los avisos de ese intervalo se han perdido.
+    """
+
+    def __init__(self, canal, al_notificar, al_reconectar=None, espera_reconexion=5):
+        self.canal = canal
+        self.al_notificar = al_notificar
+        self.al_reconectar = al_reconectar
+        self.espera_reconexion = espera_reconexion
+        self.conectado = False
+        self._detenido = threading.Event()
+        self._hilo = threading.Thread(target=self._ejecutar, name=f"listen-{canal}", daemon=True)
+
+    def iniciar(self):
+        self._hilo.start()
+        return self
+
+    def detener(self):
+        self._detenido.set()
+
+    def _escuchar(self):
+        conn = psycopg2.connect(connect_timeout=10, **DB_CONFIG)
+        try:
+            conn.set_session(autocommit=True)
+            with conn.cursor() as cursor:
+                cursor.execute(f"LISTEN {self.canal}")
+            self.conectado = True
+            logging.info(f"Escuchando notificaciones de PostgreSQL en el canal {self.canal}")
+            while not self._detenido.is_set():
+                if not select.select([conn], [], [], 5)[0]:
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    self.al_notificar(conn.notifies.pop(0).payload)
+        finally:
+            self.conectado = False
+            conn.close()
+
+    def _ejecutar(self):
+        primera = True
+        while not self._detenido.is_set():
+            try:
+                if not primera and self.al_reconectar:
+                    self.al_reconectar()
+                primera = False
+                self._escuchar()
+            except Exception as e:
+                logging.warning(f"Se perdió la escucha del canal {self.canal}: {e}. Reintentando en {self.espera_reconexion} s")
+                self._detenido.wait(self.espera_reconexion)
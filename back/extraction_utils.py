@@ -0,0 +1,176 @@
+import os
+import logging
+from html.parser import HTMLParser
+
+# Backend de extracción: 'stream' (tokenizador de la stdlib que se detiene pronto),
+# 'bs4' (árbol completo, comportamiento original), 'lxml' o 'selectolax' si están instalados
+SCRAPER_HTML_BACKEND = os.environ.get('SCRAPER_HTML_BACKEND', 'stream').lower()
+
+MARCADOR_PRODUCTO = "articulo.mercadolibre.com.co"
+TEXTO_SIGUIENTE = "Siguiente"
+# Tamaño de los trozos con los que se alimenta el tokenizador en modo stream
+TAMANO_TROZO_STREAM = 16 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+def _resultado(links, siguiente, completo=True):
+    return {"links": links, "siguiente": siguiente, "completo": completo}
+
+
+def _elegir_siguiente(por_titulo, por_texto):
+    """Replica la prioridad original: primero un <a title="Siguiente">, si no hay ninguno, por texto."""
+    if por_titulo is not None:
+        return por_titulo[0]
+    return por_texto[0] if por_texto is not None else None
+
+
+def _agregar_link(links, vistos, link, limite):
+    """Añade un enlace de producto si no estaba. Devuelve True si ya se alcanzó el límite."""
+    if link and MARCADOR_PRODUCTO in link and link not in vistos:
+        vistos.add(link)
+        links.append(link)
+    return limite is not None and len(links) >= limite
+
+
+def extraer_bs4(html, limite=None):
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, "html.parser")
+    links, vistos = [], set()
+    por_titulo = por_texto = None
+    for a in soup.find_all("a"):
+        href = a.get("href")
+        if href is not None:
+            _agregar_link(links, vistos, href, None)
+        if por_titulo is None and a.get("title") == TEXTO_SIGUIENTE:
+            por_titulo = (href,)
+        if por_texto is None and a.get_text(strip=True) == TEXTO_SIGUIENTE:
+            por_texto = (href,)
+    if limite is not None:
+        links = links[:limite]
+    return _resultado(links, _elegir_siguiente(por_titulo, por_texto))
+
+
+def extraer_lxml(html, limite=None):
+    import lxml.html
+
+    documento = lxml.html.document_fromstring(html)
+    links, vistos = [], set()
+    por_titulo = por_texto = None
+    for a in documento.iter("a"):
+        href = a.get("href")
+        if href is not None:
+            _agregar_link(links, vistos, href, None)
+        if por_titulo is None and a.get("title") == TEXTO_SIGUIENTE:
+            por_titulo = (href,)
+        if por_texto is None and "".join(t.strip() for t in a.itertext()) == TEXTO_SIGUIENTE:
+            por_texto = (href,)
+    if limite is not None:
+        links = links[:limite]
+    return _resultado(links, _elegir_siguiente(por_titulo, por_texto))
+
+
+def extraer_selectolax(html, limite=None):
+    from selectolax.parser import HTMLParser as SelectolaxParser
+
+    arbol = SelectolaxParser(html)
+    links, vistos = [], set()
+    por_titulo = por_texto = None
+    for a in arbol.css("a"):
+        href = a.attributes.get("href")
+        if href is not None:
+            _agregar_link(links, vistos, href, None)
+        if por_titulo is None and a.attributes.get("title") == TEXTO_SIGUIENTE:
+            por_titulo = (href,)
+        if por_texto is None and a.text(deep=True, separator="", strip=True) == TEXTO_SIGUIENTE:
+            por_texto = (href,)
+    if limite is not None:
+        links = links[:limite]
+    return _resultado(links, _elegir_siguiente(por_titulo, por_texto))
+
+
+class _TokenizadorEnlaces(HTMLParser):
+    """Recorre el HTML como flujo de etiquetas sin construir árbol, anotando enlaces y el botón 'Siguiente'."""
+
+    def __init__(self, limite):
+        super().__init__(convert_charrefs=True)
+        self.limite = limite
+        self.links = []
+        self.vistos = set()
+        self.por_titulo = None
+        self.por_texto = None
+        self.terminado = False
+        self._href_actual = None
+        self._texto_actual = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag != "a" or self.terminado:
+            return
+        atributos = dict(attrs)
+        href = atributos.get("href")
+        if href is not None and _agregar_link(self.links, self.vistos, href, self.limite):
+            self.terminado = True
+        if self.por_titulo is None and atributos.get("title") == TEXTO_SIGUIENTE:
+            self.por_titulo = (href,)
+        self._href_actual = href
+        self._texto_actual = []
+
+    def handle_data(self, data):
+        if self._texto_actual is not None:
+            self._texto_actual.append(data.strip())
+
+    def handle_endtag(self, tag):
+        if tag != "a" or self._texto_actual is None:
+            return
+        if self.por_texto is None and "".join(self._texto_actual) == TEXTO_SIGUIENTE:
+            self.por_texto = (self._href_actual,)
+        self._texto_actual = None
+
+
+def extraer_stream(html, limite=None):
+    """Tokeniza el HTML por trozos y se detiene en cuanto hay `limite` enlaces de producto.
+
+    Si se detiene antes del final, el resultado se marca como incompleto y el enlace a la
+    siguiente página queda sin determinar: quien lo pida sabe que ya tiene enlaces suficientes.
+    """
+    tokenizador = _TokenizadorEnlaces(limite)
+    for inicio in range(0, len(html), TAMANO_TROZO_STREAM):
+        tokenizador.feed(html[inicio:inicio + TAMANO_TROZO_STREAM])
+        if tokenizador.terminado:
+            return _resultado(tokenizador.links[:limite], None, completo=False)
+    tokenizador.close()
+    return _resultado(tokenizador.links, _elegir_siguiente(tokenizador.por_titulo, tokenizador.por_texto))
+
+
+BACKENDS = {
+    "stream": extraer_stream,
+    "bs4": extraer_bs4,
+    "lxml": extraer_lxml,
+    "selectolax": extraer_selectolax,
+}
+
+_MODULOS_BACKEND = {"bs4": "bs4", "lxml": "lxml.html", "selectolax": "selectolax.parser"}
+
+
+def backend_disponible(nombre):
+    """Indica si el backend existe y sus dependencias están instaladas."""
+    if nombre not in BACKENDS:
+        return False
+    modulo = _MODULOS_BACKEND.get(nombre)
+    if modulo is None:
+        return True
+    try:
+        __import__(modulo)
+        return True
+    except ImportError:
+        return False
+
+
+def obtener_extractor(nombre=None):
+    """Devuelve la función de extracción configurada, usando 'stream' si el backend pedido no está disponible."""
+    nombre = (nombre or SCRAPER_HTML_BACKEND).lower()
+    if not backend_disponible(nombre):
+        logger.warning(f"Backend de extracción '{nombre}' no disponible; se usa 'stream'")
+        nombre = "stream"
+    return BACKENDS[nombre]
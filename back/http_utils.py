@@ -0,0 +1,158 @@
+import os
+import logging
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+
+from comun.metricas import observar_http
+from trafico_utils import (
+    SCRAPER_RETRY_AFTER_MAX, obtener_limitador, obtener_cortocircuito, registrar_respuesta, registrar_error_transporte,
+)
+from comun.limitacion import CODIGOS_LIMITACION, segundos_retry_after
+
+# Tamaño del pool de conexiones: debe cubrir la concurrencia del scraper para no
+# abrir conexiones nuevas cuando todos los hilos descargan a la vez
+HTTP_POOL_SIZE = int(os.environ.get('SCRAPER_HTTP_POOL', os.environ.get('SCRAPER_MAX_CONCURRENCIA', 12)))
+HTTP_MAX_CONCURRENCIA_HOST = int(os.environ.get('SCRAPER_MAX_CONCURRENCIA_HOST', 6))
+HTTP_TIMEOUT = float(os.environ.get('SCRAPER_HTTP_TIMEOUT', 10))
+HTTP_REINTENTOS = int(os.environ.get('SCRAPER_HTTP_REINTENTOS', 3))
+HTTP_BACKOFF_BASE = float(os.environ.get('SCRAPER_HTTP_BACKOFF_BASE', 0.5))
+HTTP_BACKOFF_MAX = float(os.environ.get('SCRAPER_HTTP_BACKOFF_MAX', 8))
+# HTTP/2 es opcional: requiere httpx con el extra http2 instalado
+HTTP2_HABILITADO = os.environ.get('SCRAPER_HTTP2', '0').lower() in ('1', 'true', 'yes')
+
+# Códigos ante los que vale la pena reintentar: el servidor está saturado o nos limita
+CODIGOS_REINTENTABLES = {429, 500, 502, 503, 504}
+
+DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+    # gzip/deflate siempre; br solo si hay un decodificador de brotli instalado
+    "Accept-Encoding": make_headers(accept_encoding=True)["accept-encoding"],
+    "Connection": "keep-alive",
+}
+
+logger = logging.getLogger(__name__)
+
+_cliente = None
+_errores_transporte = (requests.exceptions.RequestException,)
+_cliente_lock = threading.Lock()
+_semaforos_hosts = {}
+_semaforos_hosts_lock = threading.Lock()
+
+
+def _crear_sesion_requests():
+    """Crea una sesión de requests con un pool de conexiones keep-alive dimensionado a la concurrencia."""
+    sesion = requests.Session()
+    adaptador = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, pool_block=True)
+    sesion.mount("https://", adaptador)
+    sesion.mount("http://", adaptador)
+    sesion.headers.update(DEFAULT_HEADERS)
+    return sesion
+
+
+def _crear_cliente_http2():
+    """Crea un cliente httpx con HTTP/2.
+
+    Devuelve (cliente, errores de transporte del cliente), o (None, None) si httpx/h2 no están instalados.
+    """
+    try:
+        import httpx
+        import h2  # noqa: F401 - httpx lo necesita para negociar HTTP/2
+    except ImportError:
+        logger.warning("SCRAPER_HTTP2 activo pero httpx[http2] no está instalado; se usa HTTP/1.1")
+        return None, None
+    limites = httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE)
+    cliente = httpx.Client(http2=True, limits=limites, headers=DEFAULT_HEADERS, follow_redirects=True)
+    return cliente, (httpx.HTTPError,)
+
+
+def obtener_cliente():
+    """Devuelve el cliente HTTP compartido por todo el proceso, creándolo la primera vez."""
+    global _cliente, _errores_transporte
+    if _cliente is None:
+        with _cliente_lock:
+            if _cliente is None:
+                cliente = None
+                if HTTP2_HABILITADO:
+                    cliente, errores = _crear_cliente_http2()
+                    if cliente is not None:
+                        _errores_transporte = errores
+                if cliente is None:
+                    cliente = _crear_sesion_requests()
+                _cliente = cliente
+                logger.info(f"Cliente HTTP inicializado ({type(cliente).__name__}, pool={HTTP_POOL_SIZE})")
+    return _cliente
+
+
+def _semaforo_host(host):
+    """Devuelve (creándolo si no existe) el semáforo que limita las descargas simultáneas a un host."""
+    with _semaforos_hosts_lock:
+        semaforo = _semaforos_hosts.get(host)
+        if semaforo is None:
+            semaforo = threading.BoundedSemaphore(HTTP_MAX_CONCURRENCIA_HOST)
+            _semaforos_hosts[host] = semaforo
+        return semaforo
+
+
+def calcular_espera(intento):
+    """Backoff exponencial con jitter completo para el intento indicado (empezando en 0)."""
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * (2 ** intento)))
+
+
+def obtener_pagina(url, headers=None, timeout=None, reintentos=None):
+    """Descarga una URL con el cliente compartido.
+
+    Cada intento espera su hueco en el limitador de tasa del host y se descarta al instante si
+    el cortocircuito del host está abierto. Reintenta con backoff exponencial y jitter ante
+    errores de red y respuestas 429/5xx, respetando Retry-After.
+    Devuelve la respuesta si el código es 200, o None si no se pudo obtener.
+    """
+    cliente = obtener_cliente()
+    reintentos = HTTP_REINTENTOS if reintentos is None else reintentos
+    timeout = HTTP_TIMEOUT if timeout is None else timeout
+    host = urlsplit(url).netloc
+    limitador = obtener_limitador(host)
+
+    for intento in range(reintentos):
+        if not obtener_cortocircuito(host).permitir():
+            logger.warning(f"Cortocircuito de {host} abierto; no se descarga {url}")
+            return None
+        # Esperar el hueco fuera del semáforo para no ocupar una plaza del host sin descargar
+        espera = limitador.reservar()
+        if espera > 0:
+            time.sleep(espera)
+        retry_after = None
+        try:
+            with _semaforo_host(host):
+                inicio = time.perf_counter()
+                try:
+                    response = cliente.get(url, headers=headers, timeout=timeout)
+                except _errores_transporte:
+                    observar_http(host, 'error', time.perf_counter() - inicio)
+                    registrar_error_transporte(host)
+                    raise
+                observar_http(host, response.status_code, time.perf_counter() - inicio)
+            if response.status_code in CODIGOS_LIMITACION:
+                retry_after = segundos_retry_after(response.headers.get('Retry-After'), SCRAPER_RETRY_AFTER_MAX)
+            registrar_respuesta(host, response.status_code, retry_after)
+            if response.status_code == 200:
+                return response
+            if response.status_code not in CODIGOS_REINTENTABLES:
+                logger.warning(f"Respuesta {response.status_code} al acceder a {url}; no se reintenta.")
+                return None
+            logger.warning(f"Respuesta {response.status_code} al acceder a {url} (Intento {intento + 1}/{reintentos})")
+        except _errores_transporte as e:
+            logger.warning(f"Error accediendo a {url} (Intento {intento + 1}/{reintentos}): {e}")
+
+        if intento + 1 < reintentos:
+            # Con Retry-After el limitador ya retrasa el siguiente hueco del host; si no, backoff
+            if retry_after is None:
+                time.sleep(calcular_espera(intento))
+
+    logger.error(f"No se pudo acceder a {url} después de {reintentos} intentos.")
+    return None
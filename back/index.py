@@ -1,11 +1,43 @@
+import os
 import json
 import logging
-import time
-import signal
 import sys
-from rabbitmq_utils import conectar_a_rabbitmq, configurar_consumidor, enviar_a_rabbitmq, enviar_a_peticiones_ia
-from rabbitmq_utils import QUEUE_SOLICITUDES, QUEUE_RESPUESTAS, setup_rabbitmq
-from database_utils import init_db_connection_pool, get_db_connection, release_db_connection
+from rabbitmq_utils import enviar_a_rabbitmq, enviar_a_peticiones_ia
+from rabbitmq_utils import QUEUE_SOLICITUDES, QUEUE_RESPUESTAS, QUEUE_PETICIONES_IA, setup_rabbitmq, obtener_publicador, enviar_lote
+from comun.consumidor import ConsumidorConcurrente, ConsumidorLotes, instalar_manejador_senales
+from comun.trazas import traza_mensaje, tramo, id_correlacion_actual, id_correlacion_de, nuevo_id_correlacion, iniciar_exportadores
+from database_utils import (
+    init_db_connection_pool, conexion_db, ConexionNoDisponible, notificar_cambio_formulario, CANAL_CAMBIOS_FORMULARIO,
+    comprobar_db
+)
+from comun.metricas import registrar_comprobacion
+
+# Ingesta por lotes: con más de 1, se agrupan hasta N solicitudes (o las que lleguen en T ms)
+# y se guardan en una sola transacción
+INGESTA_LOTE_TAMANO = int(os.environ.get('INGESTA_LOTE_TAMANO', 1))
+INGESTA_LOTE_ESPERA_MS = int(os.environ.get('INGESTA_LOTE_ESPERA_MS', 50))
+
+CAMPOS_TEST = (
+    'motivoCompra', 'fuenteInformacion', 'temasDeInteres', 'comprasNoNecesarias', 'importanciaMarca',
+    'probarNuevosProductos', 'aspiraciones', 'nivelSocial', 'tiempoLibre', 'identidad', 'tendencias'
+)
+CAMPOS_SOLICITUD = ('nombreUsuario', 'edad') + CAMPOS_TEST + ('comentarioSolicitud',)
+
+# Los tests son únicos por respuestas (columna generada `huella`, migración 0003): si la
+# combinación ya existe se reutiliza su fila en lugar de insertar otra copia
+_PARAMETROS_TEST = ', '.join(f'%({campo})s' for campo in CAMPOS_TEST)
+SQL_TEST_CANONICO = f"""
+    WITH nuevo AS (
+        INSERT INTO tests ({', '.join(CAMPOS_TEST)})
+        VALUES ({_PARAMETROS_TEST})
+        ON CONFLICT (huella) DO NOTHING
+        RETURNING id
+    )
+    SELECT id FROM nuevo
+    UNION ALL
+    SELECT id FROM tests WHERE huella = huella_test({_PARAMETROS_TEST})
+"""
+SQL_BUSCAR_TEST = f"SELECT id FROM tests WHERE huella = huella_test({_PARAMETROS_TEST})"
 
 # Configurar el logging
 logging.basicConfig(
@@ -16,108 +48,206 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
-# Bandera para controlar si el servicio sigue en ejecución
-running = True
+def reply_to_de(properties, data):
+    """Clave de la sesión del frontend que envió el formulario (`reply_to` del cuerpo o de la entrega), o None."""
+    reply_to = data.get('reply_to') if isinstance(data, dict) else None
+    return reply_to or getattr(properties, 'reply_to', None)
 
-def signal_handler(sig, frame):
-    """Manejador de señales para terminar el servicio correctamente"""
-    global running
-    logger.info("Recibida señal de terminación. Deteniendo servicio...")
-    running = False
+def perfil_para_ia(user_id, test_id, data, id_correlacion, reply_to=None):
+    """Mensaje para la cola de peticiones de IA a partir de los datos del formulario.
 
-# Registrar manejadores de señales
-signal.signal(signal.SIGINT, signal_handler)
-signal.signal(signal.SIGTERM, signal_handler)
+    `id_test` identifica la combinación de respuestas: es el mismo para perfiles idénticos.
+    `reply_to` viaja hasta el scraper para que publique las URLs en la ruta de esa sesión.
+    """
+    return {
+        'id_correlacion': id_correlacion,
+        'reply_to': reply_to,
+        'id_usuario': user_id,
+        'id_test': test_id,
+        'usuario': {
+            'id': user_id,
+            'nombreUsuario': data['nombreUsuario'],
+            'edad': data['edad']
+        },
+        'formulario': {campo: data[campo] for campo in CAMPOS_TEST},
+        'comentarioSolicitud': data['comentarioSolicitud']
+    }
+
+def respuesta_registro(user_id, data, id_correlacion):
+    return {
+        'id_correlacion': id_correlacion,
+        'id_usuario': user_id,
+        'nombre': data['nombreUsuario'],
+        'mensaje': f"Hola {data['nombreUsuario']}, tu información ha sido registrada correctamente."
+    }
+
+def obtener_test_canonico(cursor, data):
+    """ID del test con las respuestas de `data`; lo inserta si no existía."""
+    cursor.execute(SQL_TEST_CANONICO, data)
+    fila = cursor.fetchone()
+    if fila is None:
+        # Otra transacción lo insertó después de empezar la sentencia: ya está confirmado y es visible
+        cursor.execute(SQL_BUSCAR_TEST, data)
+        fila = cursor.fetchone()
+    return fila[0]
 
 def procesar_solicitud(ch, method, properties, body):
     try:
         data = json.loads(body)
         logger.info(f"Datos recibidos del formulario: {data}")
         
-        conn = get_db_connection()
-        if not conn:
-            logger.error("No se pudo conectar a la base de datos")
-            return
-            
-        cursor = conn.cursor()
-        
         try:
-            # Insertar usuario y obtener su ID
-            cursor.execute(
-                "INSERT INTO usuarios (nombreUsuario, edad) VALUES (%s, %s) RETURNING id",
-                (data['nombreUsuario'], data['edad'])
-            )
-            user_id = cursor.fetchone()[0]
-            logger.info(f"Usuario insertado con ID: {user_id}")
+            # El commit se hace al salir del bloque; ante un error se deshace la transacción
+            with tramo('db_registro'), conexion_db() as conn, conn.cursor() as cursor:
+                # Insertar usuario y obtener su ID
+                cursor.execute(
+                    "INSERT INTO usuarios (nombreUsuario, edad) VALUES (%s, %s) RETURNING id",
+                    (data['nombreUsuario'], data['edad'])
+                )
+                user_id = cursor.fetchone()[0]
+                logger.info(f"Usuario insertado con ID: {user_id}")
             
-            # Insertar test y obtener su ID
-            cursor.execute(
-                """INSERT INTO tests (motivoCompra, fuenteInformacion, temasDeInteres, comprasNoNecesarias, 
-                importanciaMarca, probarNuevosProductos, aspiraciones, nivelSocial, tiempoLibre, 
-                identidad, tendencias) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id""",
-                (data['motivoCompra'], data['fuenteInformacion'], data['temasDeInteres'], data['comprasNoNecesarias'],
-                data['importanciaMarca'], data['probarNuevosProductos'], data['aspiraciones'], data['nivelSocial'],
-                data['tiempoLibre'], data['identidad'], data['tendencias'])
-            )
-            test_id = cursor.fetchone()[0]
-            logger.info(f"Test insertado con ID: {test_id}")
+                # Obtener el test con estas respuestas, creándolo si es la primera vez
+                test_id = obtener_test_canonico(cursor, data)
+                logger.info(f"Test con ID: {test_id}")
             
-            # Insertar solicitud
-            cursor.execute(
-                "INSERT INTO solicitudes (userId, testsId, comentarioSolicitud) VALUES (%s, %s, %s)",
-                (user_id, test_id, data['comentarioSolicitud'])
-            )
-            
-            # Al enviar el perfil al servicio de IA, incluir el ID de usuario
-            perfil_usuario_ia = {
-                'id_usuario': user_id,  # Agregar el ID de usuario aquí
-                'usuario': {
-                    'id': user_id,
-                    'nombreUsuario': data['nombreUsuario'],
-                    'edad': data['edad']
-                },
-                'formulario': {
-                    'motivoCompra': data['motivoCompra'],
-                    'fuenteInformacion': data['fuenteInformacion'],
-                    'temasDeInteres': data['temasDeInteres'],
-                    'comprasNoNecesarias': data['comprasNoNecesarias'],
-                    'importanciaMarca': data['importanciaMarca'],
-                    'probarNuevosProductos': data['probarNuevosProductos'],
-                    'aspiraciones': data['aspiraciones'],
-                    'nivelSocial': data['nivelSocial'],
-                    'tiempoLibre': data['tiempoLibre'],
-                    'identidad': data['identidad'],
-                    'tendencias': data['tendencias']
-                }
-            }
+                # Insertar solicitud
+                cursor.execute(
+                    "INSERT INTO solicitudes (userId, testsId, comentarioSolicitud) VALUES (%s, %s, %s)",
+                    (user_id, test_id, data['comentarioSolicitud'])
+                )
+                notificar_cambio_formulario(cursor, user_id)
 
+            # Se publica tras el commit: el servicio de IA y el scraper ya encuentran la solicitud
+            perfil_usuario_ia = perfil_para_ia(user_id, test_id, data, id_correlacion_actual(), reply_to_de(properties, data))
             logger.info(f"Enviando perfil de usuario {user_id} al servicio de IA")
             if not enviar_a_peticiones_ia(perfil_usuario_ia):
                 logger.error(f"No se pudo enviar el perfil del usuario {user_id} al servicio de IA")
-
-            conn.commit()
-            
-            # Enviar mensaje de respuesta a la cola de respuestas
-            respuesta = {
-                'id_usuario': user_id,
-                'nombre': data['nombreUsuario'],
-                'mensaje': f"Hola {data['nombreUsuario']}, tu información ha sido registrada correctamente."
-            }
-            enviar_a_rabbitmq(json.dumps(respuesta), queue=QUEUE_RESPUESTAS)
-            
+        except ConexionNoDisponible as e:
+            logger.error(f"No se pudo conectar a la base de datos: {e}")
+            # Devolver el mensaje a la cola para que otro worker lo intente más tarde
+            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+            return
         except Exception as e:
             logger.error(f"Error procesando solicitud: {e}")
-            conn.rollback()
             raise
-        finally:
-            cursor.close()
-            conn.close()
+
+        # Enviar mensaje de respuesta a la cola de respuestas
+        enviar_a_rabbitmq(
+            json.dumps(respuesta_registro(user_id, data, id_correlacion_actual())),
+            queue=QUEUE_RESPUESTAS, reply_to=reply_to_de(properties, data)
+        )
+
+        ch.basic_ack(delivery_tag=method.delivery_tag)
 
     except Exception as e:
         logger.error(f"Error en procesar_solicitud: {e}")
         # Asegurarse de que el mensaje sea procesado
         ch.basic_ack(delivery_tag=method.delivery_tag)
 
+# Inserta un lote de formularios en una sola sentencia. Los IDs de usuario se reservan por fila
+# con nextval, así cada solicitud se enlaza con el suyo sin depender del orden de RETURNING; los
+# tests se insertan una vez por huella y, si ya existían, se reutilizan. Las claves foráneas se
+# comprueban al final de la sentencia, cuando ya existen las tres filas.
+SQL_INSERTAR_LOTE = """
+    WITH datos AS (
+        SELECT d.*,
+               nextval(pg_get_serial_sequence('usuarios', 'id')) AS user_id,
+               huella_test(d."motivoCompra", d."fuenteInformacion", d."temasDeInteres", d."comprasNoNecesarias",
+                           d."importanciaMarca", d."probarNuevosProductos", d.aspiraciones, d."nivelSocial",
+                           d."tiempoLibre", d.identidad, d.tendencias) AS huella
+        FROM jsonb_to_recordset(%(filas)s::jsonb) AS d(
+            orden INT, "nombreUsuario" VARCHAR, edad INT,
+            "motivoCompra" VARCHAR, "fuenteInformacion" VARCHAR, "temasDeInteres" VARCHAR,
+            "comprasNoNecesarias" VARCHAR, "importanciaMarca" VARCHAR, "probarNuevosProductos" VARCHAR,
+            aspiraciones VARCHAR, "nivelSocial" VARCHAR, "tiempoLibre" VARCHAR, identidad VARCHAR,
+            tendencias VARCHAR, "comentarioSolicitud" VARCHAR
+        )
+    ),
+    nuevos_usuarios AS (
+        INSERT INTO usuarios (id, nombreUsuario, edad)
+        SELECT user_id, "nombreUsuario", edad FROM datos
+    ),
+    nuevos_tests AS (
+        INSERT INTO tests (motivoCompra, fuenteInformacion, temasDeInteres, comprasNoNecesarias,
+                           importanciaMarca, probarNuevosProductos, aspiraciones, nivelSocial, tiempoLibre,
+                           identidad, tendencias)
+        SELECT DISTINCT ON (huella)
+               "motivoCompra", "fuenteInformacion", "temasDeInteres", "comprasNoNecesarias",
+               "importanciaMarca", "probarNuevosProductos", aspiraciones, "nivelSocial", "tiempoLibre",
+               identidad, tendencias
+        FROM datos
+        ON CONFLICT (huella) DO NOTHING
+        RETURNING id, huella
+    ),
+    -- Si otra transacción inserta la misma huella a la vez, no aparece en ninguna de las dos
+    -- ramas: testsId queda NULL, la sentencia falla y el lote se reprocesa mensaje a mensaje
+    tests_lote AS (
+        SELECT id, huella FROM nuevos_tests
+        UNION ALL
+        SELECT id, huella FROM tests WHERE huella IN (SELECT huella FROM datos)
+    ),
+    nuevas_solicitudes AS (
+        INSERT INTO solicitudes (userId, testsId, comentarioSolicitud)
+        SELECT d.user_id, t.id, d."comentarioSolicitud"
+        FROM datos d
+        LEFT JOIN tests_lote t ON t.huella = d.huella
+    )
+    SELECT d.orden, d.user_id, t.id, pg_notify(%(canal)s, d.user_id::text)
+    FROM datos d
+    LEFT JOIN tests_lote t ON t.huella = d.huella
+    ORDER BY d.orden
+"""
+
+def procesar_lote_solicitudes(ch, entregas):
+    """Guarda un lote de formularios en una transacción y confirma todas las entregas con un solo ack.
+
+    Los mensajes que no se pueden leer se descartan como en procesar_solicitud. Si el lote falla
+    por los datos de algún mensaje, se procesan uno a uno para no perder los demás.
+    """
+    ultimo_tag = entregas[-1][0].delivery_tag
+    validos = []
+    correlaciones = {}
+    sesiones = {}
+    for orden, (method, properties, body) in enumerate(entregas):
+        try:
+            data = json.loads(body)
+            validos.append((orden, {campo: data[campo] for campo in CAMPOS_SOLICITUD}))
+            correlaciones[orden] = id_correlacion_de(properties, data) or nuevo_id_correlacion()
+            sesiones[orden] = reply_to_de(properties, data)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.error(f"Mensaje {method.delivery_tag} descartado, formulario inválido: {e}")
+
+    ids = {}
+    if validos:
+        filas = [dict(data, orden=orden) for orden, data in validos]
+        try:
+            with tramo('db_registro_lote'), conexion_db() as conn, conn.cursor() as cursor:
+                cursor.execute(SQL_INSERTAR_LOTE, {'filas': json.dumps(filas), 'canal': CANAL_CAMBIOS_FORMULARIO})
+                ids = {orden: (user_id, test_id) for orden, user_id, test_id, _ in cursor.fetchall()}
+        except ConexionNoDisponible as e:
+            logger.error(f"No se pudo conectar a la base de datos: {e}")
+            # Devolver todo el lote a la cola para reintentarlo más tarde
+            ch.basic_nack(delivery_tag=ultimo_tag, multiple=True, requeue=True)
+            return
+        except Exception as e:
+            logger.warning(f"Error guardando un lote de {len(validos)} solicitudes: {e}. Se procesan una a una.")
+            for method, properties, body in entregas:
+                with traza_mensaje(QUEUE_SOLICITUDES, properties, registrar_espera=False):
+                    procesar_solicitud(ch, method, properties, body)
+            return
+
+    logger.info(f"Lote de {len(entregas)} mensajes: {len(ids)} solicitudes registradas")
+    mensajes = []
+    for orden, data in validos:
+        user_id, test_id = ids[orden]
+        mensajes.append((QUEUE_PETICIONES_IA, perfil_para_ia(user_id, test_id, data, correlaciones[orden], sesiones[orden])))
+        mensajes.append((QUEUE_RESPUESTAS, respuesta_registro(user_id, data, correlaciones[orden]), sesiones[orden]))
+    if not enviar_lote(mensajes):
+        logger.error(f"No se pudieron enviar los mensajes de un lote de {len(validos)} solicitudes")
+
+    ch.basic_ack(delivery_tag=ultimo_tag, multiple=True)
+
 def main():
     """Función principal"""
     logger.info("Iniciando servicio de backend con RabbitMQ...")
@@ -132,30 +262,25 @@ def main():
         logger.error("No se pudo inicializar la conexión a la base de datos. Saliendo...")
         sys.exit(1)
     
-    # Establecer conexión con RabbitMQ
-    conexion = conectar_a_rabbitmq()
-    if not conexion:
-        logger.error("No se pudo establecer conexión con RabbitMQ. Saliendo...")
-        sys.exit(1)
-    
-    canal = conexion.channel()
-    
-    # Configurar el consumidor para la cola de solicitudes
-    configurar_consumidor(canal, QUEUE_SOLICITUDES, procesar_solicitud)
-    
+    registrar_comprobacion('postgres', comprobar_db)
+    iniciar_exportadores('back')
+
+    if INGESTA_LOTE_TAMANO > 1:
+        consumidor = ConsumidorLotes(
+            QUEUE_SOLICITUDES, procesar_lote_solicitudes, INGESTA_LOTE_TAMANO, INGESTA_LOTE_ESPERA_MS,
+            nombre="Procesador de solicitudes"
+        )
+        logger.info(f"Ingesta por lotes de hasta {INGESTA_LOTE_TAMANO} solicitudes o {INGESTA_LOTE_ESPERA_MS} ms")
+    else:
+        # Consumir la cola de solicitudes con la ventana de prefetch y los workers configurados
+        consumidor = ConsumidorConcurrente(QUEUE_SOLICITUDES, procesar_solicitud, nombre="Procesador de solicitudes")
+    instalar_manejador_senales(consumidor)
+
     logger.info(f"Esperando mensajes en la cola '{QUEUE_SOLICITUDES}'. Para salir presiona CTRL+C")
-    
-    # Iniciar el bucle de consumo de RabbitMQ
     try:
-        while running:
-            conexion.process_data_events(time_limit=1)  # Procesar eventos con timeout para poder comprobar 'running'
-    except KeyboardInterrupt:
-        logger.info("Interrumpido por el usuario")
-    except Exception as e:
-        logger.error(f"Error en el bucle principal: {e}")
+        consumidor.ejecutar()
     finally:
-        if conexion and conexion.is_open:
-            conexion.close()
+        obtener_publicador().cerrar()
         logger.info("Servicio de backend finalizado")
 
 if __name__ == '__main__':
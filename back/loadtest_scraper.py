@@ -0,0 +1,161 @@
+"""Prueba de carga del reparto de búsquedas del scraper con peticiones grandes y pequeñas mezcladas.
+
+Genera llegadas de Poisson de peticiones de scraping (una fracción con muchas búsquedas, el resto
+con una) y las procesa con scrape_mercadolibre_colombia sustituyendo la descarga de cada búsqueda
+por una espera simulada. No necesita RabbitMQ, PostgreSQL ni red. Compara tres escenarios:
+
+    secuencial  una petición a la vez (prefetch 1, el comportamiento anterior)
+    fifo        varias peticiones a la vez, búsquedas atendidas en orden de llegada
+    justo       varias peticiones a la vez, búsquedas repartidas por turnos entre usuarios
+
+Para cada tipo de petición muestra p50/p99 del tiempo hasta el primer resultado y hasta el final.
+
+Uso:
+    python loadtest_scraper.py --peticiones 300 --por-segundo 15 --grandes 0.2 --latencia 0.05
+"""
+import time
+import queue
+import random
+import logging
+import argparse
+import threading
+
+import scraper
+from planificador import PlanificadorJusto
+
+
+def percentiles(valores):
+    valores = sorted(valores)
+    if not valores:
+        return float('nan'), float('nan')
+    p50 = valores[len(valores) // 2]
+    p99 = valores[min(len(valores) - 1, int(len(valores) * 0.99))]
+    return p50, p99
+
+
+def busqueda_simulada(paginas, latencia, semilla):
+    """Sustituto de scraper._scrape_busqueda: `paginas` descargas de unos `latencia` segundos."""
+    azar = random.Random(semilla)
+    lock_azar = threading.Lock()
+
+    def scrape_busqueda(busqueda_texto, max_products_per_search, urls_reclamadas, lock_reclamadas):
+        for _ in range(paginas):
+            with lock_azar:
+                espera = azar.uniform(0.5, 1.5) * latencia
+            time.sleep(espera)
+        return [f"https://articulo.mercadolibre.com.co/{busqueda_texto}-{i}" for i in range(max_products_per_search)]
+
+    return scrape_busqueda
+
+
+def generar_peticiones(total, por_segundo, fraccion_grandes, busquedas_grande, semilla):
+    """Lista de (instante de llegada, tipo, busquedas) con llegadas de Poisson."""
+    azar = random.Random(semilla)
+    instante = 0.0
+    peticiones = []
+    for i in range(total):
+        instante += azar.expovariate(por_segundo)
+        tipo = 'grande' if azar.random() < fraccion_grandes else 'pequena'
+        cantidad = busquedas_grande if tipo == 'grande' else 1
+        peticiones.append((instante, tipo, [f"p{i}-b{j}" for j in range(cantidad)]))
+    return peticiones
+
+
+def ejecutar_escenario(nombre, peticiones, simultaneas, hilos, reparto_justo):
+    """Procesa las peticiones con `simultaneas` hilos consumidores. Devuelve {tipo: [(primero, total)]}."""
+    anterior = scraper._planificador
+    scraper._planificador = PlanificadorJusto(hilos, nombre=f'loadtest-{nombre}')
+    pendientes = queue.Queue()
+    resultados = {'grande': [], 'pequena': []}
+    resultados_lock = threading.Lock()
+
+    def consumir():
+        while True:
+            peticion = pendientes.get()
+            if peticion is None:
+                return
+            llegada, tipo, busquedas, usuario = peticion
+            primero = []
+
+            def al_completar(busqueda, links):
+                if not primero:
+                    primero.append(time.perf_counter())
+
+            scraper.scrape_mercadolibre_colombia(
+                {'busquedas': busquedas}, max_products_per_search=3, al_completar_busqueda=al_completar,
+                clave=usuario if reparto_justo else 'todos'
+            )
+            fin = time.perf_counter()
+            with resultados_lock:
+                resultados[tipo].append((primero[0] - llegada, fin - llegada))
+
+    consumidores = [threading.Thread(target=consumir, daemon=True) for _ in range(simultaneas)]
+    for hilo in consumidores:
+        hilo.start()
+
+    inicio = time.perf_counter()
+    for usuario, (instante, tipo, busquedas) in enumerate(peticiones):
+        espera = inicio + instante - time.perf_counter()
+        if espera > 0:
+            time.sleep(espera)
+        pendientes.put((time.perf_counter(), tipo, busquedas, usuario))
+    for _ in consumidores:
+        pendientes.put(None)
+    for hilo in consumidores:
+        hilo.join()
+
+    scraper._planificador.cerrar()
+    scraper._planificador = anterior
+    return resultados
+
+
+def mostrar(nombre, resultados, segundos):
+    print(f"\n{nombre} ({segundos:.1f} s)")
+    for tipo, tiempos in resultados.items():
+        p50_primero, p99_primero = percentiles([primero for primero, _ in tiempos])
+        p50_total, p99_total = percentiles([total for _, total in tiempos])
+        print(
+            f"  {tipo:<8} n={len(tiempos):<4} primer resultado p50 {p50_primero:7.2f} s  p99 {p99_primero:7.2f} s"
+            f"   completa p50 {p50_total:7.2f} s  p99 {p99_total:7.2f} s"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mide la latencia del scraper con peticiones grandes y pequeñas mezcladas")
+    parser.add_argument('--peticiones', type=int, default=300)
+    parser.add_argument('--por-segundo', type=float, default=15, help="Llegadas de peticiones por segundo")
+    parser.add_argument('--grandes', type=float, default=0.2, help="Fracción de peticiones grandes")
+    parser.add_argument('--busquedas-grande', type=int, default=12)
+    parser.add_argument('--paginas', type=int, default=3, help="Páginas descargadas por búsqueda")
+    parser.add_argument('--latencia', type=float, default=0.05, help="Segundos medios por página")
+    parser.add_argument('--hilos', type=int, default=scraper.SCRAPER_MAX_CONCURRENCIA, help="Búsquedas simultáneas")
+    parser.add_argument('--simultaneas', type=int, default=scraper.SCRAPER_PETICIONES_SIMULTANEAS,
+                        help="Peticiones en curso a la vez en los escenarios fifo y justo")
+    parser.add_argument('--escenario', choices=('todos', 'secuencial', 'fifo', 'justo'), default='todos')
+    parser.add_argument('--semilla', type=int, default=1)
+    args = parser.parse_args()
+
+    # scraper.py registra cada petición a nivel INFO: no mezclarlo con los resultados
+    logging.getLogger().setLevel(logging.WARNING)
+    scraper._scrape_busqueda = busqueda_simulada(args.paginas, args.latencia, args.semilla)
+    peticiones = generar_peticiones(args.peticiones, args.por_segundo, args.grandes, args.busquedas_grande, args.semilla)
+    demanda = sum(len(busquedas) for _, _, busquedas in peticiones) * args.paginas * args.latencia
+    duracion = peticiones[-1][0]
+    print(f"{len(peticiones)} peticiones en {duracion:.1f} s; ocupación media de los {args.hilos} hilos: "
+          f"{demanda / (duracion * args.hilos):.0%}")
+
+    escenarios = {
+        'secuencial': (1, True),
+        'fifo': (args.simultaneas, False),
+        'justo': (args.simultaneas, True),
+    }
+    for nombre, (simultaneas, reparto_justo) in escenarios.items():
+        if args.escenario not in ('todos', nombre):
+            continue
+        inicio = time.perf_counter()
+        resultados = ejecutar_escenario(nombre, peticiones, simultaneas, args.hilos, reparto_justo)
+        mostrar(f"{nombre}/{simultaneas}", resultados, time.perf_counter() - inicio)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""Aplica las migraciones de esquema pendientes de la carpeta migrations/.
+
+Cada fichero NNNN_descripcion.sql es una versión. Las versiones aplicadas se registran en la
+tabla schema_migrations y un advisory lock impide que dos procesos migren a la vez. Un fichero
+cuya primera línea es `-- sin-transaccion` se ejecuta sentencia a sentencia en autocommit
+(necesario para CREATE INDEX CONCURRENTLY); el resto se aplica en una única transacción.
+
+Uso:
+    python migrate.py            # aplica las pendientes
+    python migrate.py --estado   # lista las versiones y si están aplicadas
+"""
+import os
+import re
+import sys
+import time
+import logging
+import argparse
+
+import psycopg2
+
+from database_utils import DB_CONFIG
+
+DIRECTORIO_MIGRACIONES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MARCA_SIN_TRANSACCION = '-- sin-transaccion'
+# Clave del advisory lock que serializa las migraciones entre procesos
+CLAVE_BLOQUEO = 7260401
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+class Migracion:
+    def __init__(self, version, ruta):
+        self.version = version
+        self.ruta = ruta
+        with open(ruta, encoding='utf-8') as f:
+            self.sql = f.read()
+        self.transaccional = not self.sql.lstrip().startswith(MARCA_SIN_TRANSACCION)
+
+    def sentencias(self):
+        """Sentencias del fichero sin comentarios. Solo para migraciones sin transacción (SQL simple)."""
+        sin_comentarios = re.sub(r'--[^\n]*', '', self.sql)
+        return [s.strip() for s in sin_comentarios.split(';') if s.strip()]
+
+
+def leer_migraciones(directorio=DIRECTORIO_MIGRACIONES):
+    """Devuelve las migraciones del directorio ordenadas por versión."""
+    migraciones = []
+    for nombre in sorted(os.listdir(directorio)):
+        if nombre.endswith('.sql'):
+            migraciones.append(Migracion(nombre[:-len('.sql')], os.path.join(directorio, nombre)))
+    return migraciones
+
+
+def ejecutar_migracion(conn, migracion, registrar=False):
+    """Ejecuta una migración en `conn` (en autocommit). Con `registrar`, la anota en schema_migrations.
+
+    En las migraciones transaccionales el registro va en la misma transacción que el cambio.
+    """
+    registro = "INSERT INTO schema_migrations (version) VALUES (%s)"
+    if migracion.transaccional:
+        conn.autocommit = False
+        try:
+            with conn, conn.cursor() as cursor:
+                cursor.execute(migracion.sql)
+                if registrar:
+                    cursor.execute(registro, (migracion.version,))
+        finally:
+            conn.autocommit = True
+        return
+    with conn.cursor() as cursor:
+        for sentencia in migracion.sentencias():
+            cursor.execute(sentencia)
+        if registrar:
+            cursor.execute(registro, (migracion.version,))
+
+
+def conectar(max_intentos=10, espera=3):
+    for intento in range(1, max_intentos + 1):
+        try:
+            conn = psycopg2.connect(connect_timeout=10, **DB_CONFIG)
+            conn.autocommit = True
+            return conn
+        except psycopg2.OperationalError as e:
+            logger.warning(f"Intento {intento}/{max_intentos} de conectar a PostgreSQL fallido: {e}")
+            time.sleep(espera)
+    raise RuntimeError("No se pudo conectar a PostgreSQL para aplicar migraciones")
+
+
+def versiones_aplicadas(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version VARCHAR(200) PRIMARY KEY,
+                aplicada_en TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cursor.execute("SELECT version FROM schema_migrations")
+        return {fila[0] for fila in cursor.fetchall()}
+
+
+def aplicar_migraciones(directorio=DIRECTORIO_MIGRACIONES):
+    """Aplica en orden las migraciones pendientes. Devuelve las versiones aplicadas."""
+    conn = conectar()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_lock(%s)", (CLAVE_BLOQUEO,))
+        aplicadas = versiones_aplicadas(conn)
+        nuevas = []
+        for migracion in leer_migraciones(directorio):
+            if migracion.version in aplicadas:
+                continue
+            logger.info(f"Aplicando migración {migracion.version}...")
+            inicio = time.perf_counter()
+            ejecutar_migracion(conn, migracion, registrar=True)
+            logger.info(f"Migración {migracion.version} aplicada en {time.perf_counter() - inicio:.1f} s")
+            nuevas.append(migracion.version)
+        if not nuevas:
+            logger.info("El esquema está al día")
+        return nuevas
+    finally:
+        conn.close()  # cierra la sesión y libera el advisory lock
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migraciones de esquema de PostgreSQL")
+    parser.add_argument('--estado', action='store_true', help="Lista las migraciones sin aplicar nada")
+    args = parser.parse_args()
+
+    if args.estado:
+        conn = conectar()
+        try:
+            aplicadas = versiones_aplicadas(conn)
+        finally:
+            conn.close()
+        for migracion in leer_migraciones():
+            print(f"{'[x]' if migracion.version in aplicadas else '[ ]'} {migracion.version}")
+        return
+
+    try:
+        aplicar_migraciones()
+    except Exception as e:
+        logger.error(f"Error aplicando migraciones: {e}", exc_info=True)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
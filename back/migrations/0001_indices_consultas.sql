@@ -0,0 +1,11 @@
+-- sin-transaccion
+-- Índices para los accesos más frecuentes. CONCURRENTLY no bloquea escrituras mientras se
+-- construyen, pero no puede ir dentro de una transacción.
+
+-- Última solicitud de un usuario: WHERE userId = ? ORDER BY id DESC LIMIT 1 (API y scraper)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_solicitudes_userid_id
+    ON solicitudes (userId, id DESC);
+
+-- URLs de una solicitud ordenadas por fecha (API)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_urls_encontradas_solicitud_fecha
+    ON urls_encontradas (solicitud_id, fecha_creacion DESC);
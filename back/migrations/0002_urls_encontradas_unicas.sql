@@ -0,0 +1,12 @@
+-- Una URL aparece como mucho una vez por solicitud: permite el upsert con ON CONFLICT del
+-- scraper, y el índice único también sirve al DELETE ... WHERE solicitud_id = ?
+
+-- Eliminar duplicados existentes, conservando la fila más antigua
+DELETE FROM urls_encontradas a
+USING urls_encontradas b
+WHERE a.solicitud_id = b.solicitud_id
+  AND a.url = b.url
+  AND a.id > b.id;
+
+ALTER TABLE urls_encontradas
+    ADD CONSTRAINT uq_urls_encontradas_solicitud_url UNIQUE (solicitud_id, url);
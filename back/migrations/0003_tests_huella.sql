@@ -0,0 +1,27 @@
+-- Un único registro en tests por combinación de respuestas: las solicitudes con las mismas
+-- respuestas comparten testsId. La huella (md5 de las respuestas) se calcula en la propia
+-- columna, así ninguna escritura puede dejarla desalineada con los datos.
+
+CREATE OR REPLACE FUNCTION huella_test(VARIADIC respuestas TEXT[]) RETURNS TEXT
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE
+    AS $$ SELECT md5(array_to_string(respuestas, chr(31))) $$;
+
+ALTER TABLE tests ADD COLUMN huella TEXT GENERATED ALWAYS AS (
+    huella_test(motivoCompra, fuenteInformacion, temasDeInteres, comprasNoNecesarias, importanciaMarca,
+                probarNuevosProductos, aspiraciones, nivelSocial, tiempoLibre, identidad, tendencias)
+) STORED;
+
+-- Apuntar cada solicitud al test más antiguo con sus mismas respuestas...
+UPDATE solicitudes s
+SET testsId = c.canonico
+FROM (SELECT id, min(id) OVER (PARTITION BY huella) AS canonico FROM tests) c
+WHERE s.testsId = c.id
+  AND c.id <> c.canonico;
+
+-- ...y borrar los duplicados, que ya no tienen solicitudes (la FK borra en cascada)
+DELETE FROM tests t
+USING tests o
+WHERE o.huella = t.huella
+  AND o.id < t.id;
+
+ALTER TABLE tests ADD CONSTRAINT uq_tests_huella UNIQUE (huella);
@@ -0,0 +1,46 @@
+-- Estado compartido del limitador de tasa por host del scraper (SCRAPER_LIMITE_COMPARTIDO=postgres).
+-- Los instantes son segundos epoch de clock_timestamp(): todas las réplicas usan el reloj del
+-- servidor, así no importa que los de las máquinas del scraper no estén sincronizados.
+
+CREATE TABLE IF NOT EXISTS limites_hosts (
+    host TEXT PRIMARY KEY,
+    tasa DOUBLE PRECISION NOT NULL,
+    tat DOUBLE PRECISION NOT NULL DEFAULT 0,
+    bloqueado_hasta DOUBLE PRECISION NOT NULL DEFAULT 0,
+    ultima_reduccion DOUBLE PRECISION NOT NULL DEFAULT 0
+);
+
+-- Reserva el siguiente hueco del host (GCRA) y devuelve los segundos que hay que esperar.
+-- Antes aplica el aumento aditivo de los `exitos` que la réplica acumuló desde su última reserva.
+-- El FOR UPDATE serializa las reservas concurrentes del mismo host sin bloquear a los demás.
+CREATE OR REPLACE FUNCTION reservar_hueco_host(
+    p_host TEXT, p_tasa DOUBLE PRECISION, p_maxima DOUBLE PRECISION, p_rafaga INTEGER,
+    p_exitos INTEGER, p_aumento DOUBLE PRECISION,
+    OUT o_espera DOUBLE PRECISION, OUT o_tasa DOUBLE PRECISION
+) LANGUAGE plpgsql AS $$
+DECLARE
+    ahora DOUBLE PRECISION := extract(epoch FROM clock_timestamp());
+    fila limites_hosts%ROWTYPE;
+    intervalo DOUBLE PRECISION;
+    teorico DOUBLE PRECISION;
+    salida DOUBLE PRECISION;
+BEGIN
+    INSERT INTO limites_hosts (host, tasa) VALUES (p_host, p_tasa) ON CONFLICT (host) DO NOTHING;
+    SELECT * INTO fila FROM limites_hosts WHERE host = p_host FOR UPDATE;
+
+    FOR i IN 1..p_exitos LOOP
+        fila.tasa := LEAST(p_maxima, fila.tasa + p_aumento / fila.tasa);
+    END LOOP;
+
+    intervalo := 1 / fila.tasa;
+    teorico := GREATEST(fila.tat, ahora);
+    salida := GREATEST(teorico - (p_rafaga - 1) * intervalo, ahora, fila.bloqueado_hasta);
+
+    UPDATE limites_hosts
+    SET tasa = fila.tasa, tat = GREATEST(teorico, salida) + intervalo
+    WHERE host = p_host;
+
+    o_espera := salida - ahora;
+    o_tasa := fila.tasa;
+END;
+$$;
@@ -0,0 +1,8 @@
+-- Caché compartida de páginas de resultados del scraper (SCRAPER_CACHE_COMPARTIDO=postgres).
+-- Clave: slug normalizado de la búsqueda + desplazamiento de la página.
+
+CREATE TABLE IF NOT EXISTS cache_busquedas (
+    clave VARCHAR(600) PRIMARY KEY,
+    valor JSONB NOT NULL,
+    expira_en TIMESTAMP NOT NULL
+);
@@ -0,0 +1,5 @@
+-- sin-transaccion
+-- La purga de cache_busquedas borra por expira_en (caducadas y, por encima del máximo, las más
+-- antiguas): sin índice cada purga recorrería la tabla entera.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_cache_busquedas_expira_en
+    ON cache_busquedas (expira_en);
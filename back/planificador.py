@@ -0,0 +1,170 @@
+"""Reparto justo de las búsquedas del scraper entre usuarios.
+
+Cada petición de scraping se divide en unidades de trabajo, una por búsqueda, que se encolan
+bajo la clave de su usuario. Los usuarios con trabajo pendiente se atienden por turnos
+(round-robin): cada hueco que queda libre se da a la siguiente unidad del siguiente usuario, de
+modo que una petición de una búsqueda no espera a que termine otra de doce que llegó antes; como
+mucho espera a una unidad de cada usuario activo.
+
+PlanificadorJusto lo usa el runtime bloqueante (un pool de hilos propio) y PlanificadorJustoAsync
+el runtime asyncio (limita las búsquedas activas y cede los huecos con el mismo criterio).
+"""
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from contextlib import asynccontextmanager
+
+from prometheus_client import Gauge, Histogram
+
+UNIDADES_PENDIENTES = Gauge(
+    'scraper_unidades_pendientes', 'Búsquedas en espera de un hueco en el planificador',
+    multiprocess_mode='livesum'
+)
+USUARIOS_PENDIENTES = Gauge(
+    'scraper_usuarios_pendientes', 'Usuarios con búsquedas en espera en el planificador',
+    multiprocess_mode='livesum'
+)
+ESPERA_UNIDAD = Histogram(
+    'scraper_espera_unidad_segundos', 'Tiempo que una búsqueda espera en el planificador antes de empezar',
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+)
+
+
+class _Turnos:
+    """Colas por clave atendidas por turnos. No es segura entre hilos: la protege quien la usa."""
+
+    def __init__(self):
+        self._colas = OrderedDict()
+        self.total = 0
+
+    def __bool__(self):
+        return self.total > 0
+
+    def agregar(self, clave, elemento):
+        self._colas.setdefault(clave, deque()).append(elemento)
+        self.total += 1
+        self._actualizar_metricas(1)
+
+    def siguiente(self):
+        """Saca el primer elemento de la clave a la que le toca y la pasa al final del turno."""
+        clave, cola = next(iter(self._colas.items()))
+        elemento = cola.popleft()
+        if cola:
+            self._colas.move_to_end(clave)
+        else:
+            del self._colas[clave]
+        self.total -= 1
+        self._actualizar_metricas(-1)
+        return elemento
+
+    def _actualizar_metricas(self, cambio):
+        UNIDADES_PENDIENTES.inc(cambio)
+        USUARIOS_PENDIENTES.set(len(self._colas))
+
+
+class PlanificadorJusto:
+    """Pool de `hilos` hilos que ejecuta las unidades enviadas con enviar() repartiéndolas por clave.
+
+    enviar() devuelve un concurrent.futures.Future, así que se puede esperar con as_completed
+    igual que las tareas de un ThreadPoolExecutor. Cada unidad se ejecuta con una copia del
+    contexto de quien la envió (id de correlación y span padre).
+    """
+
+    def __init__(self, hilos, nombre='planificador'):
+        self._turnos = _Turnos()
+        self._condicion = threading.Condition()
+        self._cerrado = False
+        self._hilos = [
+            threading.Thread(target=self._trabajar, name=f'{nombre}-{i}', daemon=True) for i in range(hilos)
+        ]
+        for hilo in self._hilos:
+            hilo.start()
+
+    def enviar(self, clave, funcion, *args):
+        futuro = Future()
+        unidad = (futuro, contextvars.copy_context(), funcion, args, time.perf_counter())
+        with self._condicion:
+            if self._cerrado:
+                raise RuntimeError('El planificador está cerrado')
+            self._turnos.agregar(clave, unidad)
+            self._condicion.notify()
+        return futuro
+
+    def pendientes(self):
+        with self._condicion:
+            return self._turnos.total
+
+    def _trabajar(self):
+        while True:
+            with self._condicion:
+                while not self._turnos and not self._cerrado:
+                    self._condicion.wait()
+                if not self._turnos:
+                    return
+                futuro, contexto, funcion, args, encolado = self._turnos.siguiente()
+            if not futuro.set_running_or_notify_cancel():
+                continue
+            ESPERA_UNIDAD.observe(time.perf_counter() - encolado)
+            try:
+                futuro.set_result(contexto.run(funcion, *args))
+            except BaseException as e:
+                futuro.set_exception(e)
+
+    def cerrar(self, esperar=True):
+        """No acepta más unidades; los hilos terminan al vaciar las pendientes."""
+        with self._condicion:
+            self._cerrado = True
+            self._condicion.notify_all()
+        if esperar:
+            for hilo in self._hilos:
+                hilo.join()
+        logging.info(f"Planificador cerrado ({len(self._hilos)} hilos)")
+
+
+class PlanificadorJustoAsync:
+    """Limita a `limite` las búsquedas activas del event loop y cede cada hueco por turnos entre claves.
+
+    Uso: `async with planificador.turno(clave): ...`. Los huecos se ceden en el orden de los
+    turnos por clave en vez de en el orden de llegada de un asyncio.Semaphore.
+    """
+
+    def __init__(self, limite):
+        self._libres = limite
+        self._turnos = _Turnos()
+
+    @asynccontextmanager
+    async def turno(self, clave):
+        await self._adquirir(clave)
+        try:
+            yield
+        finally:
+            self._liberar()
+
+    async def _adquirir(self, clave):
+        if self._libres > 0 and not self._turnos:
+            self._libres -= 1
+            ESPERA_UNIDAD.observe(0)
+            return
+        futuro = asyncio.get_running_loop().create_future()
+        encolado = time.perf_counter()
+        self._turnos.agregar(clave, futuro)
+        try:
+            await futuro
+        except asyncio.CancelledError:
+            # Si el hueco ya se le había cedido, devolverlo; si no, _liberar saltará este futuro
+            if futuro.done() and not futuro.cancelled():
+                self._liberar()
+            raise
+        ESPERA_UNIDAD.observe(time.perf_counter() - encolado)
+
+    def _liberar(self):
+        while self._turnos:
+            futuro = self._turnos.siguiente()
+            if not futuro.done():
+                futuro.set_result(None)
+                return
+        self._libres += 1
@@ -1,14 +1,13 @@
 import pika
 import logging
-import time
 import os
+import re
 import json
-
-# Obtener configuración de variables de entorno o usar valores predeterminados
-RABBITMQ_HOST = os.environ.get('RABBITMQ_HOST', 'rabbitmq')
-RABBITMQ_PORT = int(os.environ.get('RABBITMQ_PORT', 5672))
-RABBITMQ_USER = os.environ.get('RABBITMQ_USER', 'guest')
-RABBITMQ_PASS = os.environ.get('RABBITMQ_PASS', 'guest')
+from comun import publicador
+from comun.trazas import cabeceras_traza
+# La conexión, los consumidores y el publicador son comunes con el servicio de IA (comun/)
+from comun.consumidor import conectar_a_rabbitmq
+from comun.publicador import esperar_confirmaciones
 
 # Nombre de las colas
 QUEUE_SOLICITUDES = 'solicitudes'
@@ -18,81 +17,87 @@ QUEUE_SCRAPED_URLS = 'scraped_urls_queue'
 
 # Configuración de intercambio de mensajes
 EXCHANGE_NAME = 'formularios'
+# Exchange topic de resultados por sesión del frontend: routing key 'sesion.<reply_to>.<cola>'
+EXCHANGE_RESULTADOS = os.environ.get('RABBITMQ_EXCHANGE_RESULTADOS', 'resultados')
+_REPLY_TO_VALIDO = re.compile(r'[A-Za-z0-9_-]{8,64}')
+
+def _serializar(mensaje):
+    return mensaje if isinstance(mensaje, str) else json.dumps(mensaje)
+
+def ruta_sesion(reply_to, cola):
+    """Routing key en EXCHANGE_RESULTADOS de los mensajes de `cola` para la sesión `reply_to`.
+
+    Devuelve None si no hay `reply_to` o no es una clave válida (8 a 64 letras, dígitos, '-' o '_'):
+    en ese caso el mensaje va a la cola compartida, como antes de existir las rutas por sesión.
+    """
+    if isinstance(reply_to, str) and _REPLY_TO_VALIDO.fullmatch(reply_to):
+        return f'sesion.{reply_to}.{cola}'
+    return None
+
+def obtener_publicador():
+    """Devuelve el publicador compartido del proceso (comun/publicador.py), que declara la topología en cada canal."""
+    return publicador.obtener_publicador(topologia=declarar_topologia)
 
-def get_connection_params():
-    """Obtiene los parámetros de conexión a RabbitMQ"""
-    return pika.ConnectionParameters(
-        host=RABBITMQ_HOST,
-        port=RABBITMQ_PORT,
-        credentials=pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS),
-        heartbeat=600,
-        blocked_connection_timeout=300
+def publicar(mensaje, queue, exchange=None, routing_key='', reply_to=None):
+    """Publica un mensaje persistente en una cola (o en un exchange vinculado a ella) sin esperar al broker.
+
+    Con un `reply_to` válido se publica en la ruta de esa sesión (ver ruta_sesion) en lugar de en `queue`.
+    Devuelve un Future que se resuelve cuando el broker confirma el mensaje y falla con
+    PublicacionFallida si no se pudo entregar; se esperan varios a la vez con esperar_confirmaciones.
+    """
+    propiedades = pika.BasicProperties(
+        delivery_mode=2,  # Hacer que el mensaje sea persistente
+        content_type='application/json',
+        headers=cabeceras_traza(mensaje)
+    )
+    ruta = ruta_sesion(reply_to, queue)
+    if ruta:
+        # Solo lo recibe la sesión que lo pidió. Sin mandatory: si ya se cerró, el broker lo descarta
+        return obtener_publicador().publicar(
+            _serializar(mensaje), ruta, exchange=EXCHANGE_RESULTADOS, propiedades=propiedades, mandatory=False
+        )
+    return obtener_publicador().publicar(
+        _serializar(mensaje),
+        (routing_key or queue) if exchange else queue,
+        exchange=exchange or '',
+        propiedades=propiedades,
+        cola=queue
     )
 
+def _enviar(mensaje, queue, exchange=None, routing_key='', reply_to=None):
+    """Publica un mensaje y espera su confirmación. Devuelve True si el broker lo aceptó."""
+    destino = ruta_sesion(reply_to, queue) or queue
+    fallos = esperar_confirmaciones([publicar(mensaje, queue, exchange=exchange, routing_key=routing_key, reply_to=reply_to)])
+    if fallos:
+        logging.error(f"Error al enviar mensaje a {destino}: {fallos[0][1]}")
+        return False
+    logging.info(f"Mensaje enviado a RabbitMQ ({destino}): {mensaje}")
+    return True
+
 # Función para enviar mensajes a RabbitMQ
-def enviar_a_rabbitmq(mensaje, queue=QUEUE_SOLICITUDES, exchange=None, routing_key=''):
-    try:
-        # Conexión a RabbitMQ
-        conexion = pika.BlockingConnection(get_connection_params())
-        canal = conexion.channel()
-        
-        # Si se especifica un exchange, declararlo
-        if exchange:
-            canal.exchange_declare(exchange=exchange, exchange_type='direct', durable=True)
-            
-            # Declarar la cola (asegura que exista)
-            canal.queue_declare(queue=queue, durable=True)
-            
-            # Vincular cola al exchange
-            canal.queue_bind(exchange=exchange, queue=queue, routing_key=routing_key)
-            
-            # Publicar el mensaje al exchange
-            canal.basic_publish(
-                exchange=exchange,
-                routing_key=routing_key or queue,
-                body=mensaje if isinstance(mensaje, str) else json.dumps(mensaje),
-                properties=pika.BasicProperties(
-                    delivery_mode=2,  # Hacer que el mensaje sea persistente
-                    content_type='application/json'
-                )
-            )
-        else:
-            # Declarar la cola (asegura que exista)
-            canal.queue_declare(queue=queue, durable=True)
-
-            # Publicar el mensaje directamente a la cola
-            canal.basic_publish(
-                exchange='',
-                routing_key=queue,
-                body=mensaje if isinstance(mensaje, str) else json.dumps(mensaje),
-                properties=pika.BasicProperties(
-                    delivery_mode=2,  # Hacer que el mensaje sea persistente
-                    content_type='application/json'
-                )
-            )
-        
-        logging.info(f"Mensaje enviado a RabbitMQ ({queue}): {mensaje}")
-        conexion.close()
-    except Exception as e:
-        logging.error(f"Error al enviar mensaje a RabbitMQ: {e}")
-
-# Función para establecer conexión con RabbitMQ con reintentos
-def conectar_a_rabbitmq(max_intentos=5, tiempo_espera=5):
-    intentos = 0
-    while intentos < max_intentos:
-        try:
-            conexion = pika.BlockingConnection(get_connection_params())
-            logging.info("Conexión establecida con RabbitMQ")
-            return conexion
-        except Exception as e:
-            intentos += 1
-            logging.error(f"Intento {intentos}/{max_intentos} fallido al conectar con RabbitMQ: {e}")
-            if intentos < max_intentos:
-                logging.info(f"Reintentando en {tiempo_espera} segundos...")
-                time.sleep(tiempo_espera)
-    
-    logging.error("No se pudo establecer conexión con RabbitMQ después de varios intentos")
-    return None
+def enviar_a_rabbitmq(mensaje, queue=QUEUE_SOLICITUDES, exchange=None, routing_key='', reply_to=None):
+    return _enviar(mensaje, queue, exchange=exchange, routing_key=routing_key, reply_to=reply_to)
+
+# Colas que forman parte de la topología fija del sistema
+COLAS_TOPOLOGIA = (QUEUE_SOLICITUDES, QUEUE_RESPUESTAS, QUEUE_PETICIONES_IA, QUEUE_SCRAPED_URLS)
+
+def declarar_topologia(canal):
+    """Declara el exchange, las colas y los vínculos del sistema sobre un canal abierto"""
+    # Configurar exchange
+    canal.exchange_declare(exchange=EXCHANGE_NAME, exchange_type='direct', durable=True)
+    # Cada sesión del frontend se suscribe por WebSTOMP a /exchange/resultados/sesion.<clave>.<cola>,
+    # que crea una cola exclusiva que se borra al desconectarse
+    canal.exchange_declare(exchange=EXCHANGE_RESULTADOS, exchange_type='topic', durable=True)
+
+    # Configurar colas
+    for cola in COLAS_TOPOLOGIA:
+        canal.queue_declare(queue=cola, durable=True)
+
+    # Vincular colas a exchange
+    canal.queue_bind(exchange=EXCHANGE_NAME, queue=QUEUE_SOLICITUDES, routing_key=QUEUE_SOLICITUDES)
+    canal.queue_bind(exchange=EXCHANGE_NAME, queue=QUEUE_RESPUESTAS, routing_key=QUEUE_RESPUESTAS)
+    # No es necesario vincular QUEUE_PETICIONES_IA al exchange 'formularios' si se va a usar de forma directa
+    # o con otro exchange específico. Por ahora, la dejaremos sin vincular a este exchange.
 
 # Configurar intercambios y colas necesarios
 def setup_rabbitmq():
@@ -104,21 +109,7 @@ def setup_rabbitmq():
             return False
             
         canal = conexion.channel()
-        
-        # Configurar exchange
-        canal.exchange_declare(exchange=EXCHANGE_NAME, exchange_type='direct', durable=True)
-        
-        # Configurar colas
-        canal.queue_declare(queue=QUEUE_SOLICITUDES, durable=True)
-        canal.queue_declare(queue=QUEUE_RESPUESTAS, durable=True)
-        canal.queue_declare(queue=QUEUE_PETICIONES_IA, durable=True)
-        canal.queue_declare(queue=QUEUE_SCRAPED_URLS, durable=True)
-        
-        # Vincular colas a exchange
-        canal.queue_bind(exchange=EXCHANGE_NAME, queue=QUEUE_SOLICITUDES, routing_key=QUEUE_SOLICITUDES)
-        canal.queue_bind(exchange=EXCHANGE_NAME, queue=QUEUE_RESPUESTAS, routing_key=QUEUE_RESPUESTAS)
-        # No es necesario vincular QUEUE_PETICIONES_IA al exchange 'formularios' si se va a usar de forma directa
-        # o con otro exchange específico. Por ahora, la dejaremos sin vincular a este exchange.
+        declarar_topologia(canal)
         
         conexion.close()
         logging.info("RabbitMQ configurado correctamente")
@@ -127,65 +118,29 @@ def setup_rabbitmq():
         logging.error(f"Error al configurar RabbitMQ: {e}")
         return False
 
-# Función para consumir mensajes de una cola
-def configurar_consumidor(canal, cola, callback):
-    canal.queue_declare(queue=cola, durable=True)
-    canal.basic_qos(prefetch_count=1)
-    canal.basic_consume(queue=cola, on_message_callback=callback)
-    logging.info(f"Consumidor configurado para la cola: {cola}")
-
 # Función para enviar mensajes a la cola de peticiones de IA
 def enviar_a_peticiones_ia(mensaje):
     """Envía un mensaje a la cola de peticiones de IA."""
-    try:
-        conexion = pika.BlockingConnection(get_connection_params())
-        canal = conexion.channel()
-
-        # Declarar la cola (asegura que exista)
-        canal.queue_declare(queue=QUEUE_PETICIONES_IA, durable=True)
-
-        # Publicar el mensaje directamente a la cola
-        canal.basic_publish(
-            exchange='', # Publicación directa a la cola
-            routing_key=QUEUE_PETICIONES_IA,
-            body=mensaje if isinstance(mensaje, str) else json.dumps(mensaje),
-            properties=pika.BasicProperties(
-                delivery_mode=2,  # Hacer que el mensaje sea persistente
-                content_type='application/json'
-            )
-        )
-        logging.info(f"Mensaje enviado a RabbitMQ ({QUEUE_PETICIONES_IA}): {mensaje}")
-        conexion.close()
-        return True
-    except Exception as e:
-        logging.error(f"Error al enviar mensaje a {QUEUE_PETICIONES_IA}: {e}")
-        return False
+    return _enviar(mensaje, QUEUE_PETICIONES_IA)
 
 # Función para enviar mensajes a la cola de URLs scrapeadas
-def enviar_a_scraped_urls(mensaje):
-    """Envía un mensaje a la cola de URLs scrapeadas."""
-    try:
-        conexion = pika.BlockingConnection(get_connection_params())
-        canal = conexion.channel()
+def enviar_a_scraped_urls(mensaje, reply_to=None):
+    """Envía un mensaje a la cola de URLs scrapeadas, o a la ruta de la sesión `reply_to` si se indica."""
+    return _enviar(mensaje, QUEUE_SCRAPED_URLS, reply_to=reply_to)
 
-        # Declarar la cola (asegura que exista)
-        # La declaración ya se hace en setup_rabbitmq, pero es bueno tenerla aquí por si acaso
-        # y para mantener consistencia con otras funciones de envío.
-        canal.queue_declare(queue=QUEUE_SCRAPED_URLS, durable=True)
-
-        # Publicar el mensaje directamente a la cola
-        canal.basic_publish(
-            exchange='', # Publicación directa a la cola
-            routing_key=QUEUE_SCRAPED_URLS,
-            body=mensaje if isinstance(mensaje, str) else json.dumps(mensaje),
-            properties=pika.BasicProperties(
-                delivery_mode=2,  # Hacer que el mensaje sea persistente
-                content_type='application/json'
-            )
-        )
-        logging.info(f"Mensaje enviado a RabbitMQ ({QUEUE_SCRAPED_URLS}): {mensaje}")
-        conexion.close()
-        return True
-    except Exception as e:
-        logging.error(f"Error al enviar mensaje a {QUEUE_SCRAPED_URLS}: {e}")
-        return False
\ No newline at end of file
+# Función para enviar varios mensajes en un solo lote
+def enviar_lote(mensajes):
+    """Envía una lista de (queue, mensaje[, reply_to]) seguidos y espera sus confirmaciones juntas.
+
+    Devuelve False si alguno no se pudo entregar; cada fallo se registra con su destino.
+    """
+    mensajes = list(mensajes)
+    fallos = esperar_confirmaciones([publicar(mensaje, queue, None, '', *reply_to) for queue, mensaje, *reply_to in mensajes])
+    for indice, error in fallos:
+        queue, _, *reply_to = mensajes[indice]
+        destino = (ruta_sesion(reply_to[0], queue) if reply_to else None) or queue
+        logging.error(f"Error al enviar el mensaje {indice + 1}/{len(mensajes)} del lote a {destino}: {error}")
+    if fallos:
+        return False
+    logging.info(f"Lote de {len(mensajes)} mensajes enviado a RabbitMQ")
+    return True
@@ -1,13 +1,19 @@
-import requests
-from bs4 import BeautifulSoup
 import os
 import logging
-import pika
 import json
-import time
 import sys
+import threading
+from concurrent.futures import as_completed
 from rabbitmq_utils import enviar_a_scraped_urls, QUEUE_SCRAPED_URLS
-from database_utils import get_db_connection, init_db_connection_pool
+from rabbitmq_utils import obtener_publicador, publicar, esperar_confirmaciones
+from comun.consumidor import ConsumidorConcurrente, instalar_manejador_senales
+from database_utils import conexion_db, init_db_connection_pool, notificar_cambio_formulario, comprobar_db
+from comun.metricas import registrar_comprobacion
+from http_utils import obtener_cliente, obtener_pagina
+from cache_utils import CacheBusquedas
+from extraction_utils import obtener_extractor
+from planificador import PlanificadorJusto
+from comun.trazas import tramo, medir_etapa, id_correlacion_actual, iniciar_exportadores
 
 # Configure logging con más detalles
 logging.basicConfig(
@@ -20,135 +26,329 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
-# RabbitMQ Configuration (similar to ai_service)
-RABBITMQ_HOST = os.environ.get('RABBITMQ_HOST', 'rabbitmq')
-RABBITMQ_PORT = int(os.environ.get('RABBITMQ_PORT', 5672))
-RABBITMQ_USER = os.environ.get('RABBITMQ_USER', 'guest')
-RABBITMQ_PASS = os.environ.get('RABBITMQ_PASS', 'guest')
+# RabbitMQ Configuration (la conexión se configura en rabbitmq_utils)
 SCRAPPER_PETICIONES_QUEUE = os.environ.get('SCRAPPER_PETICIONES_QUEUE', 'scrapper_peticiones_queue')
 MAX_PRODUCTS_PER_SEARCH_DEFAULT = int(os.environ.get('MAX_PRODUCTS_PER_SEARCH', 3))
 
-def get_rabbitmq_connection_params():
-    """Obtiene los parámetros de conexión a RabbitMQ"""
-    return pika.ConnectionParameters(
-        host=RABBITMQ_HOST,
-        port=RABBITMQ_PORT,
-        credentials=pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS),
-        heartbeat=600,
-        blocked_connection_timeout=300
-    )
+# Concurrencia del scraping: búsquedas simultáneas en total (el límite por host vive en http_utils)
+SCRAPER_MAX_CONCURRENCIA = int(os.environ.get('SCRAPER_MAX_CONCURRENCIA', 12))
+# Peticiones de scraping en curso a la vez: sus búsquedas se reparten por turnos entre usuarios
+# en los SCRAPER_MAX_CONCURRENCIA hilos del planificador (ver planificador.py)
+SCRAPER_PETICIONES_SIMULTANEAS = int(os.environ.get('SCRAPER_PETICIONES_SIMULTANEAS', 8))
+# Prioridades de RabbitMQ en scrapper_peticiones_queue (x-max-priority); 0 las desactiva. El servicio
+# de IA debe usar el mismo valor y una cola ya declarada sin él hay que borrarla antes de activarlo
+SCRAPER_PRIORIDAD_MAXIMA = int(os.environ.get('SCRAPER_PRIORIDAD_MAXIMA', 0))
+# Runtime del consumidor: 'blocking' (pika, por defecto) o 'asyncio' (ver scraper_async.py)
+SCRAPER_RUNTIME = os.environ.get('SCRAPER_RUNTIME', 'blocking').lower()
+# Entrega incremental: los enlaces de cada búsqueda se publican y guardan en cuanto termina,
+# sin esperar a las demás. Con 0, un único mensaje con todas las URLs al final
+SCRAPER_ENTREGA_INCREMENTAL = os.environ.get('SCRAPER_ENTREGA_INCREMENTAL', '1').lower() in ('1', 'true', 'yes')
 
-def conectar_a_rabbitmq(max_intentos=5, tiempo_espera=5):
-    intentos = 0
-    while intentos < max_intentos:
-        try:
-            conexion = pika.BlockingConnection(get_rabbitmq_connection_params())
-            logger.info("Scraper: Conexión establecida con RabbitMQ")
-            return conexion
-        except Exception as e:
-            intentos += 1
-            logger.error(f"Scraper: Intento {intentos}/{max_intentos} fallido al conectar con RabbitMQ: {e}")
-            if intentos < max_intentos:
-                logger.info(f"Scraper: Reintentando en {tiempo_espera} segundos...")
-                time.sleep(tiempo_espera)
-    logger.error("Scraper: No se pudo establecer conexión con RabbitMQ después de varios intentos")
-    return None
+_cache_busquedas = None
+_cache_busquedas_lock = threading.Lock()
+_planificador = None
+_planificador_lock = threading.Lock()
+
+def argumentos_cola_scraper():
+    """Argumentos con los que se declara scrapper_peticiones_queue (None sin prioridades)."""
+    return {'x-max-priority': SCRAPER_PRIORIDAD_MAXIMA} if SCRAPER_PRIORIDAD_MAXIMA > 0 else None
 
 def construir_url(response):
-    busqueda = response.lower().replace(" ", "-").replace(",", "")
+    busqueda = response.strip().lower().replace(" ", "-").replace(",", "")
     
     # Construir la URL
     base_url = "https://listado.mercadolibre.com.co"
     url = f"{base_url}/{busqueda}"
     return url
 
-def scrape_mercadolibre_colombia(search_queries_obj, max_products_per_search=5):
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-    }
-    
+def obtener_cache_busquedas():
+    """Devuelve la caché de páginas de resultados del proceso, creándola la primera vez."""
+    global _cache_busquedas
+    if _cache_busquedas is None:
+        with _cache_busquedas_lock:
+            if _cache_busquedas is None:
+                _cache_busquedas = CacheBusquedas()
+    return _cache_busquedas
+
+def obtener_planificador():
+    """Devuelve el planificador de búsquedas del proceso, creándolo la primera vez."""
+    global _planificador
+    if _planificador is None:
+        with _planificador_lock:
+            if _planificador is None:
+                _planificador = PlanificadorJusto(SCRAPER_MAX_CONCURRENCIA, nombre='busqueda')
+    return _planificador
+
+def _obtener_resultados_pagina(url, desde, limite=None):
+    """Devuelve los resultados extraídos de una página, desde la caché si están disponibles.
+
+    La clave de caché es el slug normalizado de construir_url más el desplazamiento de la página.
+    Con `limite`, el extractor puede detenerse tras ese número de enlaces; una entrada de caché
+    incompleta solo se reutiliza si contiene al menos los enlaces pedidos.
+    """
+    page_url = f"{url}_Desde_{desde}" if desde > 1 else url
+    clave = f"{url.rsplit('/', 1)[-1]}:{desde}"
+
+    cache = obtener_cache_busquedas()
+    resultados = cache.obtener(clave)
+    if resultados is not None and (resultados.get("completo", True) or (limite is not None and len(resultados["links"]) >= limite)):
+        return resultados
+
+    with tramo('scraping_pagina'):
+        response = obtener_pagina(page_url)
+        if response is None:
+            return _resultados_expirados(cache, clave)
+        resultados = obtener_extractor()(response.text, limite)
+    cache.guardar(clave, resultados)
+    return resultados
+
+def _resultados_expirados(cache, clave):
+    """Resultados caducados de la página cuando no se puede descargar (host limitando o cortocircuito abierto)."""
+    resultados = cache.obtener_expirado(clave)
+    if resultados is not None:
+        logger.warning(f"No se pudo descargar la página {clave}; se sirven resultados caducados de la caché")
+    return resultados
+
+def _reclamar_links(links, product_links_for_current_search, max_products_per_search, urls_reclamadas, lock_reclamadas):
+    """Reclama para la búsqueda actual los enlaces aún no tomados por otra. Devuelve True si añadió alguno."""
+    found_new_link_on_page = False
+    for link in links:
+        if len(product_links_for_current_search) >= max_products_per_search:
+            break
+        with lock_reclamadas:
+            if link not in urls_reclamadas:
+                urls_reclamadas.add(link)
+                product_links_for_current_search.append(link)
+                found_new_link_on_page = True
+    return found_new_link_on_page
+
+@medir_etapa('scraping_busqueda')
+def _scrape_busqueda(busqueda_texto, max_products_per_search, urls_reclamadas, lock_reclamadas):
+    """Recorre las páginas de una búsqueda y devuelve sus enlaces de producto.
+
+    Las búsquedas se ejecutan en paralelo, por lo que la deduplicación entre búsquedas
+    se hace reclamando cada enlace en un conjunto compartido protegido por un lock.
+    """
+    logger.info(f"Starting scrape for: {busqueda_texto}")
+    url = construir_url(busqueda_texto)
+    logger.info(f"Generated URL: {url}")
+
+    product_links_for_current_search = []
+    current_page = 1
+
+    while len(product_links_for_current_search) < max_products_per_search:
+        desde = (current_page - 1) * 50 + 1
+        # Cota de enlaces necesarios: los que faltan más los que otras búsquedas ya reclamaron
+        with lock_reclamadas:
+            limite = max_products_per_search - len(product_links_for_current_search) + len(urls_reclamadas)
+        resultados = _obtener_resultados_pagina(url, desde, limite)
+        if resultados is None:
+            # If all retries failed, or an unexpected status code after successful connection
+            break # Stop processing this search query
+
+        found_new_link_on_page = _reclamar_links(resultados["links"], product_links_for_current_search, max_products_per_search, urls_reclamadas, lock_reclamadas)
+        if len(product_links_for_current_search) < max_products_per_search and not resultados.get("completo", True):
+            # Otras búsquedas reclamaron enlaces mientras tanto: hace falta la página completa
+            resultados = _obtener_resultados_pagina(url, desde)
+            if resultados is None:
+                break
+            found_new_link_on_page = _reclamar_links(resultados["links"], product_links_for_current_search, max_products_per_search, urls_reclamadas, lock_reclamadas) or found_new_link_on_page
+
+        if len(product_links_for_current_search) >= max_products_per_search:
+            logger.info(f"Reached max products ({max_products_per_search}) for '{busqueda_texto}'.")
+            break
+
+        if not resultados["siguiente"]:
+            logger.info(f"No 'Next' page found for '{busqueda_texto}' on page {current_page}. Reached end of results for this search or page structure changed.")
+            break # No next page link found
+
+        if not found_new_link_on_page and current_page > 1: # Avoid breaking on first page if it's empty for some reason
+             logger.info(f"No new links found on page {current_page} for '{busqueda_texto}'. Assuming end of relevant results.")
+             break
+
+        current_page += 1
+
+    logger.info(f"Found {len(product_links_for_current_search)} links for '{busqueda_texto}'.")
+    return product_links_for_current_search
+
+def scrape_mercadolibre_colombia(search_queries_obj, max_products_per_search=5, al_completar_busqueda=None, clave=None):
+    """Ejecuta todas las búsquedas en paralelo y devuelve {'urls': [...]} en el orden de las búsquedas.
+
+    Las búsquedas se encolan en el planificador del proceso bajo `clave` (el usuario), que las
+    intercala por turnos con las de las demás peticiones en curso.
+    Si se indica, `al_completar_busqueda(busqueda, links)` se llama desde este hilo con los enlaces
+    de cada búsqueda según van terminando, en orden de finalización.
+    """
     all_product_links = {"urls": []}
     
     if "busquedas" not in search_queries_obj or not isinstance(search_queries_obj["busquedas"], list):
         logger.error("Invalid input format. Expected {'busquedas': ['query1', 'query2', ...]}")
         return all_product_links
 
-    for busqueda_texto in search_queries_obj["busquedas"]:
-        logger.info(f"Starting scrape for: {busqueda_texto}")
-        url = construir_url(busqueda_texto)
-        logger.info(f"Generated URL: {url}")
-        
-        product_links_for_current_search = []
-        current_page = 1
-        retries = 3 # Max retries per page
-
-        while len(product_links_for_current_search) < max_products_per_search:
-            page_url = f"{url}_Desde_{(current_page - 1) * 50 + 1}" if current_page > 1 else url
-            
-            attempt = 0
-            response = None
-            while attempt < retries:
-                try:
-                    response = requests.get(page_url, headers=headers, timeout=10)
-                    response.raise_for_status() # Raises an HTTPError for bad responses (4XX or 5XX)
-                    break 
-                except requests.exceptions.RequestException as e:
-                    logger.warning(f"Error accessing page {page_url} (Attempt {attempt + 1}/{retries}): {e}")
-                    attempt += 1
-                    if attempt == retries:
-                        logger.error(f"Failed to access page {page_url} after {retries} attempts.")
-                        # Optionally, you might want to break the outer loop or skip this search query
-                        break # Break from retry loop, go to next search or stop
-
-            if response is None or response.status_code != 200:
-                # If all retries failed, or an unexpected status code after successful connection
-                break # Stop processing this search query
-
-            soup = BeautifulSoup(response.text, "html.parser")
-            items = soup.find_all("a", href=True)
-            
-            found_new_link_on_page = False
-            for item in items:
-                link = item.get("href")
-                if link and "articulo.mercadolibre.com.co" in link and len(product_links_for_current_search) < max_products_per_search:
-                    if link not in all_product_links["urls"] and link not in product_links_for_current_search:
-                        product_links_for_current_search.append(link)
-                        all_product_links["urls"].append(link)
-                        found_new_link_on_page = True
-                if len(product_links_for_current_search) >= max_products_per_search:
-                    break
-            
-            if len(product_links_for_current_search) >= max_products_per_search:
-                logger.info(f"Reached max products ({max_products_per_search}) for '{busqueda_texto}'.")
-                break
+    busquedas = search_queries_obj["busquedas"]
+    if not busquedas:
+        return all_product_links
 
-            # Check for next page
-            # MercadoLibre's "Siguiente" button might be within a specific element, e.g., <li class="andes-pagination__button andes-pagination__button--next">
-            # Or it might be a direct <a> tag with title "Siguiente" or text "Siguiente"
-            next_page_indicators = soup.find_all("a", title="Siguiente")
-            if not next_page_indicators:
-                 # Fallback: find by text if title not present or varies
-                next_page_indicators = [a for a in soup.find_all("a") if a.get_text(strip=True) == "Siguiente"]
-
-            if not next_page_indicators or not next_page_indicators[0].get("href"):
-                logger.info(f"No 'Next' page found for '{busqueda_texto}' on page {current_page}. Reached end of results for this search or page structure changed.")
-                break # No next page link found
-
-            if not found_new_link_on_page and current_page > 1: # Avoid breaking on first page if it's empty for some reason
-                 logger.info(f"No new links found on page {current_page} for '{busqueda_texto}'. Assuming end of relevant results.")
-                 break
-            
-            current_page += 1
-            # Optional: Add a small delay to be polite to the server
-            # import time
-            # time.sleep(1) 
+    # Todas las búsquedas se encolan a la vez; la paginación de cada una sigue siendo
+    # secuencial porque depender de la página anterior es lo que decide si hay siguiente.
+    urls_reclamadas = set()
+    lock_reclamadas = threading.Lock()
+    resultados = [[] for _ in busquedas]
+    planificador = obtener_planificador()
+    # Cada búsqueda corre con una copia del contexto: conserva el id de correlación y el span padre
+    futuros = {
+        planificador.enviar(clave, _scrape_busqueda, busqueda_texto, max_products_per_search, urls_reclamadas, lock_reclamadas): indice
+        for indice, busqueda_texto in enumerate(busquedas)
+    }
+    for futuro in as_completed(futuros):
+        indice = futuros[futuro]
+        try:
+            resultados[indice] = futuro.result()
+        except Exception as e:
+            logger.error(f"Error inesperado en la búsqueda '{busquedas[indice]}': {e}", exc_info=True)
+        if al_completar_busqueda is not None:
+            al_completar_busqueda(busquedas[indice], resultados[indice])
 
-        logger.info(f"Found {len(product_links_for_current_search)} links for '{busqueda_texto}'.")
+    # Se conserva el orden de las búsquedas en el resultado final
+    for links in resultados:
+        all_product_links["urls"].extend(links)
 
     logger.info(f"Scraping finished. Total unique URLs collected: {len(all_product_links['urls'])}")
+    logger.info(f"Estadísticas de la caché de búsquedas: {obtener_cache_busquedas().estadisticas()}")
     logger.info(f"Collected URLs: {all_product_links}")
     return all_product_links
 
+# Sustituye las URLs de la última solicitud del usuario en un solo viaje a la base de datos:
+# resuelve la solicitud, borra solo las URLs que ya no están e inserta solo las nuevas (las que ya
+# existen las descarta la restricción única de la migración 0002).
+SQL_GUARDAR_URLS = """
+    WITH solicitud AS (
+        SELECT id
+        FROM solicitudes
+        WHERE userId = %(user_id)s
+        ORDER BY id DESC
+        LIMIT 1
+    ),
+    nuevas AS (
+        SELECT s.id AS solicitud_id, u.url, u.orden
+        FROM solicitud s
+        CROSS JOIN unnest(%(urls)s::varchar[]) WITH ORDINALITY AS u(url, orden)
+    ),
+    borradas AS (
+        DELETE FROM urls_encontradas ue
+        USING solicitud s
+        WHERE ue.solicitud_id = s.id
+          AND NOT EXISTS (SELECT 1 FROM nuevas n WHERE n.url = ue.url)
+        RETURNING ue.id
+    ),
+    insertadas AS (
+        INSERT INTO urls_encontradas (solicitud_id, url)
+        SELECT n.solicitud_id, n.url
+        FROM nuevas n
+        ORDER BY n.orden
+        ON CONFLICT (solicitud_id, url) DO NOTHING
+        RETURNING id
+    )
+    SELECT (SELECT id FROM solicitud),
+           (SELECT COUNT(*) FROM insertadas),
+           (SELECT COUNT(*) FROM borradas)
+"""
+
+# Añade URLs a la última solicitud del usuario sin borrar las que ya tiene (entrega incremental)
+SQL_AGREGAR_URLS = """
+    WITH solicitud AS (
+        SELECT id
+        FROM solicitudes
+        WHERE userId = %(user_id)s
+        ORDER BY id DESC
+        LIMIT 1
+    ),
+    insertadas AS (
+        INSERT INTO urls_encontradas (solicitud_id, url)
+        SELECT s.id, u.url
+        FROM solicitud s
+        CROSS JOIN unnest(%(urls)s::varchar[]) WITH ORDINALITY AS u(url, orden)
+        ORDER BY u.orden
+        ON CONFLICT (solicitud_id, url) DO NOTHING
+        RETURNING id
+    )
+    SELECT (SELECT id FROM solicitud),
+           (SELECT COUNT(*) FROM insertadas),
+           0
+"""
+
+def guardar_urls_encontradas(cursor, user_id, urls, reemplazar=True):
+    """Guarda las URLs de la solicitud más reciente del usuario. Devuelve (solicitud_id, insertadas, borradas).
+
+    Con `reemplazar` se borran las URLs de la solicitud que no estén en `urls`; sin él solo se añaden.
+    """
+    urls_unicas = list(dict.fromkeys(urls))
+    cursor.execute(SQL_GUARDAR_URLS if reemplazar else SQL_AGREGAR_URLS, {'user_id': user_id, 'urls': urls_unicas})
+    solicitud_id, insertadas, borradas = cursor.fetchone()
+    if insertadas or borradas:
+        notificar_cambio_formulario(cursor, user_id)
+    return solicitud_id, insertadas, borradas
+
+def guardar_urls_usuario(user_id_log, urls, reemplazar=True):
+    """Guarda las URLs del usuario del mensaje; los errores se registran y no interrumpen la petición."""
+    try:
+        # Convertir user_id_log a entero
+        user_id = int(user_id_log)
+
+        with tramo('db_urls'), conexion_db() as conn, conn.cursor() as cursor:
+            solicitud_id, insertadas, borradas = guardar_urls_encontradas(cursor, user_id, urls, reemplazar)
+
+        if solicitud_id is not None:
+            logger.info(f"Se guardaron {len(urls)} URLs para la solicitud {solicitud_id} ({insertadas} nuevas, {borradas} eliminadas)")
+        else:
+            logger.error(f"No se encontró solicitud para el usuario {user_id}")
+    except ValueError as e:
+        logger.error(f"Error al convertir user_id: {user_id_log} - {e}")
+    except Exception as e:
+        logger.error(f"Error al guardar URLs: {e}")
+
+def mensaje_urls_parcial(mensaje, secuencia, urls, final=False, **campos):
+    """Mensaje de scraped_urls_queue en modo incremental: los enlaces de una búsqueda o, con `final`, el cierre."""
+    return {
+        'id_correlacion': mensaje.get('id_correlacion') or id_correlacion_actual(),
+        'user_id': mensaje.get('user_id'),
+        'secuencia': secuencia,
+        'final': final,
+        'urls': urls,
+        **campos
+    }
+
+class EntregaIncremental:
+    """Publica y guarda los enlaces de cada búsqueda en cuanto termina.
+
+    Cada mensaje lleva `secuencia` (0, 1, 2...) y `final`. El último (`final: true`, sin URLs y
+    con `total`) indica que no llegarán más; antes de publicarlo se borran de la solicitud las URLs
+    que ya no forman parte del resultado, igual que en la entrega de una sola vez.
+    Los mensajes se publican sin esperar al broker; finalizar() espera todas las confirmaciones.
+    """
+
+    def __init__(self, mensaje):
+        self.mensaje = mensaje
+        self.secuencia = 0
+        self._confirmaciones = []
+
+    def _publicar(self, urls, final=False, **campos):
+        payload = mensaje_urls_parcial(self.mensaje, self.secuencia, urls, final, **campos)
+        self.secuencia += 1
+        self._confirmaciones.append(publicar(payload, QUEUE_SCRAPED_URLS, reply_to=self.mensaje.get('reply_to')))
+
+    def agregar(self, busqueda, urls):
+        if not urls:
+            return
+        self._publicar(urls, busqueda=busqueda)
+        guardar_urls_usuario(self.mensaje.get('user_id'), urls, reemplazar=False)
+
+    def finalizar(self, urls):
+        guardar_urls_usuario(self.mensaje.get('user_id'), urls)
+        self._publicar([], final=True, total=len(urls))
+        for secuencia, error in esperar_confirmaciones(self._confirmaciones):
+            logger.error(f"Scraper: Error al enviar el mensaje {secuencia} a {QUEUE_SCRAPED_URLS} para usuario {self.mensaje.get('user_id')}: {error}")
+
 def procesar_peticion_scraping_callback(ch, method, properties, body):
     """Procesa un mensaje de la cola de peticiones de scraping."""
     user_id_log = 'ID no especificado'
@@ -170,72 +370,33 @@ def procesar_peticion_scraping_callback(ch, method, properties, body):
         
         # Aquí se llama a la función de scraping existente
         # La función scrape_mercadolibre_colombia ya loguea sus resultados.
-        scraped_data = scrape_mercadolibre_colombia(search_queries_obj, max_products_per_search=max_products)
+        entrega = EntregaIncremental(mensaje) if SCRAPER_ENTREGA_INCREMENTAL else None
+        with tramo('scraping'):
+            scraped_data = scrape_mercadolibre_colombia(
+                search_queries_obj, max_products_per_search=max_products,
+                al_completar_busqueda=entrega.agregar if entrega else None,
+                clave=mensaje.get('user_id') or mensaje.get('id_correlacion')
+            )
 
-        # Podrías enviar `scraped_data` a otra cola o base de datos aquí si es necesario.
-        # Por ahora, solo confirmamos el procesamiento.
         logger.info(f"Scraper: Scraping completado para {user_id_log}. URLs obtenidas: {len(scraped_data.get('urls', []))}")
 
-        # Enviar las URLs scrapeadas a la nueva cola para el frontend
-        if scraped_data.get('urls'):
+        if entrega is not None:
+            # Las URLs ya se enviaron y guardaron por búsqueda: queda el cierre
+            entrega.finalizar(scraped_data['urls'])
+        elif scraped_data.get('urls'):
+            # Enviar las URLs scrapeadas a la nueva cola para el frontend
             payload_urls = {
+                'id_correlacion': mensaje.get('id_correlacion') or id_correlacion_actual(),
                 'user_id': user_id_log, # Aunque el frontend no lo use actualmente para esto, es buena práctica incluirlo
                 'urls': scraped_data['urls']
             }
-            if enviar_a_scraped_urls(payload_urls):
+            if enviar_a_scraped_urls(payload_urls, reply_to=mensaje.get('reply_to')):
                 logger.info(f"Scraper: URLs enviadas a {QUEUE_SCRAPED_URLS} para usuario {user_id_log}")
             else:
                 logger.error(f"Scraper: Error al enviar URLs a {QUEUE_SCRAPED_URLS} para usuario {user_id_log}")
 
             # Guardar URLs en la base de datos
-            try:
-                conn = get_db_connection()
-                if conn:
-                    cursor = conn.cursor()
-                    
-                    # Convertir user_id_log a entero
-                    user_id = int(user_id_log)
-                    
-                    # Obtener el ID de la solicitud más reciente
-                    cursor.execute("""
-                        SELECT id 
-                        FROM solicitudes 
-                        WHERE userId = %s 
-                        ORDER BY id DESC 
-                        LIMIT 1
-                    """, (user_id,))
-                    
-                    solicitud_id = cursor.fetchone()
-                    
-                    if solicitud_id:
-                        logger.info(f"Encontrada solicitud {solicitud_id[0]} para usuario {user_id}")
-                        
-                        # Primero eliminar URLs existentes para esta solicitud
-                        cursor.execute("""
-                            DELETE FROM urls_encontradas 
-                            WHERE solicitud_id = %s
-                        """, (solicitud_id[0],))
-                        
-                        # Insertar las nuevas URLs
-                        for url in scraped_data['urls']:
-                            cursor.execute("""
-                                INSERT INTO urls_encontradas (solicitud_id, url)
-                                VALUES (%s, %s)
-                            """, (solicitud_id[0], url))
-                        
-                        conn.commit()
-                        logger.info(f"Se guardaron {len(scraped_data['urls'])} URLs para la solicitud {solicitud_id[0]}")
-                    else:
-                        logger.error(f"No se encontró solicitud para el usuario {user_id}")
-            except ValueError as e:
-                logger.error(f"Error al convertir user_id: {user_id_log} - {e}")
-            except Exception as e:
-                logger.error(f"Error al guardar URLs: {e}")
-                if conn:
-                    conn.rollback()
-            finally:
-                if conn:
-                    conn.close()
+            guardar_urls_usuario(user_id_log, scraped_data['urls'])
 
         ch.basic_ack(delivery_tag=method.delivery_tag)
         logger.info(f"Scraper: Petición de scraping procesada y ack enviada para usuario: {user_id_log}")
@@ -251,37 +412,18 @@ def procesar_peticion_scraping_callback(ch, method, properties, body):
 def iniciar_consumidor_scraper():
     """Inicia el consumidor de RabbitMQ para la cola de peticiones de scraping."""
     logger.info(f"Scraper: Preparando para iniciar consumidor de {SCRAPPER_PETICIONES_QUEUE}...")
-    while True:
-        conexion = conectar_a_rabbitmq()
-        if conexion:
-            try:
-                canal = conexion.channel()
-                # Declarar la cola como durable, igual que el productor
-                canal.queue_declare(queue=SCRAPPER_PETICIONES_QUEUE, durable=True)
-                canal.basic_qos(prefetch_count=1) # Procesar un mensaje a la vez
-                
-                canal.basic_consume(queue=SCRAPPER_PETICIONES_QUEUE, on_message_callback=procesar_peticion_scraping_callback)
-                
-                logger.info(f"Scraper: Consumidor de {SCRAPPER_PETICIONES_QUEUE} iniciado. Esperando mensajes...")
-                canal.start_consuming()
-            except pika.exceptions.StreamLostError as e:
-                logger.warning(f"Scraper: Se perdió la conexión con RabbitMQ (StreamLostError): {e}. Reintentando...")
-            except pika.exceptions.AMQPConnectionError as e:
-                logger.warning(f"Scraper: Error de conexión AMQP: {e}. Reintentando...")
-            except Exception as e:
-                logger.error(f"Scraper: Error inesperado en el consumidor: {e}. Reintentando...", exc_info=True)
-            finally:
-                if conexion and not conexion.is_closed:
-                    try:
-                        conexion.close()
-                        logger.info("Scraper: Conexión RabbitMQ cerrada limpiamente.")
-                    except Exception as close_err:
-                        logger.error(f"Scraper: Error al cerrar la conexión RabbitMQ: {close_err}")
-                logger.info("Scraper: Intentando reconectar consumidor RabbitMQ en 10 segundos.")
-                time.sleep(10)
-        else:
-            logger.warning("Scraper: No se pudo conectar a RabbitMQ para iniciar consumidor. Reintentando en 10 segundos.")
-            time.sleep(10)
+    # Varias peticiones a la vez para que el planificador pueda intercalar sus búsquedas: los hilos
+    # del consumidor solo esperan a que terminen, el trabajo lo hacen los del planificador
+    consumidor = ConsumidorConcurrente(
+        SCRAPPER_PETICIONES_QUEUE, procesar_peticion_scraping_callback,
+        prefetch=SCRAPER_PETICIONES_SIMULTANEAS, workers=SCRAPER_PETICIONES_SIMULTANEAS,
+        nombre="Scraper", argumentos=argumentos_cola_scraper()
+    )
+    instalar_manejador_senales(consumidor)
+    try:
+        consumidor.ejecutar()
+    finally:
+        obtener_publicador().cerrar()
 
 def main():
     """Función principal que inicia el servicio"""
@@ -291,6 +433,21 @@ def main():
             logger.error("No se pudo inicializar el pool de conexiones a la base de datos")
             sys.exit(1)
             
+        registrar_comprobacion('postgres', comprobar_db)
+        iniciar_exportadores('back')
+
+        # Crear el cliente HTTP compartido y la caché antes de empezar a consumir
+        obtener_cliente()
+        obtener_cache_busquedas()
+        if SCRAPER_RUNTIME != 'asyncio':
+            obtener_planificador()
+
+        if SCRAPER_RUNTIME == 'asyncio':
+            import scraper_async
+            logger.info("Iniciando servicio de Scraper (runtime asyncio)...")
+            scraper_async.main()
+            return
+
         logger.info("Iniciando servicio de Scraper...")
         iniciar_consumidor_scraper()
     except Exception as e:
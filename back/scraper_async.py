@@ -0,0 +1,337 @@
+"""Runtime asyncio opcional del scraper (aio-pika + httpx + asyncpg).
+
+Se activa con SCRAPER_RUNTIME=asyncio. Usa las mismas colas, el mismo formato de
+mensajes y la misma semántica de ack/nack que procesar_peticion_scraping_callback,
+pero cada descarga de página es una corrutina, de modo que un proceso puede tener
+cientos de páginas en vuelo sin bloquear los heartbeats de RabbitMQ.
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from urllib.parse import urlsplit
+
+import aio_pika
+import asyncpg
+import httpx
+
+from comun.consumidor import RABBITMQ_HOST, RABBITMQ_PORT, RABBITMQ_USER, RABBITMQ_PASS
+from rabbitmq_utils import QUEUE_SCRAPED_URLS, EXCHANGE_RESULTADOS, ruta_sesion
+from database_utils import DB_CONFIG, DB_POOL_MIN, DB_POOL_MAX, CANAL_CAMBIOS_FORMULARIO
+from http_utils import (
+    DEFAULT_HEADERS, CODIGOS_REINTENTABLES, HTTP_TIMEOUT, HTTP_REINTENTOS,
+    HTTP_MAX_CONCURRENCIA_HOST, calcular_espera,
+)
+from extraction_utils import obtener_extractor
+from planificador import PlanificadorJustoAsync
+from trafico_utils import (
+    SCRAPER_RETRY_AFTER_MAX, obtener_limitador, obtener_cortocircuito, registrar_respuesta, registrar_error_transporte,
+)
+from comun.limitacion import CODIGOS_LIMITACION, segundos_retry_after
+from comun.trazas import traza_mensaje, tramo, medir_etapa, cabeceras_traza, id_correlacion_actual
+from comun.metricas import EntregaContada, observar_http, registrar_comprobacion
+from scraper import (
+    SCRAPPER_PETICIONES_QUEUE, MAX_PRODUCTS_PER_SEARCH_DEFAULT, SCRAPER_ENTREGA_INCREMENTAL,
+    SQL_GUARDAR_URLS, SQL_AGREGAR_URLS, construir_url, obtener_cache_busquedas, mensaje_urls_parcial,
+    argumentos_cola_scraper, _reclamar_links, _resultados_expirados,
+)
+
+logger = logging.getLogger(__name__)
+
+# Páginas descargándose a la vez en todo el proceso y peticiones de scraping en paralelo
+SCRAPER_ASYNC_MAX_PAGINAS = int(os.environ.get('SCRAPER_ASYNC_MAX_PAGINAS', 200))
+SCRAPER_ASYNC_PREFETCH = int(os.environ.get('SCRAPER_ASYNC_PREFETCH', 20))
+
+# La misma sentencia que el runtime bloqueante, con los parámetros posicionales de asyncpg
+SQL_GUARDAR_URLS_ASYNCPG = SQL_GUARDAR_URLS.replace('%(user_id)s', '$1').replace('%(urls)s', '$2')
+SQL_AGREGAR_URLS_ASYNCPG = SQL_AGREGAR_URLS.replace('%(user_id)s', '$1').replace('%(urls)s', '$2')
+
+
+class ScraperAsync:
+    """Estado compartido del runtime: cliente HTTP, pool de PostgreSQL y semáforos de concurrencia."""
+
+    def __init__(self, cliente, pool_db, exchange, exchange_resultados):
+        self.cliente = cliente
+        self.pool_db = pool_db
+        self.exchange = exchange
+        self.exchange_resultados = exchange_resultados
+        self.cache = obtener_cache_busquedas()
+        self.extractor = obtener_extractor()
+        self._paginas = asyncio.Semaphore(SCRAPER_ASYNC_MAX_PAGINAS)
+        # Cada búsqueda activa descarga una página a la vez: con el mismo límite, quien decide
+        # qué búsqueda avanza es el reparto por turnos entre usuarios y no el orden de llegada
+        self.planificador = PlanificadorJustoAsync(SCRAPER_ASYNC_MAX_PAGINAS)
+        self._hosts = {}
+
+    def _semaforo_host(self, host):
+        if host not in self._hosts:
+            self._hosts[host] = asyncio.Semaphore(HTTP_MAX_CONCURRENCIA_HOST)
+        return self._hosts[host]
+
+    async def obtener_pagina(self, url):
+        """Descarga una página con el limitador de tasa y el cortocircuito del host, reintentos y backoff con jitter. Devuelve el HTML o None."""
+        host = urlsplit(url).netloc
+        limitador = obtener_limitador(host)
+        for intento in range(HTTP_REINTENTOS):
+            if not obtener_cortocircuito(host).permitir():
+                logger.warning(f"Cortocircuito de {host} abierto; no se descarga {url}")
+                return None
+            # El limitador compartido consulta PostgreSQL: fuera del event loop
+            espera = await asyncio.to_thread(limitador.reservar) if limitador.usa_db else limitador.reservar()
+            if espera > 0:
+                await asyncio.sleep(espera)
+            retry_after = None
+            try:
+                async with self._paginas, self._semaforo_host(host):
+                    inicio = time.perf_counter()
+                    try:
+                        response = await self.cliente.get(url)
+                    except httpx.HTTPError:
+                        observar_http(host, 'error', time.perf_counter() - inicio)
+                        registrar_error_transporte(host)
+                        raise
+                    observar_http(host, response.status_code, time.perf_counter() - inicio)
+                if response.status_code in CODIGOS_LIMITACION:
+                    retry_after = segundos_retry_after(response.headers.get('Retry-After'), SCRAPER_RETRY_AFTER_MAX)
+                if limitador.usa_db:
+                    await asyncio.to_thread(registrar_respuesta, host, response.status_code, retry_after)
+                else:
+                    registrar_respuesta(host, response.status_code, retry_after)
+                if response.status_code == 200:
+                    return response.text
+                if response.status_code not in CODIGOS_REINTENTABLES:
+                    logger.warning(f"Respuesta {response.status_code} al acceder a {url}; no se reintenta.")
+                    return None
+                logger.warning(f"Respuesta {response.status_code} al acceder a {url} (Intento {intento + 1}/{HTTP_REINTENTOS})")
+            except httpx.HTTPError as e:
+                logger.warning(f"Error accediendo a {url} (Intento {intento + 1}/{HTTP_REINTENTOS}): {e!r}")
+            if intento + 1 < HTTP_REINTENTOS and retry_after is None:
+                await asyncio.sleep(calcular_espera(intento))
+        logger.error(f"No se pudo acceder a {url} después de {HTTP_REINTENTOS} intentos.")
+        return None
+
+    async def obtener_resultados_pagina(self, url, desde, limite=None):
+        """Equivalente asíncrono de scraper._obtener_resultados_pagina, con la misma caché."""
+        page_url = f"{url}_Desde_{desde}" if desde > 1 else url
+        clave = f"{url.rsplit('/', 1)[-1]}:{desde}"
+
+        # La caché puede tener un nivel compartido con E/S bloqueante: fuera del event loop
+        resultados = await asyncio.to_thread(self.cache.obtener, clave)
+        if resultados is not None and (resultados.get("completo", True) or (limite is not None and len(resultados["links"]) >= limite)):
+            return resultados
+
+        with tramo('scraping_pagina'):
+            html = await self.obtener_pagina(page_url)
+            if html is None:
+                return await asyncio.to_thread(_resultados_expirados, self.cache, clave)
+            resultados = await asyncio.to_thread(self.extractor, html, limite)
+        await asyncio.to_thread(self.cache.guardar, clave, resultados)
+        return resultados
+
+    @medir_etapa('scraping_busqueda')
+    async def scrape_busqueda(self, busqueda_texto, max_products_per_search, urls_reclamadas, lock_reclamadas):
+        """Misma paginación y deduplicación que scraper._scrape_busqueda."""
+        url = construir_url(busqueda_texto)
+        product_links_for_current_search = []
+        current_page = 1
+
+        while len(product_links_for_current_search) < max_products_per_search:
+            desde = (current_page - 1) * 50 + 1
+            limite = max_products_per_search - len(product_links_for_current_search) + len(urls_reclamadas)
+            resultados = await self.obtener_resultados_pagina(url, desde, limite)
+            if resultados is None:
+                break
+
+            found_new_link_on_page = _reclamar_links(resultados["links"], product_links_for_current_search, max_products_per_search, urls_reclamadas, lock_reclamadas)
+            if len(product_links_for_current_search) < max_products_per_search and not resultados.get("completo", True):
+                resultados = await self.obtener_resultados_pagina(url, desde)
+                if resultados is None:
+                    break
+                found_new_link_on_page = _reclamar_links(resultados["links"], product_links_for_current_search, max_products_per_search, urls_reclamadas, lock_reclamadas) or found_new_link_on_page
+
+            if len(product_links_for_current_search) >= max_products_per_search:
+                break
+            if not resultados["siguiente"]:
+                break
+            if not found_new_link_on_page and current_page > 1:
+                break
+            current_page += 1
+
+        logger.info(f"Found {len(product_links_for_current_search)} links for '{busqueda_texto}'.")
+        return product_links_for_current_search
+
+    async def scrape(self, busquedas, max_products_per_search, al_completar_busqueda=None, clave=None):
+        """Ejecuta todas las búsquedas a la vez y devuelve sus URLs en el orden de las búsquedas.
+
+        Cada búsqueda espera su turno en el planificador bajo `clave` (el usuario).
+
+        Si se indica, se espera `al_completar_busqueda(busqueda, links)` con los enlaces de cada
+        búsqueda en cuanto termina, como en scrape_mercadolibre_colombia.
+        """
+        urls_reclamadas = set()
+        lock_reclamadas = threading.Lock()
+
+        async def buscar(busqueda_texto):
+            try:
+                async with self.planificador.turno(clave):
+                    links = await self.scrape_busqueda(busqueda_texto, max_products_per_search, urls_reclamadas, lock_reclamadas)
+            except Exception as e:
+                logger.error(f"Error inesperado en la búsqueda '{busqueda_texto}': {e!r}")
+                links = []
+            if al_completar_busqueda is not None:
+                await al_completar_busqueda(busqueda_texto, links)
+            return links
+
+        resultados = await asyncio.gather(*(buscar(b) for b in busquedas))
+        return [url for links in resultados for url in links]
+
+    @medir_etapa('db_urls')
+    async def guardar_urls(self, user_id, urls, reemplazar=True):
+        sql = SQL_GUARDAR_URLS_ASYNCPG if reemplazar else SQL_AGREGAR_URLS_ASYNCPG
+        async with self.pool_db.acquire() as conn, conn.transaction():
+            fila = await conn.fetchrow(sql, user_id, list(dict.fromkeys(urls)))
+            if fila and (fila[1] or fila[2]):
+                await conn.execute("SELECT pg_notify($1, $2)", CANAL_CAMBIOS_FORMULARIO, str(user_id))
+            return fila
+
+    async def guardar_urls_usuario(self, user_id_log, urls, reemplazar=True):
+        """Versión asíncrona de scraper.guardar_urls_usuario."""
+        try:
+            fila = await self.guardar_urls(int(user_id_log), urls, reemplazar)
+            if fila and fila[0] is not None:
+                logger.info(f"Se guardaron {len(urls)} URLs para la solicitud {fila[0]} ({fila[1]} nuevas, {fila[2]} eliminadas)")
+            else:
+                logger.error(f"No se encontró solicitud para el usuario {user_id_log}")
+        except ValueError as e:
+            logger.error(f"Error al convertir user_id: {user_id_log} - {e}")
+        except Exception as e:
+            logger.error(f"Error al guardar URLs: {e}")
+
+    async def publicar_urls(self, payload, reply_to=None):
+        """Publica en la ruta de la sesión `reply_to` si es válida o, si no, en la cola compartida."""
+        ruta = ruta_sesion(reply_to, QUEUE_SCRAPED_URLS)
+        exchange = self.exchange_resultados if ruta else self.exchange
+        try:
+            await exchange.publish(
+                aio_pika.Message(
+                    body=json.dumps(payload).encode(),
+                    content_type='application/json',
+                    delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                    headers=cabeceras_traza(payload),
+                ),
+                routing_key=ruta or QUEUE_SCRAPED_URLS,
+            )
+        except Exception as e:
+            logger.error(f"Scraper (asyncio): Error al enviar URLs a {QUEUE_SCRAPED_URLS} para usuario {payload.get('user_id')}: {e}")
+
+    async def procesar_mensaje(self, message):
+        """Procesa una entrega de scrapper_peticiones_queue con las reglas de ack/nack del runtime bloqueante."""
+        user_id_log = 'ID no especificado'
+        try:
+            mensaje = json.loads(message.body.decode())
+            user_id_log = mensaje.get('user_id', 'ID no especificado')
+            if 'busquedas' not in mensaje or not isinstance(mensaje['busquedas'], list):
+                logger.error(f"Scraper (asyncio): Formato de mensaje inválido para {user_id_log}. Mensaje: {mensaje}")
+                await message.nack(requeue=False)
+                return
+
+            max_products = mensaje.get('max_products_per_search', MAX_PRODUCTS_PER_SEARCH_DEFAULT)
+            secuencia = 0
+
+            async def agregar(busqueda, links):
+                # Mismo protocolo que scraper.EntregaIncremental
+                nonlocal secuencia
+                if not links:
+                    return
+                payload = mensaje_urls_parcial(mensaje, secuencia, links, busqueda=busqueda)
+                secuencia += 1
+                await self.publicar_urls(payload, mensaje.get('reply_to'))
+                await self.guardar_urls_usuario(user_id_log, links, reemplazar=False)
+
+            with tramo('scraping'):
+                urls = await self.scrape(
+                    mensaje['busquedas'], max_products, agregar if SCRAPER_ENTREGA_INCREMENTAL else None,
+                    clave=mensaje.get('user_id') or mensaje.get('id_correlacion')
+                )
+            logger.info(f"Scraper (asyncio): Scraping completado para {user_id_log}. URLs obtenidas: {len(urls)}")
+
+            if SCRAPER_ENTREGA_INCREMENTAL:
+                await self.guardar_urls_usuario(user_id_log, urls)
+                await self.publicar_urls(
+                    mensaje_urls_parcial(mensaje, secuencia, [], final=True, total=len(urls)), mensaje.get('reply_to')
+                )
+            elif urls:
+                await self.publicar_urls({
+                    'id_correlacion': mensaje.get('id_correlacion') or id_correlacion_actual(),
+                    'user_id': user_id_log,
+                    'urls': urls,
+                }, mensaje.get('reply_to'))
+                await self.guardar_urls_usuario(user_id_log, urls)
+
+            await message.ack()
+            logger.info(f"Scraper (asyncio): Petición de scraping procesada y ack enviada para usuario: {user_id_log}")
+
+        except json.JSONDecodeError as e:
+            logger.error(f"Scraper (asyncio): Error al decodificar JSON de RabbitMQ para {user_id_log}: {e}. Mensaje no será reencolado.")
+            await message.nack(requeue=False)
+        except Exception as e:
+            logger.error(f"Scraper (asyncio): Error inesperado al procesar petición de scraping para {user_id_log}: {e}", exc_info=True)
+            await message.nack(requeue=True)
+
+
+async def consumir_peticiones_scraping(detener=None):
+    """Consume scrapper_peticiones_queue hasta que se active el evento `detener` (o indefinidamente)."""
+    detener = detener or asyncio.Event()
+    conexion = await aio_pika.connect_robust(
+        host=RABBITMQ_HOST, port=RABBITMQ_PORT, login=RABBITMQ_USER, password=RABBITMQ_PASS, heartbeat=600
+    )
+    pool_db = await asyncpg.create_pool(min_size=DB_POOL_MIN, max_size=DB_POOL_MAX, **DB_CONFIG)
+    limites = httpx.Limits(max_connections=SCRAPER_ASYNC_MAX_PAGINAS, max_keepalive_connections=SCRAPER_ASYNC_MAX_PAGINAS)
+    async with conexion, httpx.AsyncClient(headers=DEFAULT_HEADERS, limits=limites, timeout=HTTP_TIMEOUT, follow_redirects=True) as cliente:
+        try:
+            canal = await conexion.channel()
+            await canal.set_qos(prefetch_count=SCRAPER_ASYNC_PREFETCH)
+            cola = await canal.declare_queue(SCRAPPER_PETICIONES_QUEUE, durable=True, arguments=argumentos_cola_scraper())
+            await canal.declare_queue(QUEUE_SCRAPED_URLS, durable=True)
+            resultados = await canal.declare_exchange(EXCHANGE_RESULTADOS, aio_pika.ExchangeType.TOPIC, durable=True)
+            scraper = ScraperAsync(cliente, pool_db, canal.default_exchange, resultados)
+            registrar_comprobacion(f'rabbitmq:{SCRAPPER_PETICIONES_QUEUE}', lambda: not canal.is_closed)
+
+            tareas = set()
+
+            async def procesar_trazado(message):
+                with traza_mensaje(SCRAPPER_PETICIONES_QUEUE, message), tramo(f"consumir:{SCRAPPER_PETICIONES_QUEUE}"):
+                    await scraper.procesar_mensaje(message)
+
+            async def al_recibir(message):
+                # No esperar aquí: cada petición avanza en su propia tarea
+                tarea = asyncio.ensure_future(procesar_trazado(EntregaContada(message, SCRAPPER_PETICIONES_QUEUE)))
+                tareas.add(tarea)
+                tarea.add_done_callback(tareas.discard)
+
+            consumer_tag = await cola.consume(al_recibir)
+            logger.info(f"Scraper (asyncio): Consumidor de {SCRAPPER_PETICIONES_QUEUE} iniciado (prefetch={SCRAPER_ASYNC_PREFETCH}, páginas en vuelo={SCRAPER_ASYNC_MAX_PAGINAS})")
+            await detener.wait()
+
+            # Cierre ordenado: dejar de recibir y esperar a las peticiones en curso
+            await cola.cancel(consumer_tag)
+            if tareas:
+                await asyncio.gather(*tareas, return_exceptions=True)
+        finally:
+            await pool_db.close()
+
+
+def main():
+    """Punto de entrada del runtime asyncio; termina de forma ordenada con SIGTERM/SIGINT."""
+    import signal
+
+    async def ejecutar():
+        detener = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, detener.set)
+        await consumir_peticiones_scraping(detener)
+
+    asyncio.run(ejecutar())
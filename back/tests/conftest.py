@@ -0,0 +1,7 @@
+import os
+import sys
+
+# Los módulos del servicio viven en back/, no en un paquete instalable, y los compartidos en comun/
+BACK = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACK)
+sys.path.insert(1, os.path.dirname(BACK))
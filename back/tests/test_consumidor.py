@@ -0,0 +1,75 @@
+"""Los consumidores de comun/consumidor.py no dejan entregas sin confirmar cuando el callback falla."""
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("pika")
+pytest.importorskip("prometheus_client")
+
+from comun.consumidor import CanalHilos, ConsumidorConcurrente, ConsumidorLotes
+
+
+class ConexionInmediata:
+    """Ejecuta al momento lo que los workers programan en el hilo de la conexión."""
+
+    def add_callback_threadsafe(self, funcion):
+        funcion()
+
+
+class CanalRegistrado:
+    def __init__(self):
+        self.llamadas = []
+
+    def basic_ack(self, delivery_tag, multiple):
+        self.llamadas.append(("ack", delivery_tag, multiple))
+
+    def basic_nack(self, delivery_tag, multiple, requeue):
+        self.llamadas.append(("nack", delivery_tag, requeue))
+
+
+def entrega(delivery_tag):
+    return SimpleNamespace(delivery_tag=delivery_tag), SimpleNamespace(headers=None), b"no es json"
+
+
+def preparar(consumidor, delivery_tags):
+    canal = CanalRegistrado()
+    fachada = CanalHilos(ConexionInmediata(), canal, consumidor.cola)
+    for delivery_tag in delivery_tags:
+        fachada.registrar_entrega(delivery_tag)
+    consumidor._en_curso = len(delivery_tags)
+    return canal, fachada
+
+
+def test_callback_que_falla_descarta_la_entrega():
+    def callback(ch, method, properties, body):
+        raise ValueError("cuerpo inválido")
+
+    consumidor = ConsumidorConcurrente("pruebas", callback, workers=1)
+    canal, fachada = preparar(consumidor, [7])
+    consumidor._procesar(fachada, *entrega(7))
+    assert canal.llamadas == [("nack", 7, False)]
+    assert fachada.sin_confirmar([7]) == []
+    assert consumidor._en_curso == 0
+
+
+def test_callback_que_confirma_no_se_toca():
+    def callback(ch, method, properties, body):
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        raise RuntimeError("falla después de confirmar")
+
+    consumidor = ConsumidorConcurrente("pruebas", callback, workers=1)
+    canal, fachada = preparar(consumidor, [3])
+    consumidor._procesar(fachada, *entrega(3))
+    assert canal.llamadas == [("ack", 3, False)]
+
+
+def test_lote_que_falla_descarta_solo_lo_no_confirmado():
+    def callback_lote(ch, entregas):
+        ch.basic_ack(delivery_tag=entregas[0][0].delivery_tag)
+        raise ValueError("falla a mitad del lote")
+
+    consumidor = ConsumidorLotes("pruebas", callback_lote, tamano=3, espera_ms=10)
+    canal, fachada = preparar(consumidor, [1, 2, 3])
+    consumidor._procesar_lote(fachada, [entrega(tag) for tag in (1, 2, 3)])
+    assert canal.llamadas == [("ack", 1, False), ("nack", 2, False), ("nack", 3, False)]
+    assert consumidor._en_curso == 0
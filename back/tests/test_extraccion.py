@@ -0,0 +1,61 @@
+"""Paridad de los backends de extracción con 'bs4' (el comportamiento original) sobre listados guardados."""
+import os
+
+import pytest
+
+pytest.importorskip("bs4")
+
+from extraction_utils import BACKENDS, backend_disponible, extraer_bs4
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+PAGINAS = ["listado_limite_exacto.html", "listado_sin_siguiente.html", "listado_siguiente_titulo_texto.html"]
+BACKENDS_DISPONIBLES = [nombre for nombre in BACKENDS if backend_disponible(nombre)]
+# Sin límite, por debajo, justo en el número de productos de listado_limite_exacto.html y por encima
+LIMITES = [None, 1, 2, 3, 50]
+
+
+def leer_pagina(nombre):
+    with open(os.path.join(FIXTURES, nombre), encoding="utf-8") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("limite", LIMITES)
+@pytest.mark.parametrize("pagina", PAGINAS)
+@pytest.mark.parametrize("backend", BACKENDS_DISPONIBLES)
+def test_backend_coincide_con_bs4(backend, pagina, limite):
+    html = leer_pagina(pagina)
+    resultado = BACKENDS[backend](html, limite)
+    if resultado["completo"]:
+        referencia = extraer_bs4(html, limite)
+        assert resultado["links"] == referencia["links"]
+        assert resultado["siguiente"] == referencia["siguiente"]
+    else:
+        # Un backend que para pronto solo garantiza un prefijo de los enlaces, y solo cuando ya tiene `limite`
+        enlaces = extraer_bs4(html)["links"]
+        assert limite is not None and len(resultado["links"]) == limite
+        assert resultado["links"] == enlaces[:limite]
+        assert resultado["siguiente"] is None
+
+
+def test_limite_exacto():
+    html = leer_pagina("listado_limite_exacto.html")
+    referencia = extraer_bs4(html)
+    assert len(referencia["links"]) == 3
+    assert referencia["siguiente"] == "https://listado.mercadolibre.com.co/camara-nikon_Desde_51_NoIndex_True"
+
+    resultado = BACKENDS["stream"](html, 3)
+    assert not resultado["completo"]
+    assert resultado["links"] == referencia["links"]
+
+
+def test_sin_siguiente():
+    referencia = extraer_bs4(leer_pagina("listado_sin_siguiente.html"))
+    assert referencia["siguiente"] is None
+    assert len(referencia["links"]) == 3
+    assert BACKENDS["stream"](leer_pagina("listado_sin_siguiente.html"), 50)["completo"]
+
+
+def test_siguiente_por_titulo_antes_que_por_texto():
+    referencia = extraer_bs4(leer_pagina("listado_siguiente_titulo_texto.html"))
+    assert referencia["siguiente"] == "https://listado.mercadolibre.com.co/tripode_Desde_49_NoIndex_True"
+    assert len(referencia["links"]) == 4
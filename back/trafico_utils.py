@@ -0,0 +1,256 @@
+"""Control del tráfico saliente del scraper por host: limitador de tasa adaptativo y cortocircuito.
+
+Cada host tiene un cubo de tokens (implementado como GCRA: cada petición reserva el siguiente
+hueco del calendario) con `SCRAPER_RAFAGA_HOST` peticiones de ráfaga. La tasa se adapta como AIMD:
+cada respuesta correcta la sube un poco (aumento aditivo, unas SCRAPER_AIMD_AUMENTO peticiones/s
+por cada segundo sin limitaciones) y un 429/503 la multiplica por SCRAPER_AIMD_REDUCCION, como
+mucho una vez por intervalo para que una ráfaga de rechazos no la hunda. Un `Retry-After` bloquea
+el host hasta esa hora.
+
+El cortocircuito se abre tras SCRAPER_CIRCUITO_FALLOS fallos seguidos (errores de red o 5xx):
+mientras está abierto las descargas fallan al instante y el scraper sirve resultados de la caché
+aunque hayan expirado. Pasado SCRAPER_CIRCUITO_ENFRIAMIENTO deja pasar una petición de prueba;
+si va bien se cierra y si no vuelve a abrirse.
+
+Con SCRAPER_LIMITE_COMPARTIDO=postgres el estado del limitador vive en la tabla limites_hosts
+(migración 0004) y todas las réplicas reparten el mismo cupo por host.
+"""
+import os
+import time
+import logging
+import threading
+
+from prometheus_client import Counter, Gauge
+
+from comun.limitacion import CODIGOS_LIMITACION
+from database_utils import conexion_db
+
+SCRAPER_TASA_HOST = float(os.environ.get('SCRAPER_TASA_HOST', 5))
+SCRAPER_TASA_MINIMA = float(os.environ.get('SCRAPER_TASA_MINIMA', 0.5))
+SCRAPER_TASA_MAXIMA = float(os.environ.get('SCRAPER_TASA_MAXIMA', 20))
+SCRAPER_RAFAGA_HOST = int(os.environ.get('SCRAPER_RAFAGA_HOST', 5))
+SCRAPER_AIMD_AUMENTO = float(os.environ.get('SCRAPER_AIMD_AUMENTO', 0.5))
+SCRAPER_AIMD_REDUCCION = float(os.environ.get('SCRAPER_AIMD_REDUCCION', 0.5))
+# Un Retry-After mayor que esto se recorta: un valor absurdo no debe parar el scraper durante horas
+SCRAPER_RETRY_AFTER_MAX = float(os.environ.get('SCRAPER_RETRY_AFTER_MAX', 120))
+SCRAPER_CIRCUITO_FALLOS = int(os.environ.get('SCRAPER_CIRCUITO_FALLOS', 5))
+SCRAPER_CIRCUITO_ENFRIAMIENTO = float(os.environ.get('SCRAPER_CIRCUITO_ENFRIAMIENTO', 30))
+# Estado del limitador compartido entre réplicas: '' (en memoria del proceso) o 'postgres'
+SCRAPER_LIMITE_COMPARTIDO = os.environ.get('SCRAPER_LIMITE_COMPARTIDO', '').lower()
+
+TASA_HOST = Gauge(
+    'http_tasa_host', 'Peticiones por segundo que el limitador permite hacia cada host',
+    ['host'], multiprocess_mode='max'
+)
+CORTOCIRCUITO_ABIERTO = Gauge(
+    'http_cortocircuito_abierto', 'Si el cortocircuito del host está abierto (1) o cerrado (0)',
+    ['host'], multiprocess_mode='max'
+)
+CORTOCIRCUITO_RECHAZOS = Counter(
+    'http_cortocircuito_rechazos_total', 'Descargas descartadas sin intentarlas por tener el cortocircuito abierto',
+    ['host']
+)
+
+logger = logging.getLogger(__name__)
+
+_limitadores = {}
+_cortocircuitos = {}
+_registro_lock = threading.Lock()
+
+
+class LimitadorHost:
+    """Cubo de tokens de un host con tasa adaptativa (AIMD). Seguro entre hilos."""
+
+    usa_db = False
+
+    def __init__(self, host, tasa=SCRAPER_TASA_HOST):
+        self.host = host
+        self.tasa = tasa
+        self._tat = 0.0
+        self._bloqueado_hasta = 0.0
+        self._ultima_reduccion = 0.0
+        self._lock = threading.Lock()
+        TASA_HOST.labels(host).set(tasa)
+
+    def reservar(self):
+        """Reserva el hueco de la siguiente petición. Devuelve los segundos que hay que esperar antes de enviarla."""
+        with self._lock:
+            ahora = time.monotonic()
+            intervalo = 1 / self.tasa
+            tat = max(self._tat, ahora)
+            salida = max(tat - (SCRAPER_RAFAGA_HOST - 1) * intervalo, ahora, self._bloqueado_hasta)
+            self._tat = max(tat, salida) + intervalo
+            return salida - ahora
+
+    def registrar(self, codigo, retry_after=None):
+        """Adapta la tasa a la respuesta: `codigo` es el estado HTTP y `retry_after` sus segundos, si los trae."""
+        with self._lock:
+            if codigo in CODIGOS_LIMITACION:
+                ahora = time.monotonic()
+                if ahora - self._ultima_reduccion >= max(1.0, 1 / self.tasa):
+                    self.tasa = max(SCRAPER_TASA_MINIMA, self.tasa * SCRAPER_AIMD_REDUCCION)
+                    self._ultima_reduccion = ahora
+                if retry_after:
+                    self._bloqueado_hasta = max(self._bloqueado_hasta, ahora + retry_after)
+            elif codigo < 400:
+                self.tasa = min(SCRAPER_TASA_MAXIMA, self.tasa + SCRAPER_AIMD_AUMENTO / self.tasa)
+            else:
+                return
+            tasa = self.tasa
+        TASA_HOST.labels(self.host).set(tasa)
+
+
+# Reserva el siguiente hueco del host sobre la fila compartida (ver migrations/0004_limites_hosts.sql)
+SQL_RESERVAR_HUECO = "SELECT o_espera, o_tasa FROM reservar_hueco_host(%(host)s, %(tasa)s, %(maxima)s, %(rafaga)s, %(exitos)s, %(aumento)s)"
+
+# Reducción multiplicativa y Retry-After; el UPDATE bloquea la fila, así dos réplicas no se pisan
+SQL_LIMITAR_HOST = """
+    UPDATE limites_hosts
+    SET tasa = CASE WHEN r.ahora - ultima_reduccion >= GREATEST(1, 1 / tasa)
+                    THEN GREATEST(%(minima)s, tasa * %(reduccion)s) ELSE tasa END,
+        ultima_reduccion = CASE WHEN r.ahora - ultima_reduccion >= GREATEST(1, 1 / tasa)
+                                THEN r.ahora ELSE ultima_reduccion END,
+        bloqueado_hasta = GREATEST(bloqueado_hasta, r.ahora + %(retry_after)s)
+    FROM (SELECT extract(epoch FROM clock_timestamp()) AS ahora) r
+    WHERE host = %(host)s
+    RETURNING tasa
+"""
+
+
+class LimitadorCompartido(LimitadorHost):
+    """Limitador con el estado en PostgreSQL: el cupo del host es común a todas las réplicas.
+
+    Los aumentos por respuestas correctas se acumulan en el proceso y se aplican en la siguiente
+    reserva. Si la base de datos no responde se usa el estado local para no detener el scraping.
+    """
+
+    usa_db = True
+
+    def __init__(self, host, tasa=SCRAPER_TASA_HOST):
+        super().__init__(host, tasa)
+        self._exitos = 0
+
+    def reservar(self):
+        with self._lock:
+            exitos, self._exitos = self._exitos, 0
+        try:
+            with conexion_db() as conn, conn.cursor() as cursor:
+                cursor.execute(SQL_RESERVAR_HUECO, {
+                    'host': self.host, 'tasa': self.tasa, 'maxima': SCRAPER_TASA_MAXIMA,
+                    'rafaga': SCRAPER_RAFAGA_HOST, 'exitos': exitos, 'aumento': SCRAPER_AIMD_AUMENTO,
+                })
+                espera, tasa = cursor.fetchone()
+        except Exception as e:
+            logger.warning(f"Limitador compartido de {self.host} no disponible ({e}); se usa el local")
+            return super().reservar()
+        self.tasa = tasa
+        TASA_HOST.labels(self.host).set(tasa)
+        return espera
+
+    def registrar(self, codigo, retry_after=None):
+        if codigo not in CODIGOS_LIMITACION:
+            if codigo < 400:
+                with self._lock:
+                    self._exitos += 1
+            return
+        try:
+            with conexion_db() as conn, conn.cursor() as cursor:
+                cursor.execute(SQL_LIMITAR_HOST, {
+                    'host': self.host, 'minima': SCRAPER_TASA_MINIMA, 'reduccion': SCRAPER_AIMD_REDUCCION,
+                    'retry_after': retry_after or 0,
+                })
+                fila = cursor.fetchone()
+        except Exception as e:
+            logger.warning(f"Limitador compartido de {self.host} no disponible ({e}); se usa el local")
+            super().registrar(codigo, retry_after)
+            return
+        if fila:
+            self.tasa = fila[0]
+            TASA_HOST.labels(self.host).set(self.tasa)
+
+
+class Cortocircuito:
+    """Cortocircuito de un host: cerrado, abierto tras varios fallos seguidos y una prueba tras enfriarse."""
+
+    def __init__(self, host, fallos=SCRAPER_CIRCUITO_FALLOS, enfriamiento=SCRAPER_CIRCUITO_ENFRIAMIENTO):
+        self.host = host
+        self.umbral = fallos
+        self.enfriamiento = enfriamiento
+        self._fallos = 0
+        self._abierto = False
+        self._abierto_hasta = 0.0
+        self._lock = threading.Lock()
+        CORTOCIRCUITO_ABIERTO.labels(host).set(0)
+
+    @property
+    def abierto(self):
+        with self._lock:
+            return self._abierto
+
+    def permitir(self):
+        """Indica si se puede intentar una descarga. Con el circuito abierto y enfriado deja pasar una de prueba."""
+        with self._lock:
+            if not self._abierto:
+                return True
+            ahora = time.monotonic()
+            if ahora >= self._abierto_hasta:
+                # Solo una prueba por periodo de enfriamiento: el resto sigue fallando al instante
+                self._abierto_hasta = ahora + self.enfriamiento
+                return True
+        CORTOCIRCUITO_RECHAZOS.labels(self.host).inc()
+        return False
+
+    def registrar_exito(self):
+        with self._lock:
+            self._fallos = 0
+            if not self._abierto:
+                return
+            self._abierto = False
+        CORTOCIRCUITO_ABIERTO.labels(self.host).set(0)
+        logger.info(f"Cortocircuito de {self.host} cerrado: el host vuelve a responder")
+
+    def registrar_fallo(self):
+        with self._lock:
+            self._fallos += 1
+            if not self._abierto and self._fallos < self.umbral:
+                return
+            # Prueba fallida o umbral alcanzado: abrir (o mantener abierto) otro periodo
+            recien_abierto = not self._abierto
+            self._abierto = True
+            self._abierto_hasta = time.monotonic() + self.enfriamiento
+        if recien_abierto:
+            CORTOCIRCUITO_ABIERTO.labels(self.host).set(1)
+            logger.warning(f"Cortocircuito de {self.host} abierto tras {self._fallos} fallos seguidos; se reintenta en {self.enfriamiento:.0f} s")
+
+
+def obtener_limitador(host):
+    """Devuelve (creándolo si no existe) el limitador de tasa de un host."""
+    with _registro_lock:
+        limitador = _limitadores.get(host)
+        if limitador is None:
+            clase = LimitadorCompartido if SCRAPER_LIMITE_COMPARTIDO == 'postgres' else LimitadorHost
+            limitador = _limitadores[host] = clase(host)
+        return limitador
+
+
+def obtener_cortocircuito(host):
+    """Devuelve (creándolo si no existe) el cortocircuito de un host."""
+    with _registro_lock:
+        cortocircuito = _cortocircuitos.get(host)
+        if cortocircuito is None:
+            cortocircuito = _cortocircuitos[host] = Cortocircuito(host)
+        return cortocircuito
+
+
+def registrar_respuesta(host, codigo, retry_after=None):
+    """Informa al limitador y al cortocircuito del host de una respuesta recibida."""
+    obtener_limitador(host).registrar(codigo, retry_after)
+    if codigo >= 500:
+        obtener_cortocircuito(host).registrar_fallo()
+    else:
+        obtener_cortocircuito(host).registrar_exito()
+
+
+def registrar_error_transporte(host):
+    """Informa al cortocircuito de una petición que no obtuvo respuesta (timeout, conexión rechazada...)."""
+    obtener_cortocircuito(host).registrar_fallo()
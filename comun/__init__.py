@@ -0,0 +1,5 @@
+"""Módulos compartidos por el backend (back/) y el servicio de IA (ai_service/).
+
+Cada imagen los copia en /app/comun (ver los Dockerfile); en local, ejecutar los servicios
+con la raíz del repositorio en PYTHONPATH.
+"""
@@ -0,0 +1,334 @@
+"""Conexión a RabbitMQ y consumidores concurrentes con pika, comunes al backend y al servicio de IA."""
+import os
+import time
+import signal
+import logging
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import pika
+
+from comun.trazas import traza_mensaje, tramo, registrar_espera_cola
+from comun.metricas import contar_mensaje, evento_nack, registrar_comprobacion
+
+# Obtener configuración de variables de entorno o usar valores predeterminados
+RABBITMQ_HOST = os.environ.get('RABBITMQ_HOST', 'rabbitmq')
+RABBITMQ_PORT = int(os.environ.get('RABBITMQ_PORT', 5672))
+RABBITMQ_USER = os.environ.get('RABBITMQ_USER', 'guest')
+RABBITMQ_PASS = os.environ.get('RABBITMQ_PASS', 'guest')
+
+# Consumidores: mensajes sin confirmar que el broker entrega por adelantado y hilos que los procesan
+CONSUMIDOR_PREFETCH = int(os.environ.get('CONSUMIDOR_PREFETCH', 1))
+CONSUMIDOR_WORKERS = int(os.environ.get('CONSUMIDOR_WORKERS', 1))
+# Segundos sin que el bucle de la conexión atienda eventos tras los que /health da el consumidor por atascado
+CONSUMIDOR_LATIDO_MAXIMO = float(os.environ.get('CONSUMIDOR_LATIDO_MAXIMO', 30))
+
+
+def get_connection_params():
+    """Obtiene los parámetros de conexión a RabbitMQ"""
+    return pika.ConnectionParameters(
+        host=RABBITMQ_HOST,
+        port=RABBITMQ_PORT,
+        credentials=pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS),
+        heartbeat=600,
+        blocked_connection_timeout=300
+    )
+
+
+# Función para establecer conexión con RabbitMQ con reintentos
+def conectar_a_rabbitmq(max_intentos=5, tiempo_espera=5):
+    intentos = 0
+    while intentos < max_intentos:
+        try:
+            conexion = pika.BlockingConnection(get_connection_params())
+            logging.info("Conexión establecida con RabbitMQ")
+            return conexion
+        except Exception as e:
+            intentos += 1
+            logging.error(f"Intento {intentos}/{max_intentos} fallido al conectar con RabbitMQ: {e}")
+            if intentos < max_intentos:
+                logging.info(f"Reintentando en {tiempo_espera} segundos...")
+                time.sleep(tiempo_espera)
+
+    logging.error("No se pudo establecer conexión con RabbitMQ después de varios intentos")
+    return None
+
+
+# Función para consumir mensajes de una cola
+def configurar_consumidor(canal, cola, callback, prefetch=CONSUMIDOR_PREFETCH, argumentos=None):
+    canal.queue_declare(queue=cola, durable=True, arguments=argumentos)
+    canal.basic_qos(prefetch_count=prefetch)
+    consumer_tag = canal.basic_consume(queue=cola, on_message_callback=callback)
+    logging.info(f"Consumidor configurado para la cola: {cola} (prefetch={prefetch})")
+    return consumer_tag
+
+
+class CanalHilos:
+    """Fachada del canal para callbacks que se ejecutan fuera del hilo de la conexión.
+
+    pika solo permite usar la conexión desde su propio hilo, así que cada operación se
+    programa con add_callback_threadsafe y no espera. Para publicar, los callbacks usan el
+    publicador compartido (comun/publicador.py), que tiene su propia conexión.
+    También lleva la cuenta de las entregas sin confirmar de `cola` para las métricas.
+    """
+
+    def __init__(self, conexion, canal, cola):
+        self._conexion = conexion
+        self._canal = canal
+        self._cola = cola
+        self._pendientes = set()
+        self._pendientes_lock = threading.Lock()
+
+    def registrar_entrega(self, delivery_tag):
+        """Anota una entrega recibida; sus ack/nack (también con multiple=True) se cuentan al confirmarla."""
+        with self._pendientes_lock:
+            self._pendientes.add(delivery_tag)
+        contar_mensaje(self._cola, 'consumido')
+
+    def _contar_confirmacion(self, delivery_tag, multiple, evento):
+        with self._pendientes_lock:
+            if multiple:
+                # delivery_tag=0 con multiple confirma todo lo pendiente
+                confirmadas = {tag for tag in self._pendientes if not delivery_tag or tag <= delivery_tag}
+            else:
+                confirmadas = self._pendientes & {delivery_tag}
+            self._pendientes -= confirmadas
+        if confirmadas:
+            contar_mensaje(self._cola, evento, len(confirmadas))
+
+    def sin_confirmar(self, delivery_tags):
+        """Las entregas de `delivery_tags` que todavía no tienen ack/nack."""
+        with self._pendientes_lock:
+            return sorted(self._pendientes.intersection(delivery_tags))
+
+    def descartar_pendientes(self):
+        """La conexión se cerró: las entregas sin confirmar las reentregará el broker."""
+        with self._pendientes_lock:
+            perdidas, self._pendientes = len(self._pendientes), set()
+        if perdidas:
+            contar_mensaje(self._cola, 'sin_confirmar', perdidas)
+
+    def _programar(self, funcion):
+        try:
+            self._conexion.add_callback_threadsafe(funcion)
+            return True
+        except Exception as e:
+            # La conexión ya se cerró: el broker reentregará los mensajes sin confirmar
+            logging.warning(f"No se pudo programar la operación en la conexión RabbitMQ: {e!r}")
+            return False
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        if self._programar(functools.partial(self._canal.basic_ack, delivery_tag=delivery_tag, multiple=multiple)):
+            self._contar_confirmacion(delivery_tag, multiple, 'ack')
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        if self._programar(functools.partial(self._canal.basic_nack, delivery_tag=delivery_tag, multiple=multiple, requeue=requeue)):
+            self._contar_confirmacion(delivery_tag, multiple, evento_nack(requeue))
+
+    def basic_reject(self, delivery_tag=0, requeue=True):
+        if self._programar(functools.partial(self._canal.basic_reject, delivery_tag=delivery_tag, requeue=requeue)):
+            self._contar_confirmacion(delivery_tag, False, evento_nack(requeue))
+
+
+class ConsumidorConcurrente:
+    """Consume una cola con una ventana de prefetch y reparte las entregas en un pool de hilos.
+
+    El hilo que llama a ejecutar() es el dueño de la conexión: recibe las entregas y aplica
+    los acks que los workers programan a través de CanalHilos. detener() hace un cierre
+    ordenado: cancela el consumo, espera a los mensajes en curso y cierra la conexión.
+    listo() es la comprobación de /health: canal abierto y bucle de la conexión activo.
+    `argumentos` son los de queue_declare de la cola (p. ej. x-max-priority) y
+    `colas_adicionales` ({nombre: arguments}) otras que se declaran con ella, como las de reintentos.
+    """
+
+    def __init__(self, cola, callback, prefetch=CONSUMIDOR_PREFETCH, workers=CONSUMIDOR_WORKERS, nombre=None,
+                 argumentos=None, colas_adicionales=None):
+        self.cola = cola
+        self.argumentos = argumentos
+        self.colas_adicionales = colas_adicionales or {}
+        self.callback = callback
+        self.prefetch = max(prefetch, workers)
+        self.workers = workers
+        self.nombre = nombre or cola
+        self._detenido = threading.Event()
+        self._en_curso = 0
+        self._en_curso_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"consumidor-{self.nombre}")
+        self._canal = None
+        self._latido = time.monotonic()
+
+    def detener(self):
+        """Pide el cierre ordenado. Se puede llamar desde un manejador de señales."""
+        self._detenido.set()
+
+    def listo(self):
+        canal = self._canal
+        return canal is not None and canal.is_open and time.monotonic() - self._latido < CONSUMIDOR_LATIDO_MAXIMO
+
+    def _procesar(self, fachada, method, properties, body):
+        try:
+            with traza_mensaje(self.cola, properties), tramo(f"consumir:{self.cola}"):
+                self.callback(fachada, method, properties, body)
+        except Exception as e:
+            logging.error(f"{self.nombre}: Error no controlado procesando mensaje {method.delivery_tag}: {e}", exc_info=True)
+        finally:
+            self._descartar_sin_confirmar(fachada, [method.delivery_tag])
+            with self._en_curso_lock:
+                self._en_curso -= 1
+
+    def _descartar_sin_confirmar(self, fachada, delivery_tags):
+        """Descarta (nack sin reencolar) las entregas que el callback dejó sin confirmar.
+
+        Si no, se quedarían sin confirmar hasta cerrar la conexión y, con un prefetch bajo,
+        el consumidor dejaría de recibir mensajes aunque siga conectado.
+        """
+        for delivery_tag in fachada.sin_confirmar(delivery_tags):
+            logging.error(f"{self.nombre}: El mensaje {delivery_tag} quedó sin confirmar; se descarta sin reencolar")
+            fachada.basic_nack(delivery_tag=delivery_tag, requeue=False)
+
+    def _despachar(self, fachada, method, properties, body):
+        fachada.registrar_entrega(method.delivery_tag)
+        with self._en_curso_lock:
+            self._en_curso += 1
+        self._executor.submit(self._procesar, fachada, method, properties, body)
+
+    def _espera_eventos(self):
+        """Segundos máximos que el bucle principal espera eventos de la conexión."""
+        return 1
+
+    def _tras_eventos(self):
+        """Se llama en el hilo de la conexión tras cada espera de eventos."""
+
+    def _drenar(self, conexion, canal, consumer_tag):
+        logging.info(f"{self.nombre}: Deteniendo consumo y esperando {self._en_curso} mensajes en curso...")
+        try:
+            canal.basic_cancel(consumer_tag)
+        except Exception as e:
+            logging.warning(f"{self.nombre}: No se pudo cancelar el consumidor: {e!r}")
+        # Seguir atendiendo la conexión para que los acks de los workers lleguen al broker
+        while True:
+            with self._en_curso_lock:
+                pendientes = self._en_curso
+            if pendientes == 0:
+                break
+            conexion.process_data_events(time_limit=0.5)
+        conexion.process_data_events(time_limit=0)
+
+    def ejecutar(self):
+        """Bucle principal: conecta, consume y reconecta hasta que se llame a detener()."""
+        registrar_comprobacion(f'rabbitmq:{self.cola}', self.listo)
+        while not self._detenido.is_set():
+            conexion = conectar_a_rabbitmq()
+            if not conexion:
+                logging.warning(f"{self.nombre}: No se pudo conectar a RabbitMQ. Reintentando en 10 segundos.")
+                self._detenido.wait(10)
+                continue
+            fachada = None
+            try:
+                canal = conexion.channel()
+                for cola, argumentos in self.colas_adicionales.items():
+                    canal.queue_declare(queue=cola, durable=True, arguments=argumentos)
+                fachada = CanalHilos(conexion, canal, self.cola)
+                consumer_tag = configurar_consumidor(
+                    canal, self.cola,
+                    lambda ch, method, properties, body: self._despachar(fachada, method, properties, body),
+                    prefetch=self.prefetch, argumentos=self.argumentos
+                )
+                self._canal = canal
+                logging.info(f"{self.nombre}: Consumiendo {self.cola} con {self.workers} workers. Esperando mensajes...")
+                while not self._detenido.is_set():
+                    conexion.process_data_events(time_limit=self._espera_eventos())
+                    self._latido = time.monotonic()
+                    self._tras_eventos()
+                self._drenar(conexion, canal, consumer_tag)
+            except pika.exceptions.AMQPConnectionError as e:
+                logging.warning(f"{self.nombre}: Se perdió la conexión con RabbitMQ: {e!r}. Reintentando...")
+            except Exception as e:
+                logging.error(f"{self.nombre}: Error inesperado en el consumidor: {e}. Reintentando...", exc_info=True)
+            finally:
+                self._canal = None
+                if conexion.is_open:
+                    try:
+                        conexion.close()
+                    except Exception as close_err:
+                        logging.error(f"{self.nombre}: Error al cerrar la conexión RabbitMQ: {close_err}")
+                if fachada is not None:
+                    fachada.descartar_pendientes()
+            if not self._detenido.is_set():
+                logging.info(f"{self.nombre}: Intentando reconectar consumidor RabbitMQ en 10 segundos.")
+                self._detenido.wait(10)
+        self._executor.shutdown(wait=True)
+        logging.info(f"{self.nombre}: Consumidor detenido")
+
+
+class ConsumidorLotes(ConsumidorConcurrente):
+    """Consumidor que agrupa las entregas en lotes de hasta `tamano` mensajes o `espera_ms` milisegundos.
+
+    `callback_lote(ch, entregas)` recibe la lista de (method, properties, body) y es responsable de
+    confirmarlos. Los lotes se procesan de uno en uno y en orden de llegada, de modo que un
+    basic_ack con multiple=True sobre el último delivery_tag confirma exactamente ese lote.
+    Mientras tanto el hilo de la conexión sigue recibiendo y preparando el siguiente.
+    """
+
+    def __init__(self, cola, callback_lote, tamano, espera_ms, nombre=None):
+        super().__init__(cola, callback_lote, prefetch=2 * tamano, workers=1, nombre=nombre)
+        self.tamano = tamano
+        self.espera = espera_ms / 1000
+        self._lote = []
+        self._limite_lote = None
+        self._fachada = None
+
+    def _despachar(self, fachada, method, properties, body):
+        fachada.registrar_entrega(method.delivery_tag)
+        if fachada is not self._fachada:
+            # Conexión nueva: las entregas pendientes de la anterior ya las reentrega el broker
+            self._lote = []
+            self._fachada = fachada
+        if not self._lote:
+            self._limite_lote = time.monotonic() + self.espera
+        self._lote.append((method, properties, body))
+        if len(self._lote) >= self.tamano:
+            self._enviar_lote()
+
+    def _enviar_lote(self):
+        lote, self._lote = self._lote, []
+        with self._en_curso_lock:
+            self._en_curso += len(lote)
+        self._executor.submit(self._procesar_lote, self._fachada, lote)
+
+    def _procesar_lote(self, fachada, lote):
+        try:
+            for method, properties, body in lote:
+                registrar_espera_cola(self.cola, properties.headers)
+            with tramo(f"consumir_lote:{self.cola}"):
+                self.callback(fachada, lote)
+        except Exception as e:
+            logging.error(f"{self.nombre}: Error no controlado procesando un lote de {len(lote)} mensajes: {e}", exc_info=True)
+        finally:
+            self._descartar_sin_confirmar(fachada, [method.delivery_tag for method, _, _ in lote])
+            with self._en_curso_lock:
+                self._en_curso -= len(lote)
+
+    def _espera_eventos(self):
+        if not self._lote:
+            return 1
+        return max(0, min(1, self._limite_lote - time.monotonic()))
+
+    def _tras_eventos(self):
+        if self._lote and time.monotonic() >= self._limite_lote:
+            self._enviar_lote()
+
+    def _drenar(self, conexion, canal, consumer_tag):
+        if self._lote:
+            self._enviar_lote()
+        super()._drenar(conexion, canal, consumer_tag)
+
+
+def instalar_manejador_senales(consumidor):
+    """Detiene el consumidor de forma ordenada al recibir SIGTERM o SIGINT."""
+    def manejador(sig, frame):
+        logging.info(f"Recibida señal {sig}. Deteniendo consumidor {consumidor.nombre}...")
+        consumidor.detener()
+    signal.signal(signal.SIGTERM, manejador)
+    signal.signal(signal.SIGINT, manejador)
@@ -0,0 +1,24 @@
+"""Respuestas con las que un servidor pide bajar el ritmo (429/503) y su cabecera Retry-After.
+
+Las usan el limitador del scraper (back/trafico_utils.py) y el planificador de llamadas a
+OpenRouter (ai_service/llm_planificador.py); cada uno recorta el Retry-After a su propio máximo.
+"""
+import time
+from email.utils import parsedate_to_datetime
+
+# Respuestas con las que el servidor pide que bajemos el ritmo
+CODIGOS_LIMITACION = {429, 503}
+
+
+def segundos_retry_after(valor, maximo):
+    """Segundos de una cabecera Retry-After (número o fecha HTTP), recortados a `maximo`. None si no es válida."""
+    if not valor:
+        return None
+    try:
+        segundos = float(valor)
+    except ValueError:
+        try:
+            segundos = parsedate_to_datetime(valor).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(segundos, 0.0), maximo)
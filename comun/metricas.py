@@ -0,0 +1,158 @@
+"""Métricas Prometheus del proceso y comprobaciones de disponibilidad (/metrics y /health).
+
+Los workers sirven ambas rutas en METRICAS_PUERTO con iniciar_servidor(); las APIs Flask
+las exponen con respuesta_metricas() y estado_salud(). Bajo gunicorn cada worker es un proceso
+distinto: con PROMETHEUS_MULTIPROC_DIR definido (lo hace gunicorn.conf.py) cada uno escribe sus
+métricas en ese directorio y /metrics devuelve la suma de todos.
+"""
+import os
+import json
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from prometheus_client import (
+    Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+)
+
+# Puerto del endpoint de métricas y salud de los workers; 0 lo desactiva
+METRICAS_PUERTO = int(os.environ.get('METRICAS_PUERTO', 0))
+
+MENSAJES = Counter(
+    'rabbitmq_mensajes_total', 'Mensajes recibidos (consumido) y su desenlace por cola: ack, nack, reencolado o '
+    'sin_confirmar (la conexión se perdió antes y el broker los reentrega)',
+    ['cola', 'evento']
+)
+MENSAJES_EN_CURSO = Gauge(
+    'rabbitmq_mensajes_en_curso', 'Mensajes entregados al proceso que todavía no se han confirmado',
+    ['cola'], multiprocess_mode='livesum'
+)
+HTTP_SALIENTE = Histogram(
+    'http_saliente_segundos', 'Duración de las peticiones HTTP salientes por host y código de respuesta',
+    ['host', 'codigo'], buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+)
+REINTENTOS_PROGRAMADOS = Counter(
+    'rabbitmq_reintentos_programados_total', 'Mensajes reprogramados en una cola de reintentos, por cola de origen '
+    'y espera en segundos',
+    ['cola', 'espera']
+)
+CACHE_CONSULTAS = Counter(
+    'cache_consultas_total', 'Consultas a las cachés del proceso por resultado (aciertos por nivel, fallos)',
+    ['cache', 'resultado']
+)
+
+_comprobaciones = {}
+_comprobaciones_lock = threading.Lock()
+
+
+def contar_mensaje(cola, evento, cantidad=1):
+    MENSAJES.labels(cola, evento).inc(cantidad)
+    if evento == 'consumido':
+        MENSAJES_EN_CURSO.labels(cola).inc(cantidad)
+    else:
+        MENSAJES_EN_CURSO.labels(cola).dec(cantidad)
+
+
+def evento_nack(requeue):
+    return 'reencolado' if requeue else 'nack'
+
+
+def contar_reintento(cola, espera):
+    REINTENTOS_PROGRAMADOS.labels(cola, str(espera)).inc()
+
+
+def observar_http(host, codigo, segundos):
+    """Registra una petición saliente; `codigo` es el estado HTTP o 'error' si no hubo respuesta."""
+    HTTP_SALIENTE.labels(host, str(codigo)).observe(segundos)
+
+
+def contar_cache(cache, resultado):
+    CACHE_CONSULTAS.labels(cache, resultado).inc()
+
+
+class EntregaContada:
+    """Envuelve un mensaje de aio-pika para contar su ack/nack/reject en rabbitmq_mensajes_total.
+
+    El resto de atributos (body, headers...) se delegan en el mensaje original.
+    """
+
+    def __init__(self, mensaje, cola):
+        self._mensaje = mensaje
+        self._cola = cola
+        contar_mensaje(cola, 'consumido')
+
+    def __getattr__(self, nombre):
+        return getattr(self._mensaje, nombre)
+
+    async def ack(self, *args, **kwargs):
+        await self._mensaje.ack(*args, **kwargs)
+        contar_mensaje(self._cola, 'ack')
+
+    async def nack(self, requeue=True, **kwargs):
+        await self._mensaje.nack(requeue=requeue, **kwargs)
+        contar_mensaje(self._cola, evento_nack(requeue))
+
+    async def reject(self, requeue=False):
+        await self._mensaje.reject(requeue=requeue)
+        contar_mensaje(self._cola, evento_nack(requeue))
+
+
+def registrar_comprobacion(nombre, funcion):
+    """Añade una comprobación de disponibilidad: `funcion()` devuelve True si el recurso está listo."""
+    with _comprobaciones_lock:
+        _comprobaciones[nombre] = funcion
+
+
+def estado_salud():
+    """Ejecuta las comprobaciones registradas. Devuelve (listo, cuerpo de la respuesta de /health)."""
+    with _comprobaciones_lock:
+        comprobaciones = list(_comprobaciones.items())
+    detalle = {}
+    for nombre, funcion in comprobaciones:
+        try:
+            detalle[nombre] = bool(funcion())
+        except Exception as e:
+            logging.warning(f"Comprobación de salud '{nombre}' fallida: {e!r}")
+            detalle[nombre] = False
+    listo = all(detalle.values())
+    return listo, {'status': 'healthy' if listo else 'unhealthy', 'comprobaciones': detalle}
+
+
+def respuesta_metricas():
+    """Devuelve (cuerpo, content_type) de /metrics, agregando los procesos si hay varios."""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registro = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registro)
+    else:
+        registro = REGISTRY
+    return generate_latest(registro), CONTENT_TYPE_LATEST
+
+
+class _ManejadorMetricas(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] == '/health':
+            listo, cuerpo = estado_salud()
+            cuerpo, tipo, estado = json.dumps(cuerpo).encode('utf-8'), 'application/json', 200 if listo else 503
+        else:
+            (cuerpo, tipo), estado = respuesta_metricas(), 200
+        self.send_response(estado)
+        self.send_header('Content-Type', tipo)
+        self.send_header('Content-Length', str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, formato, *args):
+        # Prometheus y el orquestador consultan cada pocos segundos: no llenar el log
+        pass
+
+
+def iniciar_servidor(puerto=METRICAS_PUERTO):
+    """Sirve /metrics y /health en `puerto` desde un hilo daemon. No hace nada si el puerto es 0."""
+    if not puerto:
+        return None
+    servidor = ThreadingHTTPServer(('0.0.0.0', puerto), _ManejadorMetricas)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, name='metricas', daemon=True).start()
+    logging.info(f"Métricas Prometheus en :{puerto}/metrics y disponibilidad en :{puerto}/health")
+    return servidor
@@ -0,0 +1,344 @@
+"""Publicación en RabbitMQ desde cualquier hilo, con confirmaciones del broker en tubería.
+
+Un hilo propio es el dueño de una SelectConnection de pika. Los demás hilos encolan sus
+mensajes y reciben un Future por mensaje, sin tocar la conexión. Con RABBITMQ_CONFIRMACIONES
+el canal está en modo confirmación: el hilo publica sin esperar, anota el delivery tag de cada
+mensaje y resuelve los Futures a medida que llegan los basic.ack/basic.nack (también los que
+confirman varios con multiple). Como mucho RABBITMQ_VENTANA_CONFIRMACIONES mensajes esperan
+confirmación a la vez; quien publica por encima de la ventana espera a que se libere un hueco.
+
+El Future de un mensaje falla con PublicacionFallida si el broker lo rechaza (nack), lo
+devuelve por no poder enrutarlo a ninguna cola, o se pierde el canal antes de confirmarlo.
+En ese último caso el broker pudo haberlo recibido o no: no se reenvía para no duplicarlo,
+decide quien publicó (normalmente, no confirmar el mensaje que estaba procesando).
+Sin confirmaciones, el Future se resuelve en cuanto el mensaje se escribe en la conexión.
+"""
+import os
+import uuid
+import time
+import logging
+import threading
+import itertools
+import collections
+from concurrent.futures import Future
+
+import pika
+
+from comun.consumidor import get_connection_params
+
+# Publicación confirmada por el broker (publisher confirms), desactivada por defecto
+RABBITMQ_CONFIRMACIONES = os.environ.get('RABBITMQ_CONFIRMACIONES', '0').lower() in ('1', 'true', 'yes')
+# Mensajes publicados pendientes de confirmación a la vez por proceso
+RABBITMQ_VENTANA_CONFIRMACIONES = int(os.environ.get('RABBITMQ_VENTANA_CONFIRMACIONES', 1000))
+# Segundos que se espera la confirmación de un mensaje (o un hueco en la ventana) antes de darlo por fallido
+RABBITMQ_TIMEOUT_CONFIRMACION = float(os.environ.get('RABBITMQ_TIMEOUT_CONFIRMACION', 30))
+# Pausa antes de reconectar o de reabrir un canal que cerró el broker
+ESPERA_RECONEXION = 5
+
+
+class PublicacionFallida(Exception):
+    """El broker rechazó (nack) o devolvió un mensaje, o no llegó a confirmarlo."""
+
+
+class _Envio:
+    __slots__ = ('cuerpo', 'routing_key', 'exchange', 'propiedades', 'cola', 'argumentos', 'mandatory',
+                 'futuro', 'devuelto')
+
+    def __init__(self, cuerpo, routing_key, exchange, propiedades, cola, argumentos, mandatory):
+        self.cuerpo = cuerpo
+        self.routing_key = routing_key
+        self.exchange = exchange
+        self.propiedades = propiedades
+        self.cola = cola
+        self.argumentos = argumentos
+        self.mandatory = mandatory
+        self.futuro = Future()
+        self.devuelto = None
+
+    @property
+    def destino(self):
+        return f'{self.exchange}/{self.routing_key}' if self.exchange else self.routing_key
+
+
+class PublicadorRabbitMQ:
+    """Publicador compartido por todos los hilos de un proceso (ver el docstring del módulo).
+
+    `topologia(canal)`, si se indica, declara exchanges y colas cada vez que se abre un canal.
+    Las declaraciones se envían sin esperar respuesta (nowait): viajan en orden por el canal,
+    así que un mensaje publicado después ya encuentra su cola, y si una falla el broker cierra
+    el canal y fallan los mensajes que quedaban por confirmar.
+    """
+
+    def __init__(self, confirmaciones=RABBITMQ_CONFIRMACIONES, ventana=RABBITMQ_VENTANA_CONFIRMACIONES,
+                 topologia=None):
+        self.confirmaciones = confirmaciones
+        self.ventana = max(1, ventana)
+        self._topologia = topologia
+        self._cond = threading.Condition()
+        self._en_espera = collections.deque()
+        self._pendientes = 0
+        self._cerrando = threading.Event()
+        self._hilo = None
+        self._conexion = None
+        # Solo los usa el hilo de la conexión
+        self._canal = None
+        self._etiquetas = None
+        self._sin_confirmar = {}
+        self._por_id = {}
+        self._declaradas = set()
+
+    # --- Hilos que publican ---
+
+    def publicar(self, cuerpo, routing_key, exchange='', propiedades=None, cola=None, argumentos=None,
+                 mandatory=True, timeout=RABBITMQ_TIMEOUT_CONFIRMACION):
+        """Encola un mensaje y devuelve un Future que se resuelve cuando el broker lo confirma.
+
+        `cola`, si se indica, se declara duradera (con `argumentos`) la primera vez en cada canal
+        y, con `exchange`, se vincula a él (exchange directo) con `routing_key`. Con confirmaciones
+        y `mandatory`, un mensaje que no llega a ninguna cola falla en lugar de perderse.
+        Si la ventana sigue llena tras `timeout` segundos, el Future falla sin publicar.
+        """
+        propiedades = propiedades or pika.BasicProperties()
+        mandatory = mandatory and self.confirmaciones
+        if mandatory and propiedades.message_id is None:
+            # Identifica el mensaje en un basic.return, que no trae delivery tag
+            propiedades.message_id = uuid.uuid4().hex
+        envio = _Envio(cuerpo, routing_key, exchange, propiedades, cola, argumentos, mandatory)
+        with self._cond:
+            if self._cerrando.is_set():
+                envio.futuro.set_exception(PublicacionFallida(f'Publicador cerrado; no se envía el mensaje para {envio.destino}'))
+                return envio.futuro
+            if not self._cond.wait_for(lambda: self._pendientes < self.ventana, timeout):
+                envio.futuro.set_exception(PublicacionFallida(
+                    f'Ventana de {self.ventana} mensajes sin confirmar llena durante {timeout:g} s; '
+                    f'no se envía el mensaje para {envio.destino}'
+                ))
+                return envio.futuro
+            self._pendientes += 1
+            self._en_espera.append(envio)
+        self._arrancar()
+        self._despertar()
+        return envio.futuro
+
+    def cerrar(self, timeout=RABBITMQ_TIMEOUT_CONFIRMACION):
+        """Espera (hasta `timeout`) a que se confirme lo publicado y cierra la conexión."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._pendientes == 0, timeout):
+                logging.warning(f"Publicador: se cierra con {self._pendientes} mensajes sin confirmar")
+            self._cerrando.set()
+        conexion = self._conexion
+        if conexion is not None:
+            try:
+                conexion.ioloop.add_callback_threadsafe(self._cerrar_conexion)
+            except Exception:
+                pass
+        if self._hilo is not None:
+            self._hilo.join(timeout)
+
+    def _arrancar(self):
+        if self._hilo is None:
+            with self._cond:
+                if self._hilo is None:
+                    self._hilo = threading.Thread(target=self._ejecutar, name='publicador-rabbitmq', daemon=True)
+                    self._hilo.start()
+
+    def _despertar(self):
+        conexion = self._conexion
+        if conexion is None:
+            return  # Al abrirse el canal se publica lo que esté en espera
+        try:
+            conexion.ioloop.add_callback_threadsafe(self._vaciar)
+        except Exception:
+            pass  # La conexión se está cerrando; se reintentará al reconectar
+
+    def _resolver(self, envio, error=None):
+        if error is None:
+            envio.futuro.set_result(None)
+        else:
+            envio.futuro.set_exception(error)
+        with self._cond:
+            self._pendientes -= 1
+            self._cond.notify_all()
+
+    # --- Hilo de la conexión ---
+
+    def _ejecutar(self):
+        while not self._cerrando.is_set():
+            try:
+                self._conexion = pika.SelectConnection(
+                    get_connection_params(),
+                    on_open_callback=self._al_abrir_conexion,
+                    on_open_error_callback=self._al_fallar_conexion,
+                    on_close_callback=self._al_cerrar_conexion,
+                )
+                self._conexion.ioloop.start()
+            except Exception as e:
+                logging.error(f"Publicador: error en la conexión con RabbitMQ: {e!r}", exc_info=True)
+                self._perder_canal(f'error en la conexión ({e!r})')
+            self._conexion = None
+            if not self._cerrando.is_set():
+                self._cerrando.wait(ESPERA_RECONEXION)
+        with self._cond:
+            en_espera, self._en_espera = list(self._en_espera), collections.deque()
+        for envio in en_espera:
+            self._resolver(envio, PublicacionFallida(f'Publicador cerrado antes de enviar el mensaje para {envio.destino}'))
+        logging.info("Publicador: conexión con RabbitMQ cerrada")
+
+    def _cerrar_conexion(self):
+        # También interrumpe una conexión que aún se está estableciendo
+        conexion = self._conexion
+        if conexion is not None and not (conexion.is_closing or conexion.is_closed):
+            conexion.close()
+
+    def _al_abrir_conexion(self, conexion):
+        logging.info("Publicador: conexión establecida con RabbitMQ")
+        self._abrir_canal()
+
+    def _al_fallar_conexion(self, conexion, error):
+        logging.warning(f"Publicador: no se pudo conectar con RabbitMQ ({error!r}). Reintentando en {ESPERA_RECONEXION} s")
+        conexion.ioloop.stop()
+
+    def _al_cerrar_conexion(self, conexion, motivo):
+        if not self._cerrando.is_set():
+            logging.warning(f"Publicador: se perdió la conexión con RabbitMQ ({motivo!r}). Reconectando...")
+        self._perder_canal(f'conexión cerrada ({motivo!r})')
+        conexion.ioloop.stop()
+
+    def _abrir_canal(self):
+        conexion = self._conexion
+        if conexion is not None and conexion.is_open and not self._cerrando.is_set():
+            conexion.channel(on_open_callback=self._al_abrir_canal)
+
+    def _al_abrir_canal(self, canal):
+        canal.add_on_close_callback(self._al_cerrar_canal)
+        canal.add_on_return_callback(self._al_devolver)
+        self._declaradas.clear()
+        if self._topologia is not None:
+            self._topologia(canal)
+        if self.confirmaciones:
+            canal.confirm_delivery(ack_nack_callback=self._al_confirmar, callback=lambda _: self._canal_listo(canal))
+        else:
+            self._canal_listo(canal)
+
+    def _canal_listo(self, canal):
+        # Los delivery tags de las confirmaciones empiezan en 1 en cada canal
+        self._etiquetas = itertools.count(1)
+        self._canal = canal
+        self._vaciar()
+
+    def _al_cerrar_canal(self, canal, motivo):
+        self._perder_canal(f'canal cerrado ({motivo!r})')
+        if isinstance(motivo, pika.exceptions.ChannelClosedByBroker):
+            # Por ejemplo, una cola declarada con otros argumentos: los mensajes en vuelo ya han fallado
+            logging.error(f"Publicador: el broker cerró el canal ({motivo!r}). Reabriendo en {ESPERA_RECONEXION} s")
+            self._conexion.ioloop.call_later(ESPERA_RECONEXION, self._abrir_canal)
+
+    def _perder_canal(self, motivo):
+        """El canal ya no sirve: fallan los mensajes publicados que no se llegaron a confirmar."""
+        self._canal = None
+        sin_confirmar, self._sin_confirmar = self._sin_confirmar, {}
+        self._por_id.clear()
+        for envio in sin_confirmar.values():
+            self._resolver(envio, PublicacionFallida(
+                f'Sin confirmación del broker para el mensaje para {envio.destino}: {motivo}; '
+                'pudo entregarse o no'
+            ))
+
+    def _vaciar(self):
+        """Publica los mensajes en espera sin esperar confirmaciones."""
+        while self._canal is not None and self._canal.is_open:
+            with self._cond:
+                if not self._en_espera:
+                    return
+                envio = self._en_espera.popleft()
+            self._enviar(self._canal, envio)
+
+    def _enviar(self, canal, envio):
+        try:
+            if envio.cola is not None:
+                self._declarar(canal, envio)
+            canal.basic_publish(envio.exchange, envio.routing_key, envio.cuerpo, envio.propiedades,
+                                mandatory=envio.mandatory)
+        except Exception as e:
+            self._resolver(envio, PublicacionFallida(f'No se pudo publicar el mensaje para {envio.destino}: {e!r}'))
+            return
+        if not self.confirmaciones:
+            self._resolver(envio)
+            return
+        etiqueta = next(self._etiquetas)
+        self._sin_confirmar[etiqueta] = envio
+        if envio.mandatory:
+            self._por_id[envio.propiedades.message_id] = etiqueta
+
+    def _declarar(self, canal, envio):
+        clave = (envio.exchange, envio.cola, envio.routing_key) if envio.exchange else envio.cola
+        if clave in self._declaradas:
+            return
+        if envio.exchange:
+            canal.exchange_declare(exchange=envio.exchange, exchange_type='direct', durable=True)
+        canal.queue_declare(queue=envio.cola, durable=True, arguments=envio.argumentos)
+        if envio.exchange:
+            canal.queue_bind(queue=envio.cola, exchange=envio.exchange, routing_key=envio.routing_key)
+        self._declaradas.add(clave)
+
+    def _al_devolver(self, canal, method, properties, body):
+        # El broker envía el basic.return de un mensaje antes que su basic.ack
+        etiqueta = self._por_id.pop(properties.message_id, None)
+        envio = self._sin_confirmar.get(etiqueta)
+        if envio is not None:
+            envio.devuelto = f'{method.reply_code} {method.reply_text}'
+
+    def _al_confirmar(self, frame):
+        metodo = frame.method
+        rechazado = isinstance(metodo, pika.spec.Basic.Nack)
+        if metodo.multiple:
+            # Las etiquetas se insertan en orden: las confirmadas son las primeras hasta delivery_tag
+            etiquetas = list(itertools.takewhile(lambda etiqueta: etiqueta <= metodo.delivery_tag, self._sin_confirmar))
+        else:
+            etiquetas = [metodo.delivery_tag]
+        for etiqueta in etiquetas:
+            envio = self._sin_confirmar.pop(etiqueta, None)
+            if envio is None:
+                continue
+            if envio.mandatory:
+                self._por_id.pop(envio.propiedades.message_id, None)
+            if rechazado:
+                self._resolver(envio, PublicacionFallida(f'El broker rechazó (nack) el mensaje para {envio.destino}'))
+            elif envio.devuelto:
+                self._resolver(envio, PublicacionFallida(
+                    f'El broker devolvió el mensaje para {envio.destino} ({envio.devuelto}): no llegó a ninguna cola'
+                ))
+            else:
+                self._resolver(envio)
+
+
+def esperar_confirmaciones(futuros, timeout=RABBITMQ_TIMEOUT_CONFIRMACION):
+    """Espera a la vez los Futures de varios publicar(). Devuelve [(índice, error)] de los que fallaron."""
+    limite = time.monotonic() + timeout
+    fallos = []
+    for indice, futuro in enumerate(futuros):
+        try:
+            futuro.result(timeout=max(0.0, limite - time.monotonic()))
+        except TimeoutError:
+            fallos.append((indice, PublicacionFallida(f'Sin confirmación del broker tras {timeout:g} s')))
+        except Exception as e:
+            fallos.append((indice, e))
+    return fallos
+
+
+_publicador = None
+_publicador_lock = threading.Lock()
+
+
+def obtener_publicador(topologia=None):
+    """Devuelve el publicador compartido del proceso, creándolo la primera vez (con esa `topologia`)."""
+    global _publicador
+    if _publicador is None:
+        with _publicador_lock:
+            if _publicador is None:
+                _publicador = PublicadorRabbitMQ(topologia=topologia)
+                logging.info(
+                    f"Publicador RabbitMQ inicializado (confirmaciones: {'sí' if RABBITMQ_CONFIRMACIONES else 'no'}, "
+                    f"ventana: {RABBITMQ_VENTANA_CONFIRMACIONES})"
+                )
+    return _publicador
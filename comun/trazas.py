@@ -0,0 +1,198 @@
+"""Trazas del recorrido de una solicitud: id de correlación, espera en colas y duración de cada etapa.
+
+index.py (backend) asigna el id de correlación al recibir el formulario y viaja en el cuerpo
+(`id_correlacion`) y en las cabeceras AMQP de cada mensaje, junto con la hora de publicación.
+Las duraciones se exportan como histogramas de Prometheus y, si hay un colector OTLP
+configurado (OTEL_EXPORTER_OTLP_ENDPOINT) y OpenTelemetry está instalado, también como spans:
+el id de correlación se usa como trace id, así todos los servicios comparten la misma traza.
+"""
+import os
+import time
+import uuid
+import random
+import inspect
+import logging
+import functools
+import contextvars
+from contextlib import contextmanager
+
+from prometheus_client import Histogram
+
+from comun.metricas import iniciar_servidor
+
+OTEL_EXPORTER_OTLP_ENDPOINT = os.environ.get('OTEL_EXPORTER_OTLP_ENDPOINT', '')
+# Si no se define, cada servicio usa el nombre que pasa a iniciar_exportadores()
+OTEL_SERVICE_NAME = os.environ.get('OTEL_SERVICE_NAME', '')
+
+CABECERA_CORRELACION = 'x-id-correlacion'
+# Milisegundos desde epoch en que se publicó el mensaje
+CABECERA_PUBLICADO_EN = 'x-publicado-en'
+
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+DURACION_ETAPA = Histogram(
+    'pipeline_etapa_segundos', 'Duración de cada etapa del procesamiento de una solicitud',
+    ['etapa'], buckets=BUCKETS_SEGUNDOS
+)
+ESPERA_COLA = Histogram(
+    'pipeline_espera_cola_segundos', 'Tiempo entre la publicación de un mensaje y el inicio de su procesamiento',
+    ['cola'], buckets=BUCKETS_SEGUNDOS
+)
+
+_id_correlacion = contextvars.ContextVar('id_correlacion', default=None)
+_otel = None
+
+
+def nuevo_id_correlacion():
+    return uuid.uuid4().hex
+
+
+def id_correlacion_actual():
+    """Id de correlación del mensaje que se está procesando en este hilo o tarea, o None."""
+    return _id_correlacion.get()
+
+
+def id_correlacion_de(properties, mensaje=None):
+    """Id de correlación de una entrega: cabeceras, después el cuerpo; None si no trae."""
+    cabeceras = getattr(properties, 'headers', None) or {}
+    id_correlacion = cabeceras.get(CABECERA_CORRELACION)
+    if not id_correlacion and isinstance(mensaje, dict):
+        id_correlacion = mensaje.get('id_correlacion')
+    return id_correlacion.decode() if isinstance(id_correlacion, bytes) else id_correlacion
+
+
+def registrar_espera_cola(cola, cabeceras):
+    """Observa cuánto esperó un mensaje en `cola` si trae la hora de publicación."""
+    publicado_en = (cabeceras or {}).get(CABECERA_PUBLICADO_EN)
+    if publicado_en is None:
+        return
+    try:
+        espera = time.time() - int(publicado_en) / 1000
+    except (TypeError, ValueError):
+        return
+    # Relojes de hosts distintos: una espera negativa solo indica desfase
+    ESPERA_COLA.labels(cola).observe(max(espera, 0))
+
+
+def cabeceras_traza(mensaje=None):
+    """Cabeceras AMQP de un mensaje saliente: hora de publicación e id de correlación.
+
+    El id se toma del propio mensaje (`id_correlacion`) o, si no lo trae, del contexto actual.
+    """
+    cabeceras = {CABECERA_PUBLICADO_EN: int(time.time() * 1000)}
+    id_correlacion = mensaje.get('id_correlacion') if isinstance(mensaje, dict) else None
+    id_correlacion = id_correlacion or id_correlacion_actual()
+    if id_correlacion:
+        cabeceras[CABECERA_CORRELACION] = id_correlacion
+    return cabeceras
+
+
+@contextmanager
+def traza_mensaje(cola, properties, registrar_espera=True):
+    """Contexto de procesamiento de una entrega: registra su espera y fija su id de correlación.
+
+    Si la entrega no trae id (primer salto de la solicitud) se genera uno nuevo.
+    """
+    if registrar_espera:
+        registrar_espera_cola(cola, getattr(properties, 'headers', None))
+    token = _id_correlacion.set(id_correlacion_de(properties) or nuevo_id_correlacion())
+    try:
+        yield _id_correlacion.get()
+    finally:
+        _id_correlacion.reset(token)
+
+
+@contextmanager
+def tramo(etapa, **atributos):
+    """Mide la duración de una etapa y la exporta (histograma y, si está activo, span OTLP)."""
+    inicio = time.perf_counter()
+    span, token = _abrir_span(etapa, atributos)
+    try:
+        yield
+    except Exception as e:
+        if span is not None:
+            span.record_exception(e)
+            span.set_status(_otel['Status'](_otel['StatusCode'].ERROR))
+        raise
+    finally:
+        DURACION_ETAPA.labels(etapa).observe(time.perf_counter() - inicio)
+        if span is not None:
+            span.end()
+            _otel['context'].detach(token)
+
+
+def medir_etapa(etapa):
+    """Decorador equivalente a envolver la función (o corrutina) en `tramo(etapa)`."""
+    def decorador(funcion):
+        if inspect.iscoroutinefunction(funcion):
+            @functools.wraps(funcion)
+            async def envoltorio_async(*args, **kwargs):
+                with tramo(etapa):
+                    return await funcion(*args, **kwargs)
+            return envoltorio_async
+
+        @functools.wraps(funcion)
+        def envoltorio(*args, **kwargs):
+            with tramo(etapa):
+                return funcion(*args, **kwargs)
+        return envoltorio
+    return decorador
+
+
+def _abrir_span(etapa, atributos):
+    """Abre el span de una etapa y lo hace actual. Devuelve (span, token) o (None, None)."""
+    if _otel is None:
+        return None, None
+    trace = _otel['trace']
+    contexto = None
+    id_correlacion = id_correlacion_actual()
+    if id_correlacion and not trace.get_current_span().get_span_context().is_valid:
+        # Primer span del mensaje en este proceso: colgarlo de la traza del id de correlación
+        try:
+            padre = _otel['SpanContext'](
+                trace_id=int(id_correlacion, 16), span_id=random.getrandbits(64), is_remote=True,
+                trace_flags=_otel['TraceFlags'](_otel['TraceFlags'].SAMPLED)
+            )
+            contexto = trace.set_span_in_context(trace.NonRecordingSpan(padre))
+        except ValueError:
+            contexto = None
+    if id_correlacion:
+        atributos['id_correlacion'] = id_correlacion
+    span = _otel['tracer'].start_span(etapa, context=contexto, attributes=atributos)
+    # Los tramos anidados (en este hilo o en hilos que copian el contexto) cuelgan de este
+    token = _otel['context'].attach(trace.set_span_in_context(span))
+    return span, token
+
+
+def _iniciar_otel(servicio):
+    global _otel
+    try:
+        from opentelemetry import trace, context
+        from opentelemetry.trace import SpanContext, TraceFlags, Status, StatusCode
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    except ImportError:
+        logging.warning("OTEL_EXPORTER_OTLP_ENDPOINT está configurado pero OpenTelemetry no está instalado; solo se exportan métricas")
+        return
+    servicio = OTEL_SERVICE_NAME or servicio
+    proveedor = TracerProvider(resource=Resource.create({'service.name': servicio}))
+    # El exportador toma el endpoint de OTEL_EXPORTER_OTLP_ENDPOINT (p. ej. http://otel-collector:4318)
+    proveedor.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(proveedor)
+    _otel = {
+        'trace': trace, 'context': context, 'SpanContext': SpanContext, 'TraceFlags': TraceFlags,
+        'Status': Status, 'StatusCode': StatusCode, 'tracer': trace.get_tracer(servicio),
+    }
+    logging.info(f"Exportando spans a {OTEL_EXPORTER_OTLP_ENDPOINT} como servicio '{servicio}'")
+
+
+def iniciar_exportadores(servicio):
+    """Arranca /metrics y /health (si METRICAS_PUERTO) y el exportador OTLP (si está configurado).
+
+    `servicio` es el nombre de las trazas cuando OTEL_SERVICE_NAME no está definido.
+    """
+    iniciar_servidor()
+    if OTEL_EXPORTER_OTLP_ENDPOINT and _otel is None:
+        _iniciar_otel(servicio)
@@ -68,6 +68,7 @@ function App() {
   const [connectionStatus, setConnectionStatus] = useState('Conectando...')
   const [debugInfo, setDebugInfo] = useState({})
   const [scrapedUrls, setScrapedUrls] = useState([]);
+  const [buscandoProductos, setBuscandoProductos] = useState(false); // Hasta recibir el mensaje final del scraper
 
   // Conectar a RabbitMQ al cargar el componente
   useEffect(() => {
@@ -178,6 +179,13 @@ function App() {
       } else {
         console.warn('Formato de URLs scrapeadas inesperado:', data);
       }
+
+      // El mensaje final llega aunque no se haya encontrado ningún producto
+      if (data && data.final) {
+        console.log('Scraping terminado, URLs en total:', data.total ?? data.urls?.length);
+        setBuscandoProductos(false);
+        setIsLoading(false);
+      }
     });
 
     return () => {
@@ -200,6 +208,7 @@ function App() {
     // Primero establecemos el estado de carga a true y limpiamos las URLs
     setIsLoading(true);
     setScrapedUrls([]);
+    setBuscandoProductos(true);
     setMensaje('Enviando formulario...');
     
     // Registramos el estado actual para verificar
@@ -226,6 +235,7 @@ function App() {
     } catch (error) {
       console.error('Error al enviar formulario:', error);
       setIsLoading(false); // En caso de error, desactivamos el estado de carga
+      setBuscandoProductos(false);
       setMensaje(`Error al enviar el formulario: ${error.message || 'Error desconocido'}`);
       
       // Actualizar información de depuración
@@ -501,7 +511,7 @@ function App() {
       {mensaje && <p className="message">{mensaje}</p>}
       
       {/* Componente de círculo de carga */}
-      {isLoading && scrapedUrls.length === 0 && (
+      {(isLoading || buscandoProductos) && scrapedUrls.length === 0 && (
         <LoadingContainer>
           <LoadingSpinner />
           <p>Buscando productos recomendados para ti...</p>
@@ -513,7 +523,8 @@ function App() {
         <h3>Estado de depuración:</h3>
         <p>isLoading: {isLoading ? 'true' : 'false'}</p>
         <p>scrapedUrls.length: {scrapedUrls.length}</p>
-        <p>¿Debería mostrar spinner? {(isLoading && scrapedUrls.length === 0) ? 'SÍ' : 'NO'}</p>
+        <p>buscandoProductos: {buscandoProductos ? 'true' : 'false'}</p>
+        <p>¿Debería mostrar spinner? {((isLoading || buscandoProductos) && scrapedUrls.length === 0) ? 'SÍ' : 'NO'}</p>
         <button 
           onClick={() => {
             console.log('Forzando isLoading a true');
@@ -533,9 +544,11 @@ function App() {
       {scrapedUrls.length > 0 && (
         <div className="scraped-urls-container">
           <h2>Enlaces de Productos Encontrados:</h2>
+          {buscandoProductos && <p className="message">Buscando más productos...</p>}
           <div className="microlink-cards-wrapper">
-            {scrapedUrls.map((url, index) => (
-              <Microlink key={index} url={url} size="large" media={['image', 'logo']} style={{ marginBottom: '20px' }} />
+            {/* La URL como key: las tarjetas ya mostradas no se vuelven a montar al llegar más */}
+            {scrapedUrls.map((url) => (
+              <Microlink key={url} url={url} size="large" media={['image', 'logo']} style={{ marginBottom: '20px' }} />
             ))}
           </div>
         </div>
@@ -11,6 +11,17 @@ const RABBITMQ_WS_URL = `ws://${RABBITMQ_HOST}:${RABBITMQ_PORT}/ws`;
 const QUEUE_SOLICITUDES = 'solicitudes';
 const QUEUE_RESPUESTAS = 'respuestas';
 const QUEUE_SCRAPED_URLS = 'scraped_urls_queue'; // Nueva cola para URLs scrapeadas
+// Exchange topic por el que el backend envía a cada sesión solo sus resultados
+// (routing key `sesion.<clave>.<cola>`, la clave viaja como `reply_to` en el formulario)
+const EXCHANGE_RESULTADOS = 'resultados';
+
+// Clave de esta pestaña: 8 a 64 caracteres de [A-Za-z0-9_-], como exige el backend
+const crearClaveSesion = () => {
+  if (window.crypto && window.crypto.randomUUID) {
+    return window.crypto.randomUUID().replace(/-/g, '');
+  }
+  return `${Date.now().toString(36)}${Math.random().toString(36).slice(2)}`;
+};
 
 // Para depuración
 console.log(`Entorno Docker: ${isInDocker}`);
@@ -29,6 +40,13 @@ class RabbitMQService {
     this.connectionAttempts = 0;
     this.maxConnectionAttempts = 3;
     this.mockMode = false;
+    this.sessionKey = crearClaveSesion();
+  }
+
+  // Destino WebSTOMP de los mensajes de `cola` para esta sesión. Suscribirse a /exchange/...
+  // crea una cola exclusiva que RabbitMQ borra al desconectarse: el navegador solo recibe lo suyo
+  _sessionDestination(cola) {
+    return `/exchange/${EXCHANGE_RESULTADOS}/sesion.${this.sessionKey}.${cola}`;
   }
 
   // Conectar con RabbitMQ mediante WebSTOMP
@@ -176,8 +194,8 @@ class RabbitMQService {
     }
 
     try {
-      // En WebSTOMP, la cola debe tener el prefijo /queue/
-      const queueDestination = `/queue/${QUEUE_RESPUESTAS}`;
+      // Respuestas de esta sesión, no la cola compartida `respuestas`
+      const queueDestination = this._sessionDestination(QUEUE_RESPUESTAS);
       
       console.log(`Suscribiéndose a cola de respuestas: ${queueDestination}`);
       
@@ -192,7 +210,7 @@ class RabbitMQService {
       });
 
       // Suscribirse a la cola de URLs scrapeadas
-      const scrapedUrlsDestination = `/queue/${QUEUE_SCRAPED_URLS}`;
+      const scrapedUrlsDestination = this._sessionDestination(QUEUE_SCRAPED_URLS);
       console.log(`Suscribiéndose a cola de URLs scrapeadas: ${scrapedUrlsDestination}`);
       this.client.subscribe(scrapedUrlsDestination, (message) => {
         try {
@@ -240,7 +258,8 @@ class RabbitMQService {
       
       this.client.publish({
         destination: queueDestination,
-        body: JSON.stringify(data),
+        // reply_to indica al backend la ruta por la que devolver respuestas y URLs a esta sesión
+        body: JSON.stringify({ ...data, reply_to: this.sessionKey }),
         headers: { 'content-type': 'application/json' }
       });
       
@@ -342,8 +361,14 @@ class RabbitMQService {
   }
 
   // Nuevo método para procesar URLs scrapeadas
+  // Con la entrega incremental del scraper llega un mensaje por búsqueda ({ secuencia, urls })
+  // y un cierre con `final: true` y sin URLs. Los mensajes sin `secuencia` (formato anterior)
+  // traen todas las URLs de una vez, así que también son el cierre.
   _processScrapedUrls(data) {
     console.log('Procesando URLs scrapeadas:', data);
+    if (data && data.secuencia === undefined) {
+      data = { ...data, final: true };
+    }
     const callbacks = this.messageCallbacks.get('scraped_urls') || [];
     
     callbacks.forEach(callback => {